@@ -0,0 +1,205 @@
+import time
+import asyncio
+import traceback
+from collections import deque
+from metrics import METRICS
+from refresh import PendingChanges
+
+
+class AsyncRuntime:
+    """
+    Drives a RefreshPool from an asyncio event loop instead of polling once a second
+
+    The loop sleeps until the next user expires, a fetch finishes or the schedule gets an
+    earlier entry (from any thread), so refreshes start on time and on_changes() runs as soon
+    as the refreshes that were overdue when the changes came in have been applied.
+
+    Fetches run in the pool's worker threads and only read the users they're given. Everything
+    that changes the Database or its schedule runs on the event loop: refresh results, rebuilds,
+    and the update handlers, which other threads pass to call() instead of running themselves.
+    """
+    # longest sleep between wakeups, so on_wakeup() keeps running while nothing is due
+    max_sleep = 60
+    # sleep after step() raised, so an error that keeps happening doesn't spin
+    error_sleep = 1
+
+    def __init__(self, db, refresh_pool, on_changes, on_wakeup=None, get_flush_delay=None, on_error=None):
+        self.db = db
+        self.refresh_pool = refresh_pool
+        self.on_changes = on_changes
+        self.on_wakeup = on_wakeup
+        # gets the traceback of anything step() raised, the loop keeps running either way
+        self.on_error = on_error
+        # returns how many seconds until on_wakeup() has something to write, or None
+        self.get_flush_delay = get_flush_delay
+        self.pending_changes = PendingChanges()
+        # functions and arguments that other threads asked call() to run on the loop, in order
+        self.calls = deque()
+        self.loop = None
+        self.wakeup_event = None
+        self.stopping = False
+
+    def wakeup(self):
+        """Makes the event loop look at the schedule and the fetches again, safe to call from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup_event.set)
+
+    def call(self, func, *args):
+        """Runs func(*args) on the event loop at the start of the next step, safe to call from any thread"""
+        self.calls.append((func, args))
+        self.wakeup()
+
+    def stop(self):
+        """Stops run() after the current step, safe to call from any thread and from signal handlers"""
+        self.stopping = True
+        self.wakeup()
+
+    def _get_sleep(self):
+        """Returns how long to sleep until the next user expires or something has to be written"""
+        sleep = self.max_sleep
+        if self.db.get_expired_count() > 0:
+            # every worker is busy if users are still overdue after step(), a finished fetch wakes us up
+            if not self.refresh_pool.busy():
+                return 0
+        else:
+            next_id, expires = self.db.expiry.peek()
+            if next_id is not None:
+                # get_current_timestamp() rounds, pop_due() needs expires to be in the past
+                sleep = min(max(expires + 0.5 - time.time(), 0), sleep)
+        flush_delay = self.get_flush_delay() if self.get_flush_delay else None
+        if flush_delay is not None:
+            sleep = min(flush_delay, sleep)
+        changes_delay = self.pending_changes.get_delay()
+        if changes_delay is not None:
+            sleep = min(changes_delay, sleep)
+        return sleep
+
+    def step(self):
+        """Starts due refreshes, applies finished ones and calls on_changes() once the changes are ready"""
+        while self.calls:
+            func, args = self.calls.popleft()
+            func(*args)
+
+        in_flight = {future for user_id, future in self.refresh_pool.in_flight}
+        self.refresh_pool.submit_expired(self.db)
+        for user_id, future in self.refresh_pool.in_flight:
+            if future not in in_flight:
+                future.add_done_callback(lambda future: self.wakeup())
+
+        self.pending_changes.extend(self.refresh_pool.collect(self.db), self.db, self.refresh_pool.in_flight_ids)
+
+        if self.on_wakeup:
+            self.on_wakeup()
+
+        if self.pending_changes.is_ready(self.db, self.refresh_pool.in_flight_ids):
+            self.on_changes(self.pending_changes.take())
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup_event = asyncio.Event()
+        self.db.expiry.on_earlier = self.wakeup
+
+        try:
+            while not self.stopping:
+                self.wakeup_event.clear()
+                try:
+                    self.step()
+                    sleep = self._get_sleep()
+                except Exception as e:
+                    print('Encountered exception while running main loop:', type(e))
+                    traceback.print_exc()
+                    METRICS.inc('biochain_main_loop_errors_total')
+                    if self.on_error:
+                        self.on_error(traceback.format_exc())
+                    sleep = self.error_sleep
+                if self.stopping:
+                    break
+                if sleep > 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup_event.wait(), sleep)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.db.expiry.on_earlier = None
+            self.loop = None
+
+
+if __name__ == '__main__':
+    import os
+    import shutil
+    import tempfile
+    import threading
+    from database import Database
+    from refresh import RefreshPool
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'db.json')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'), filename)
+        db = Database(filename)
+        db.update_best_chain('8888', rebuild_links=True)
+
+        fetched = []
+
+        def fetch(user):
+            time.sleep(0.05)
+            fetched.append(user.id)
+            new_bio = ['end_user', 'literally_satan'] if user.id == '42' else user.bio
+            return user.username, False, new_bio
+
+        pool = RefreshPool(None, concurrency=2)
+        pool._fetch = fetch
+        rebuilds = []
+
+        def on_changes(changes):
+            # every overdue user has been refreshed by now
+            assert db.get_expired_count() == 0 and not pool.busy()
+            rebuilds.append([str(change) for change in changes])
+            runtime.stop()
+
+        runtime = AsyncRuntime(db, pool, on_changes)
+        start = time.perf_counter()
+        asyncio.run(runtime.run())
+        assert sorted(fetched) == sorted(db.users), fetched
+        assert len(rebuilds) == 1 and len(rebuilds[0]) == 1
+        # no polling: five fetches on two workers take about three fetch times, not seconds
+        assert time.perf_counter() - start < 1
+
+        # a handler from another thread runs on the loop, and the user it marks for updating is fetched right away
+        fetched.clear()
+        handler_threads = []
+
+        def on_wakeup():
+            if fetched:
+                runtime.stop()
+
+        def handler(user_id):
+            handler_threads.append(threading.get_ident())
+            db.users[user_id].expires = 0
+
+        runtime = AsyncRuntime(db, pool, on_changes, on_wakeup)
+        threading.Timer(0.2, runtime.call, (handler, '666')).start()
+        start = time.perf_counter()
+        asyncio.run(runtime.run())
+        assert fetched == ['666']
+        assert handler_threads == [threading.get_ident()]
+        assert time.perf_counter() - start < 1.5
+
+        # an exception in a step is reported and the loop goes on
+        errors = []
+        wakeups = []
+
+        def on_wakeup():
+            wakeups.append(time.perf_counter())
+            if len(wakeups) == 1:
+                raise RuntimeError('broken')
+            runtime.stop()
+
+        runtime = AsyncRuntime(db, pool, on_changes, on_wakeup, on_error=errors.append)
+        runtime.error_sleep = 0.1
+        asyncio.run(runtime.run())
+        assert len(wakeups) == 2 and len(errors) == 1 and 'RuntimeError: broken' in errors[0]
+        assert METRICS.get('biochain_main_loop_errors_total') == 1
+
+        pool.shutdown()
+
+    print('ok')
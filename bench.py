@@ -0,0 +1,197 @@
+"""
+Benchmarks the Database on generated chain graphs and prints the timings as JSON
+
+Usage: python bench.py [--sizes 100,1000,10000,100000] [--repeat 3] [--seed 0] [--output results.json]
+Everything runs offline against generated db.json files like example_db.json.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import contextlib
+
+from database import Database
+
+
+def generate_db(user_count, seed=0, now=None):
+    """
+    Returns (data in the db.json format, ID of the end node) for a random group of user_count users:
+    a long chain, many short branches, fan-in hubs, cycles, dead links and disabled users
+    """
+    rng = random.Random(seed)
+    now = now or int(time.time())
+    ids = [str(100000 + i) for i in range(user_count)]
+    usernames = {user_id: f'user{i:06d}' for i, user_id in enumerate(ids)}
+    bio_links = {user_id: [] for user_id in ids}
+    dead_links = {user_id: set() for user_id in ids}
+    disabled = set()
+
+    # the main chain, ids[0] is the end node
+    main = ids[:max(2, user_count // 4)]
+    for i in range(1, len(main)):
+        bio_links[main[i]].append(main[i - 1])
+    hubs = rng.sample(main, max(1, len(main) // 50))
+
+    rest = ids[len(main):]
+    branch_nodes = []
+    i = 0
+    while i < len(rest):
+        kind = rng.random()
+        if kind < 0.15:
+            # someone who isn't in the chain at all
+            i += 1
+        elif kind < 0.2 and i + 1 < len(rest):
+            # two users linking to each other, one of them also links into the chain
+            a, b = rest[i], rest[i + 1]
+            bio_links[a].append(b)
+            bio_links[b].extend([a, rng.choice(main)])
+            i += 2
+        else:
+            branch = rest[i:i + rng.randint(1, 5)]
+            for linker, linked in zip(branch, branch[1:]):
+                bio_links[linker].append(linked)
+            if rng.random() < 0.5:
+                target = rng.choice(hubs)
+            elif branch_nodes and rng.random() < 0.3:
+                target = rng.choice(branch_nodes)
+            else:
+                target = rng.choice(main)
+            bio_links[branch[-1]].append(target)
+            branch_nodes.extend(branch)
+            i += len(branch)
+
+    for user_id in ids[1:]:
+        roll = rng.random()
+        if roll < 0.05:
+            bio_links[user_id].append(rng.choice(ids))
+        elif roll < 0.1:
+            dead_links[user_id].add(rng.choice(ids))
+        elif roll < 0.13 and user_id not in main:
+            disabled.add(user_id)
+
+    data = {}
+    for user_id in ids:
+        user_data = {
+            'username': usernames[user_id],
+            'bio': [usernames[linked].upper() if rng.random() < 0.1 else usernames[linked]
+                    for linked in bio_links[user_id] if linked != user_id],
+            'joined': now - rng.randrange(10**7),
+            'expires': now + rng.randrange(-600, 3600),
+        }
+        if user_id in disabled:
+            user_data['disabled'] = True
+
+        links = []
+        for linked in bio_links[user_id]:
+            if linked == user_id:
+                continue
+            links.append(('!' if user_id in disabled or linked in disabled else '') + linked)
+        for linked in dead_links[user_id] - set(bio_links[user_id]) - {user_id}:
+            links.append('!' + linked)
+        if links:
+            user_data['links_to'] = links
+
+        data[user_id] = user_data
+
+    return data, ids[0]
+
+
+def best_time(func, repeat, setup=None):
+    """Returns the fastest of repeat runs of func in seconds, setup runs untimed before each one"""
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg) if setup else func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(user_count, seed, repeat, directory):
+    data, end_node = generate_db(user_count, seed)
+    filename = os.path.join(directory, f'db_{user_count}_{seed}.json')
+    with open(filename, 'w') as f:
+        json.dump(data, f)
+
+    def load():
+        db = Database(filename)
+        # the links have to be consistent with the bios for the chain to mean anything
+        db.update_links_from_bios()
+        db.matrix.pop_changed_links()
+        return db
+
+    timings = {}
+    timings['load'] = best_time(lambda: Database(filename), repeat)
+    db = load()
+    timings['save'] = best_time(lambda db: db.flush(force=True), repeat, lambda: db.dirty_users.update(db.users) or db)
+    timings['save_unchanged'] = best_time(lambda: db.flush(force=True), repeat)
+    timings['update_links_from_bios'] = best_time(db.update_links_from_bios, repeat)
+    timings['update_best_chain'] = best_time(lambda db: db.update_best_chain(end_node), repeat, load)
+
+    # a single bio change somewhere in the graph
+    rng = random.Random(seed)
+    user_ids = [user_id for user_id, user in db.users.items() if not user.disabled]
+    db.update_best_chain(end_node)
+
+    def change_bio():
+        user = db.users[rng.choice(user_ids)]
+        db.handle_changes(user.set_bio([db.users[rng.choice(user_ids)].username]))
+        return db
+
+    timings['update_best_chain_incremental'] = best_time(
+        lambda db: db.update_best_chain(end_node), repeat, change_bio
+    )
+    timings['get_branch_announcements'] = best_time(db.get_branch_announcements, repeat)
+    timings['stringify_chain'] = best_time(lambda: db.stringify_chain(db.best_chain), repeat)
+    timings['paginate_chain'] = best_time(lambda: db.paginate_chain(db.best_chain), repeat)
+    timings['get_next_expired'] = best_time(db.get_next_expired, repeat)
+
+    return {
+        'users': user_count,
+        'seed': seed,
+        'links': sum(len(user_data.get('links_to', [])) for user_data in data.values()),
+        'chain_length': len(db.best_chain),
+        'branches': len(db.chain_engine.heads) - 1,
+        'components': db.chain_engine.get_stats(),
+        'timings': timings,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the Database on generated chain graphs')
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='comma separated user counts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the fastest one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    parser.add_argument('--keep', help='directory to keep the generated db.json files in')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for user_count in [int(size) for size in args.sizes.split(',')]:
+            print(f'benchmarking {user_count} users...', file=sys.stderr)
+            # the Database prints progress that would mix with the JSON
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                results.append(run(user_count, args.seed, args.repeat, args.keep or directory))
+
+    report = json.dumps({
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': int(time.time()),
+        'results': results,
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import re
+import hashlib
+import threading
+from util import TME_URL, REQUEST_TIMEOUT
+from collections import OrderedDict
+from metrics import METRICS
+
+
+RE_SCRAPE_BIO_BYTES = re.compile(rb'<meta +property="og:description" +content="(.+?)"')
+
+
+class BioCache:
+    """
+    Remembers what the t.me page of every username looked like the last time it was fetched
+
+    Requests are conditional (ETag/Last-Modified) when the server gave us validators, and the
+    page is only read up to the og:description tag. A hash of the last description, along with the
+    user it was fetched for, lets the caller skip parsing when that user's page hasn't changed.
+    Safe to share between refresh worker threads.
+    """
+    def __init__(self, max_entries=100000, chunk_size=2048, base_url=TME_URL):
+        self.max_entries = max_entries
+        self.base_url = base_url
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bytes_read = 0
+        self.bytes_saved = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'bytes_read': self.bytes_read,
+                'bytes_saved': self.bytes_saved,
+            }
+
+    def _get_entry(self, username):
+        with self.lock:
+            entry = self.entries.get(username.lower())
+            if entry is not None:
+                self.entries.move_to_end(username.lower())
+            return entry
+
+    def _set_entry(self, username, entry):
+        with self.lock:
+            self.entries[username.lower()] = entry
+            self.entries.move_to_end(username.lower())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _read_description(self, r):
+        """Reads r until the og:description tag, returns (the description or None, bytes read)"""
+        data = b''
+        for chunk in r.iter_content(self.chunk_size):
+            data += chunk
+            match = RE_SCRAPE_BIO_BYTES.search(data)
+            if match:
+                return match.group(1).decode('utf-8', 'replace'), len(data)
+        return None, len(data)
+
+    def fetch(self, session, username, owner=None):
+        """
+        Fetches the og:description of username's t.me page for the user with ID owner
+        Returns a tuple: (the raw description or None if it couldn't be fetched,
+                          True if it's the same as the last time it was fetched for owner)
+        """
+        entry = self._get_entry(username)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        r = session.get(f'{self.base_url}/{username}', headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+        try:
+            if r.status_code == 304 and entry:
+                # usernames change hands, the page is only unchanged for whoever it was last fetched for
+                unchanged = entry['owner'] == owner
+                with self.lock:
+                    self.hits += 1
+                    self.not_modified += 1
+                    self.bytes_saved += entry['size']
+                    entry['owner'] = owner
+                return entry['description'], unchanged
+
+            if not r.ok:
+                print(f'  Request for bio failed ({r.status_code})')
+                METRICS.inc('biochain_http_errors_total', status=r.status_code)
+                return None, False
+
+            description, size = self._read_description(r)
+        finally:
+            r.close()
+
+        full_size = int(r.headers.get('Content-Length') or size)
+        with self.lock:
+            self.bytes_read += size
+            self.bytes_saved += max(full_size - size, 0)
+
+        if description is None:
+            print('  Failed to scrape bio tag')
+            return None, False
+
+        digest = hashlib.blake2b(description.encode(), digest_size=16).digest()
+        unchanged = entry is not None and entry['digest'] == digest and entry['owner'] == owner
+        with self.lock:
+            if unchanged:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        self._set_entry(username, {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'digest': digest,
+            'owner': owner,
+            'description': description,
+            'size': full_size,
+        })
+        return description, unchanged
+
+
+if __name__ == '__main__':
+    class Response:
+        def __init__(self, status_code, body=b'', headers=None):
+            self.status_code = status_code
+            self.ok = status_code < 400
+            self.body = body
+            self.headers = headers or {}
+            self.chunks_read = 0
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(self.body), chunk_size):
+                self.chunks_read += 1
+                yield self.body[i:i + chunk_size]
+
+        def close(self):
+            pass
+
+    class Session:
+        def __init__(self):
+            self.responses = []
+            self.requests = []
+
+        def get(self, url, headers=None, stream=False, timeout=None):
+            self.requests.append((url, headers))
+            return self.responses.pop(0)
+
+    page = b'<head>' + b'x' * 5000 + b'<meta property="og:description" content="hi @someone">' + b'y' * 50000
+    session = Session()
+    cache = BioCache()
+
+    session.responses.append(Response(200, page, {'ETag': '"1"', 'Content-Length': str(len(page))}))
+    assert cache.fetch(session, 'Tester', 1) == ('hi @someone', False)
+    assert cache.stats()['bytes_read'] < 10000
+    assert cache.stats()['bytes_saved'] > 40000
+
+    # the same description again skips parsing
+    session.responses.append(Response(200, page))
+    assert cache.fetch(session, 'tester', 1) == ('hi @someone', True)
+    assert session.requests[-1][1] == {'If-None-Match': '"1"'}
+
+    session.responses.append(Response(304))
+    assert cache.fetch(session, 'tester', 1) == ('hi @someone', True)
+
+    session.responses.append(Response(200, page.replace(b'someone', b'someone_else')))
+    assert cache.fetch(session, 'tester', 1) == ('hi @someone_else', False)
+
+    session.responses.append(Response(404))
+    assert cache.fetch(session, 'tester', 1) == (None, False)
+
+    # the username went to someone else, whose bio is the same page but hasn't been parsed yet
+    session.responses.append(Response(304))
+    assert cache.fetch(session, 'tester', 2) == ('hi @someone_else', False)
+    session.responses.append(Response(304))
+    assert cache.fetch(session, 'tester', 2) == ('hi @someone_else', True)
+    session.responses.append(Response(200, page.replace(b'someone', b'someone_else')))
+    assert cache.fetch(session, 'tester', 1) == ('hi @someone_else', False)
+
+    assert cache.stats()['hits'] == 4
+    assert cache.stats()['misses'] == 3
+    assert cache.stats()['not_modified'] == 3
+
+    print('ok')
@@ -1,63 +1,129 @@
 import os
+import json
+import asyncio
 import traceback
-import datetime
 from telegram.ext import Updater, MessageHandler, Filters
 from signal import signal, SIGINT, SIGTERM, SIGABRT
 import logging
 
 from database import Database
+import storage
+import file_string
+from refresh import RefreshPool, PendingChanges
+from process_refresh import ProcessRefreshPool
+from membership import MembershipCache
+from outbox import Outbox
+from metrics import METRICS
+from async_runtime import AsyncRuntime
+from recorder import Recorder
+from groups import Groups, GroupRefreshPool
+from query_api import QueryServer
 import commands
 from util import *
 
 
-DATABASE_FILENAME = 'db.json'
+DATABASE_FILENAME = os.environ.get('tg_bot_biochain_db', 'db.json')
+LEGACY_DATABASE_FILENAME = 'db.json'
 END_NODE = '51863899'
 LAST_CHAIN = FileString('last_chain.txt')
+CHAIN_PAGES = FileString('chain_pages.json', delay=SAVE_DELAY)
+REFRESH_CONCURRENCY = int(os.environ.get('tg_bot_biochain_refresh_workers', 8))
+# worker processes to fetch and parse in instead of threads, 0 to use threads
+REFRESH_PROCESSES = int(os.environ.get('tg_bot_biochain_refresh_processes', 0))
+# how long to keep sending queued messages on shutdown (seconds)
+OUTBOX_DRAIN_TIMEOUT = 30
+# local port for Prometheus to scrape, off (0) unless it is set, and a file to dump the same text to every minute
+METRICS_PORT = int(os.environ.get('tg_bot_biochain_metrics_port', 0))
+METRICS_FILENAME = os.environ.get('tg_bot_biochain_metrics_file')
+METRICS_DUMP_INTERVAL = 60
+# local port for the read-only JSON chain queries of query_api.py, off (0) unless it is set
+QUERY_PORT = int(os.environ.get('tg_bot_biochain_query_port', 0))
+# file to record incoming updates, getChatMember results and bio pages to for replay.py, empty to not record
+TRACE_FILENAME = os.environ.get('tg_bot_biochain_trace')
+# 'asyncio' wakes up only when a user is due, a fetch finishes or a user is marked for updating,
+# 'threads' polls every second
+RUNTIME = os.environ.get('tg_bot_biochain_runtime', 'threads')
+# JSON file listing several groups to host in this process instead of just CHAT_ID, see get_groups()
+GROUPS_FILENAME = os.environ.get('tg_bot_biochain_groups')
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def update_chain(bot, chain_text):
-    """
-    Tries to post chain_text (editing the last message if possible)
-    Returns True if chain_text was sent, False if not
-    """
-    if chain_text == LAST_CHAIN.get():
-        return False
+def get_chain_pages(pages_file=CHAIN_PAGES, last_pin=LAST_PIN, last_chain=LAST_CHAIN):
+    """Returns the posted pages of the chain as a list of [message ID, text], the end of the chain first"""
+    if pages_file.get():
+        return json.loads(pages_file.get())
+    if last_pin.get() and last_chain.get():
+        # posted before the chain was split into pages
+        return [[int(last_pin.get()), last_chain.get()]]
+    return []
 
-    if len(chain_text) >= 3000:
-        send_message(bot, '@KateWasTaken Warning: The chain is approaching message character limit ({:.1%})'.format(
-            len(chain_text) / 4096
-        ))
 
-    try:
-        # try to edit our last pinned message
+def send_chain_page(bot, text, chat_id=CHAT_ID):
+    """Sends a placeholder, edits it to text to prevent notifications and pins it, returns the message"""
+    message = send_message(bot, 'the game', chat_id)
+    if message:
         bot.editMessageText(
-            chat_id=CHAT_ID,
-            message_id=LAST_PIN.get(),
-            text=chain_text
+            chat_id=chat_id,
+            message_id=message.message_id,
+            text=text
+        )
+        bot.pinChatMessage(
+            chat_id=chat_id,
+            message_id=message.message_id,
+            disable_notification=True
         )
-    except:
-        # can't edit? send a placeholder and then edit it to prevent notifications
-        message = send_message(bot, 'the game')
-        if message:
+    return message
+
+
+def update_chain(bot, chain_pages, pages_file=CHAIN_PAGES, last_pin=LAST_PIN, last_chain=LAST_CHAIN, chat_id=CHAT_ID):
+    """
+    Tries to post chain_pages (a list of texts, head first), editing only the pages whose text changed
+    Returns how many pages were edited or sent
+    """
+    pages = get_chain_pages(pages_file, last_pin, last_chain)
+    updated = 0
+
+    # pages are matched up from the end of the chain, which changes the least
+    for i, text in enumerate(reversed(chain_pages)):
+        if i < len(pages) and pages[i][1] == text:
+            continue
+
+        try:
+            # try to edit our old page
             bot.editMessageText(
-                chat_id=CHAT_ID,
-                message_id=message.message_id,
-                text=chain_text
-            )
-            bot.pinChatMessage(
-                chat_id=CHAT_ID,
-                message_id=message.message_id,
-                disable_notification=True
+                chat_id=chat_id,
+                message_id=pages[i][0],
+                text=text
             )
+            pages[i][1] = text
+        except:
+            # can't edit? post a new page
+            message = send_chain_page(bot, text, chat_id)
+            if not message:
+                continue
+            if i < len(pages):
+                pages[i] = [message.message_id, text]
+            else:
+                pages.append([message.message_id, text])
 
-            LAST_PIN.set(message.message_id)
+        updated += 1
+        pages_file.set(json.dumps(pages))
 
-    LAST_CHAIN.set(chain_text)
+    # the chain got shorter, remove the pages that aren't needed anymore
+    while len(pages) > len(chain_pages):
+        message_id, _ = pages.pop()
+        try:
+            bot.deleteMessage(chat_id=chat_id, message_id=message_id)
+        except:
+            print('Failed to delete chain page', message_id)
+        pages_file.set(json.dumps(pages))
 
-    return True
+    if pages:
+        last_pin.set(pages[-1][0])
+
+    return updated
 
 
 def send_message(bot, text, chat_id=CHAT_ID, *args, **kwargs):
@@ -80,9 +146,9 @@ def send_message_pre(bot, text, chat_id=CHAT_ID):
     return send_message(bot, '<pre>{}</pre>'.format(html_escape(text)), chat_id)
 
 
-def get_update_users(update):
+def get_update_users(update, chat_id=CHAT_ID):
     """Yields the new user IDs and usernames associated with an update in the chat"""
-    if update.message and update.message.chat.id == CHAT_ID:
+    if update.message and update.message.chat.id == chat_id:
         for user in update.message.new_chat_members:
             if not user.is_bot:
                 yield str(user.id), user.username or ''
@@ -91,51 +157,71 @@ def get_update_users(update):
             yield str(user.id), user.username or ''
 
 
-def handle_update_command(db, update):
-    if not update.message:
-        return False
-
-    message = update.message
-
-    if message.forward_from or not message.text or not message.text.startswith('/'):
-        return False
-
-    command_split = message.text[1:].split(' ', 1)
-    command_args = command_split[1:] or ''
-
-    directed = False
-    command = command_split[0].lower().split('@')
-    if command[1:]:
-        # the command was directed to a bot
-        directed = True
-    command.append(message.bot.username)
-    if command[1] != message.bot.username:
-        # this command is not for us
-        return False
-
-    try:
-        getattr(commands, 'cmd_' + command[0])(db, update, directed, command_args)
-    except AttributeError:
-        if directed:
-            print('got unknown command:', message.text)
-
-    return True
-
-
 def on_error(bot, update, error):
     send_message_pre(bot, error + '\n\n' + update, 232787997)
     logger.warning('Update "%s" caused error "%s"', update, error)
 
 
-def main():
-    def on_signal(signum, frame):
-        if updater.running:
-            updater.stop()
-        else:
-            exit(1)
-
+class ChainBot:
+    """
+    Everything the bot does for one chat besides talking to Telegram: the update handlers and
+    the steps of the main loop, so main(), groups.py and replay.py can drive the same code
+    """
+    def __init__(self, db, outbox, membership, end_node=END_NODE,
+                 pages_file=CHAIN_PAGES, last_pin=LAST_PIN, last_chain=LAST_CHAIN, chat_id=CHAT_ID,
+                 query_server=None):
+        self.chat_id = chat_id
+        # a QueryServer to give every new best chain to, or None
+        self.query_server = query_server
+        self.db = db
+        self.outbox = outbox
+        self.membership = membership
+        self.end_node = end_node
+        self.pages_file = pages_file
+        self.last_pin = last_pin
+        self.last_chain = last_chain
+        # set by the runtime to a function that calls a handler on the thread that owns the Database,
+        # the handlers that change the Database run on the dispatcher thread while it's None
+        self.run_handler = None
+
+    def add_handlers(self, dispatcher):
+        dispatcher.add_handler(
+            MessageHandler(Filters.chat(self.chat_id), self._owned(self.on_chat_update)), group=-1
+        )
+        dispatcher.add_handler(
+            MessageHandler(Filters.chat(self.chat_id) & Filters.command & (~Filters.forwarded), self.on_command)
+        )
+        dispatcher.add_handler(
+            MessageHandler(Filters.status_update.new_chat_members, self._owned(self.on_new_members))
+        )
+        dispatcher.add_handler(
+            MessageHandler(Filters.status_update.left_chat_member, self._owned(self.on_left_member))
+        )
 
-    def on_command(bot, update):
+    def _owned(self, handler):
+        """Wraps a handler that changes the Database so that it goes through run_handler"""
+        def run(bot, update):
+            if self.run_handler is None:
+                handler(bot, update)
+            else:
+                self.run_handler(handler, bot, update)
+        return run
+
+    def handle_update(self, bot, update):
+        """Routes update to the handlers the same way add_handlers() does, for updates that don't come from an Updater"""
+        message = update.message
+        if not message:
+            return
+        if message.chat.id == self.chat_id:
+            self.on_chat_update(bot, update)
+            if message.text and message.text.startswith('/') and not message.forward_date:
+                self.on_command(bot, update)
+        if message.new_chat_members:
+            self.on_new_members(bot, update)
+        if message.left_chat_member:
+            self.on_left_member(bot, update)
+
+    def on_command(self, bot, update):
         message = update.message
 
         command_split = message.text[1:].split(' ', 1)
@@ -149,104 +235,311 @@ def main():
             return
 
         try:
-            getattr(commands, 'cmd_' + command[0].lower())(db, update, directed, command_args)
+            getattr(commands, 'cmd_' + command[0].lower())(self, update, directed, command_args)
         except AttributeError:
             if directed:
                 print('got unknown command:', message.text)
 
-
-    def on_new_members(bot, update):
+    def on_new_members(self, bot, update):
         for user in update.message.new_chat_members:
             if user.is_bot:
                 continue
-            if not db.add_user(str(user.id), user.username or ''):
+            if not self.db.add_user(str(user.id), user.username or ''):
                 continue
-            if (datetime.datetime.now() - update.message.date).total_seconds() > 60:
+            if get_current_timestamp() - update.message.date.timestamp() > 60:
                 continue
 
-            send_message(
-                bot, 
+            self.outbox.call(
+                send_message,
                 (
                     'Welcome, {}!\n'
-                    '<a href="https://t.me/GBReborn_bot?start=-1001145055784_rules">Read the rules</a>\n\n'
+                    '<a href="https://t.me/GBReborn_bot?start={}_rules">Read the rules</a>\n\n'
                     'Who did you start at?\n\n'
                     '(to join the chain, simply add <code>{}</code> to your bio)'
                 ).format(
                     get_html_mention(user.id, user.username or user.first_name),
-                    db.users[db.get_head_user_id()]
+                    self.chat_id,
+                    self.db.users[self.db.get_head_user_id()]
                 ),
+                self.chat_id,
                 reply_to_message_id=update.message.message_id
             )
 
+    def on_left_member(self, bot, update):
+        left_user = update.message.left_chat_member
+        left_id = str(left_user.id)
+        self.membership.observe(left_id, left_user.username or '', left=True)
+        if left_id in self.db.users:
+            self.db.users[left_id].username_fetch_failed = True
+
+    def on_chat_update(self, bot, update):
+        # keep the membership cache fresh, and refresh users whose username changed right away
+        for user_id, username in get_update_users(update, self.chat_id):
+            self.membership.observe(user_id, username)
+            user = self.db.users.get(user_id)
+            if user and not user.disabled and user.username != username:
+                user.expires = 0
+
+    def on_tick(self):
+        """Writes whatever has waited long enough and updates the gauges"""
+        self.db.flush()
+        file_string.flush_all()
+
+        self.db.report_metrics()
+        METRICS.set('biochain_outbox_pending', self.outbox.pending())
+        self.build_queried_index()
+
+    def get_flush_delay(self):
+        delays = [delay for delay in (self.db.get_flush_delay(), file_string.get_flush_delay()) if delay is not None]
+        return min(delays, default=None)
+
+    def publish(self):
+        """Gives the query API an index of the current best chain"""
+        if self.query_server is not None:
+            self.query_server.publish(self.chat_id, self.db)
+
+    def build_queried_index(self):
+        """Builds the query API's index if the best chain changed since the last one and a query is waiting for it"""
+        if self.query_server is not None:
+            self.query_server.build_wanted()
+
+    def process_changes(self, pending_changes):
+        """Rebuilds the best chain and posts everything pending_changes calls for, once no user is overdue"""
+        db = self.db
+        try:
+            # rebuild the best chain
+            last_head = db.get_head_user_id()
+            db.update_best_chain(self.end_node)
+            if self.query_server is not None:
+                self.query_server.invalidate(self.chat_id, db)
+
+            shouts = []
+            if db.best_chain_changed:
+                # post the best chain if it's different to the old one, replacing any chain edit still queued
+                self.outbox.call(
+                    update_chain, db.paginate_chain(db.best_chain), self.pages_file, self.last_pin, self.last_chain,
+                    self.chat_id, key=('chain', self.chat_id)
+                )
+
+                # shout at branches if the head has changed
+                if db.get_head_user_id() != last_head:
+                    shouts.append(db.get_branch_announcements())
+
+            # shout at users whose data has changed, in as few messages as possible
+            with METRICS.time('biochain_phase_seconds', phase='shouts'):
+                for pending_change in pending_changes:
+                    shouts.append(pending_change.shout(db))
+                self.outbox.shout(shouts, send_message, self.chat_id)
+            pending_changes.clear()
 
-    def on_left_member(bot, update):
-        left_id = str(update.message.left_chat_member.id)
-        if left_id in db.users:
-            db.users[left_id].username_fetch_failed = True
+            # disable users who we failed to fetch a username for and aren't in the chain
+            for user_id in db.users:
+                if not db.users[user_id].username_fetch_failed:
+                    continue
+                print('rechecking', db.users[user_id].str_with_id())
+                if user_id not in db.best_chain:
+                    db.disable_user(user_id)
 
+            # Get rid of old non-existent links if the chain passes through only real links
+            if db.best_chain_is_valid:
+                print('Purged {} dead links'.format(db.clear_dead_links()))
+            self.membership.prune()
+            db.save()
+        except Exception as e:
+            #raise e
+            print('Encountered exception while running main loop:', type(e))
+            self.outbox.call(send_message_pre, traceback.format_exc(), 232787997)
 
-    db = Database(DATABASE_FILENAME)
-    db.update_best_chain(END_NODE)
 
-    updater = Updater(os.environ['tg_bot_biochain_token'])
+def get_groups(filename, outbox):
+    """
+    Returns a ChainBot for every group in filename, a JSON list like
+    [{"chat_id": -1001145055784, "end_node": "51863899", "directory": "groups/main"}, ...]
+    Each group keeps its database ("db", db.json by default) and its pin files in its own directory.
+    """
+    with open(filename) as f:
+        config = json.load(f)
+
+    chain_bots = []
+    for group in config:
+        directory = group['directory']
+        os.makedirs(directory, exist_ok=True)
+        db = Database(os.path.join(directory, group.get('db', 'db.json')))
+        db.update_best_chain(group['end_node'], rebuild_links=True)
+        chain_bots.append(ChainBot(
+            db, outbox, MembershipCache(), group['end_node'],
+            FileString(os.path.join(directory, 'chain_pages.json'), delay=SAVE_DELAY),
+            FileString(os.path.join(directory, 'last_pin.txt')),
+            FileString(os.path.join(directory, 'last_chain.txt')),
+            chat_id=group['chat_id'],
+        ))
+    return chain_bots
+
+
+def main_groups():
+    """
+    Hosts every group in GROUPS_FILENAME with one Updater, one Outbox and one GroupRefreshPool,
+    so users in several groups are fetched once. Runs the threads runtime.
+    """
+    def on_signal(signum, frame):
+        # the main loop stops the updater and sends what's still queued, a second signal exits right away
+        if stopping[0]:
+            exit(1)
+        stopping[0] = True
+
+    stopping = [False]
+
+
+    updater = Updater(os.environ['tg_bot_biochain_token'], base_url=BOT_API_URL)
     bot = updater.bot
-    updater.dispatcher.add_handler(
-        MessageHandler(Filters.chat(CHAT_ID) & Filters.command & (~Filters.forwarded), on_command)
-    )
-    updater.dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, on_new_members))
-    updater.dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, on_left_member))
+    outbox = Outbox(bot)
+    groups = Groups(get_groups(GROUPS_FILENAME, outbox))
+    print(f'Hosting {len(groups)} groups')
+    if QUERY_PORT:
+        query_server = QueryServer()
+        query_server.serve(QUERY_PORT)
+        for chain_bot in groups:
+            chain_bot.query_server = query_server
+            chain_bot.publish()
+
+    groups.add_handlers(updater.dispatcher)
     updater.dispatcher.add_error_handler(on_error)
     updater.start_polling()
 
     for sig in (SIGINT, SIGTERM, SIGABRT):
         signal(sig, on_signal)
 
-    pending_changes = []
-    while updater.running:
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+    last_metrics_dump = 0
+
+    refresh_pool = GroupRefreshPool(bot, groups, REFRESH_CONCURRENCY)
+    while updater.running and not stopping[0]:
         try:
-            # try to update the user who expires next
-            changes, user_was_updated = db.update_first_expired(bot)
+            with METRICS.time('biochain_phase_seconds', phase='refresh'):
+                user_was_updated = groups.refresh(refresh_pool)
             if not user_was_updated:
                 time.sleep(1)
 
-            pending_changes.extend(changes)
+            groups.on_tick()
+            if METRICS_FILENAME and time.time() - last_metrics_dump >= METRICS_DUMP_INTERVAL:
+                METRICS.dump(METRICS_FILENAME)
+                last_metrics_dump = time.time()
+        except Exception as e:
+            print('Encountered exception while running main loop:', type(e))
+            METRICS.inc('biochain_main_loop_errors_total')
+            outbox.call(send_message_pre, traceback.format_exc(), 232787997)
+            continue
 
-            if db.get_expired_count() > 0 or not pending_changes:
-                continue
+        groups.process_changes(refresh_pool)
 
-            # rebuild the best chain
-            last_head = db.get_head_user_id()
-            db.update_best_chain(END_NODE)
+    updater.stop()
+    refresh_pool.shutdown()
+    outbox.close(OUTBOX_DRAIN_TIMEOUT)
+    groups.flush()
 
-            # post the best chain if it's different to the old one
-            update_chain(bot, db.stringify_chain(db.best_chain))
 
-            # shout at branches if the head has changed
-            if db.get_head_user_id() != last_head:
-                send_message(bot, db.get_branch_announcements())
+def main():
+    def on_signal(signum, frame):
+        # the main loop stops the updater and sends what's still queued, a second signal exits right away
+        if stopping[0]:
+            exit(1)
+        stopping[0] = True
+        if runtime:
+            runtime.stop()
 
-            # shout at users whose data has changed
-            for pending_change in pending_changes:
-                send_message(bot, pending_change.shout(db))
-            pending_changes.clear()
+    stopping = [False]
 
-            # disable users who we failed to fetch a username for and aren't in the chain
-            for user_id in db.users:
-                if not db.users[user_id].username_fetch_failed:
-                    continue
-                print('rechecking', db.users[user_id].str_with_id())
-                if user_id not in db.best_chain:
-                    db.disable_user(user_id)
 
-            # Get rid of old non-existent links if the chain passes through only real links
-            if db.best_chain_is_valid:
-                print('Purged {} dead links'.format(db.clear_dead_links()))
-            db.save()
-        except Exception as e:
-            #raise e
-            print('Encountered exception while running main loop:', type(e))
-            send_message_pre(bot, traceback.format_exc(), 232787997)
+    if storage.is_sqlite_filename(DATABASE_FILENAME) and os.path.exists(LEGACY_DATABASE_FILENAME):
+        storage.migrate_json_to_sqlite(LEGACY_DATABASE_FILENAME, DATABASE_FILENAME)
+    db = Database(DATABASE_FILENAME)
+    db.update_best_chain(END_NODE, rebuild_links=True)
+    membership = MembershipCache()
+
+    updater = Updater(os.environ['tg_bot_biochain_token'], base_url=BOT_API_URL)
+    bot = updater.bot
+    outbox = Outbox(bot)
+    chain_bot = ChainBot(db, outbox, membership)
+    if QUERY_PORT:
+        chain_bot.query_server = QueryServer()
+        chain_bot.query_server.serve(QUERY_PORT)
+        chain_bot.publish()
+
+    recorder = None
+    if TRACE_FILENAME:
+        recorder = Recorder(TRACE_FILENAME, db, END_NODE, bot.username)
+        updater.dispatcher.add_handler(MessageHandler(Filters.all, recorder.on_update), group=-2)
+    chain_bot.add_handlers(updater.dispatcher)
+    updater.dispatcher.add_error_handler(on_error)
+    updater.start_polling()
+
+    runtime = None
+    for sig in (SIGINT, SIGTERM, SIGABRT):
+        signal(sig, on_signal)
+
+
+    def on_tick():
+        chain_bot.on_tick()
+        if METRICS_FILENAME and time.time() - last_metrics_dump[0] >= METRICS_DUMP_INTERVAL:
+            METRICS.dump(METRICS_FILENAME)
+            last_metrics_dump[0] = time.time()
+        if recorder:
+            recorder.flush()
+
+
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+    last_metrics_dump = [0]
+
+    if REFRESH_PROCESSES:
+        refresh_pool = ProcessRefreshPool(os.environ['tg_bot_biochain_token'], REFRESH_PROCESSES, membership=membership)
+    else:
+        refresh_pool = RefreshPool(recorder.wrap_bot(bot) if recorder else bot, REFRESH_CONCURRENCY, membership=membership)
+        if recorder:
+            refresh_pool.session = recorder.wrap_session(refresh_pool.session)
+    if RUNTIME == 'asyncio':
+        runtime = AsyncRuntime(
+            db, refresh_pool, chain_bot.process_changes, on_tick, chain_bot.get_flush_delay,
+            lambda text: outbox.call(send_message_pre, text, 232787997),
+        )
+        chain_bot.run_handler = runtime.call
+        if chain_bot.query_server is not None:
+            chain_bot.query_server.on_wanted = runtime.wakeup
+        if stopping[0]:
+            runtime.stop()
+        asyncio.run(runtime.run())
+    else:
+        pending_changes = PendingChanges()
+        while updater.running and not stopping[0]:
+            try:
+                # update the users who have expired, a few at a time
+                with METRICS.time('biochain_phase_seconds', phase='refresh'):
+                    changes, user_was_updated = refresh_pool.refresh(db)
+                if not user_was_updated:
+                    time.sleep(1)
+
+                pending_changes.extend(changes, db, refresh_pool.in_flight_ids)
+                on_tick()
+            except Exception as e:
+                print('Encountered exception while running main loop:', type(e))
+                METRICS.inc('biochain_main_loop_errors_total')
+                outbox.call(send_message_pre, traceback.format_exc(), 232787997)
+                continue
+
+            if pending_changes.is_ready(db, refresh_pool.in_flight_ids):
+                chain_bot.process_changes(pending_changes.take())
 
+    updater.stop()
+    refresh_pool.shutdown()
+    outbox.close(OUTBOX_DRAIN_TIMEOUT)
+    db.flush(force=True)
+    file_string.flush_all(force=True)
+    if recorder:
+        recorder.close()
 
 if __name__ == '__main__':
-    main()
+    if GROUPS_FILENAME:
+        main_groups()
+    else:
+        main()
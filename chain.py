@@ -0,0 +1,739 @@
+import heapq
+from matrix import State
+from components import ComponentIndex
+
+
+class TreeIndex:
+    """
+    The best chains from a set of heads share their ends, put together they form a tree rooted at the end node
+
+    Heads are walked in order and a chain is only followed up to the first node an earlier one
+    already went through, so where two chains go on differently from the same node the first one
+    is kept. Nodes are numbered and every node gets its depth (links to the end node) and a table of
+    its 2**k-th successors, so merge points are found in O(log n) without walking whole chains.
+    """
+    def __init__(self, heads, iter_chain):
+        self.nodes = []
+        self.index = {}
+        parent = []
+        self.depth = []
+
+        for head in heads:
+            path = []
+            node = None
+            for node in iter_chain(head):
+                if node in self.index:
+                    break
+                path.append(node)
+            else:
+                node = None
+
+            parent_i = self.index[node] if node is not None else -1
+            depth = self.depth[parent_i] if node is not None else -1
+            for node in reversed(path):
+                depth += 1
+                self.index[node] = len(self.nodes)
+                self.nodes.append(node)
+                self.depth.append(depth)
+                parent.append(parent_i)
+                parent_i = self.index[node]
+
+        # up[k][i] is the index of the 2**k-th successor of node i, or -1 past the end
+        self.up = [parent]
+        for _ in range(max(self.depth, default=0).bit_length() - 1):
+            last = self.up[-1]
+            self.up.append([last[i] if i != -1 else -1 for i in last])
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def get_next(self, node):
+        i = self.up[0][self.index[node]]
+        return self.nodes[i] if i != -1 else None
+
+    def get_depth(self, node):
+        return self.depth[self.index[node]]
+
+    def _get_ancestor_i(self, i, distance):
+        k = 0
+        while distance and i != -1:
+            if distance & 1:
+                i = self.up[k][i]
+            distance >>= 1
+            k += 1
+        return i
+
+    def get_ancestor(self, node, distance):
+        """Returns the node distance links further down node's chain, or None if the chain ends before"""
+        i = self._get_ancestor_i(self.index[node], distance)
+        return self.nodes[i] if i != -1 else None
+
+    def get_merge_point(self, node1, node2):
+        """Returns the first node the chains starting at node1 and node2 have in common, or None"""
+        i1, i2 = self.index[node1], self.index[node2]
+        if self.depth[i1] > self.depth[i2]:
+            i1 = self._get_ancestor_i(i1, self.depth[i1] - self.depth[i2])
+        else:
+            i2 = self._get_ancestor_i(i2, self.depth[i2] - self.depth[i1])
+        if i1 == i2:
+            return self.nodes[i1]
+
+        for k in range(len(self.up) - 1, -1, -1):
+            if self.up[k][i1] != self.up[k][i2]:
+                i1, i2 = self.up[k][i1], self.up[k][i2]
+        i1 = self.up[0][i1]
+        return self.nodes[i1] if i1 != -1 else None
+
+    def get_merger(self, node, chain_head):
+        """
+        Returns the last node of node's chain before it merges into chain_head's chain,
+        or None if node is in chain_head's chain
+        """
+        merge_point = self.get_merge_point(node, chain_head)
+        if merge_point == node or merge_point is None:
+            return None
+        return self.get_ancestor(node, self.get_depth(node) - self.get_depth(merge_point) - 1)
+
+
+class ChainEngine:
+    """
+    Finds the best chain ending on a node without enumerating every path
+
+    Every node that can reach the end node gets a memoized score (REAL links, DEAD links)
+    for the best chain starting at it, and the way that chain goes on. Chains are compared the
+    same way get_chains_ending_on() results used to be: most REAL links, then fewest DEAD links,
+    then the earliest joined user at the merge point. Like those results, the best chain starts
+    at a head: a node whose linkers are all in its chain, so it can't be extended backwards.
+
+    The scores are kept between calls to find(), so after the first call only the nodes that
+    can reach a changed node have to be looked at again.
+
+    Nodes that can't reach the end node are never looked at. The rest are settled one strongly
+    connected component at a time, from the end node's backwards, so cycles only have to be
+    dealt with inside a component: small ones are searched exhaustively, bigger ones fall back
+    to a depth-first search that skips links back onto its stack.
+    """
+    # components with more nodes than this aren't searched exhaustively
+    exact_component_size = 8
+    # simple paths an exhaustive search may walk from a member before falling back
+    exact_search_steps = 20000
+
+    def __init__(self, matrix, get_joined):
+        self.matrix = matrix
+        self.get_joined = get_joined
+        self.components = ComponentIndex(matrix)
+
+        self.end_node = None
+        self.score = {}
+        self.length = {}
+        self.next = {}
+        # node -> the nodes after it in its best chain up to the first one outside its component,
+        # for members of cyclic components whose chains go through each other in different orders
+        self.segment = {}
+        # head -> (score, length, segment or None) of the best chain that starts at it and can't be extended backwards
+        self.heads = {}
+        self.best_head = None
+        self._tree = None
+        # heap of (-REAL links, DEAD links, head), entries are checked against self.heads when used
+        self._head_heap = []
+
+    def _edge_score(self, linker, linked):
+        state = self.matrix.get_link_to(linker, linked)
+        return (1, 0) if state is State.REAL else (0, 1)
+
+    def _get_linkers(self, nodes):
+        """
+        Returns nodes and every node that can reach one of them by walking links_from,
+        skipping nodes that can't reach the end node and weren't settled before
+        """
+        reaching = self.components.reaching
+        found = {node for node in nodes if node in reaching or node in self.score}
+        pending = list(found)
+        while pending:
+            linked = pending.pop()
+            for linker in self.matrix.get_links_from(linked):
+                if linker not in found and (linker in reaching or linker in self.score):
+                    found.add(linker)
+                    pending.append(linker)
+        return found
+
+    def _walk(self, node, segment=None):
+        """
+        Yields (node, key) for every node of the best chain starting at node, going through segment first if it's given
+        Two walks that get to the same key go on the same way from there
+        """
+        key = node if segment is None else (segment, 0)
+        while node is not None:
+            yield node, key
+            if segment is None:
+                segment = self.segment.get(node)
+            if segment is None:
+                node = key = self.next[node]
+                continue
+            for i, node in enumerate(segment[:-1], 1):
+                yield node, (segment, i)
+            node = key = segment[-1]
+            segment = None
+
+    def iter_chain(self, node, segment=None):
+        """Yields the nodes of the best chain starting at node, going through segment first if it's given"""
+        for node, key in self._walk(node, segment):
+            yield node
+
+    def get_chain(self, node):
+        return list(self.iter_chain(node))
+
+    def iter_head_chain(self, node):
+        """Yields the nodes of the chain starting at node, the one that makes it a head if it is one"""
+        head = self.heads.get(node)
+        return self.iter_chain(node, head[2] if head is not None else None)
+
+    def _before_merge(self, chain1, chain2):
+        """
+        Same as LinkMatrix.chain_get_merge_points() but returns the nodes instead of indices,
+        walking both chains from their heads instead of materializing them
+        """
+        walk1 = self._walk(chain1[2], chain1[3])
+        walk2 = self._walk(chain2[2], chain2[3])
+        skipped1 = skipped2 = None
+
+        # line both chains up with each other from the tail
+        for _ in range(chain1[1] - chain2[1]):
+            skipped1 = next(walk1)[0]
+        for _ in range(chain2[1] - chain1[1]):
+            skipped2 = next(walk2)[0]
+
+        # the last nodes that differ before both walks go on the same way
+        before = None
+        for (node1, key1), (node2, key2) in zip(walk1, walk2):
+            if key1 == key2:
+                break
+            if node1 != node2:
+                before = node1, node2
+        if before is not None:
+            return before
+        return (skipped1 if skipped1 is not None else chain1[2],
+                skipped2 if skipped2 is not None else chain2[2])
+
+    def _is_better(self, chain1, chain2):
+        """
+        Returns True if the first chain should be picked over the second
+        Chains are (score, length, first node, segment or None to follow the first node's own chain)
+        """
+        if chain1[0] != chain2[0]:
+            return chain1[0] > chain2[0]
+
+        before1, before2 = self._before_merge(chain1, chain2)
+        return (self.get_joined(before1) or 0) < (self.get_joined(before2) or 0)
+
+    def _set_chain(self, node, chain):
+        """Makes chain, as _is_better() takes them, the best chain starting at node"""
+        if chain is None:
+            self.score[node] = None
+            self.next[node] = None
+            self.length[node] = 0
+            return
+
+        score, length, node, segment = chain
+        self.score[node] = score
+        self.length[node] = length
+        self.next[node] = segment[0]
+        if len(segment) > 1:
+            self.segment[node] = segment
+
+    def _settle(self, node, on_stack):
+        """Picks the best next node for node, all of its candidates must be settled already"""
+        best = None
+        blocked = False
+        for linked in self.matrix.get_links_to(node):
+            if linked in on_stack or (linked not in self.score and linked in self.components.reaching):
+                blocked = True
+                continue
+            if self.score.get(linked) is None:
+                continue
+
+            real, dead = self._edge_score(node, linked)
+            linked_score = self.score[linked]
+            chain = ((linked_score[0] + real, linked_score[1] - dead), self.length[linked] + 1, node, (linked,))
+            if best is None or self._is_better(chain, best):
+                best = chain
+
+        if best is None and blocked:
+            # only a cycle back onto the stack or a node it blocked was in the way, try again later
+            return
+
+        self._set_chain(node, best)
+
+    def _compute(self, root, finished):
+        """
+        Settles root and everything it links to that isn't settled or finished, iteratively to survive long chains
+        Nodes that only had links back onto the stack are left unsettled but still added to finished
+        """
+        stack = [(root, self.matrix.get_links_to(root))]
+        on_stack = {root}
+        while stack:
+            node, links = stack[-1]
+            for linked in links:
+                if linked in on_stack or linked in finished or linked in self.score or linked not in self.components.reaching:
+                    continue
+                stack.append((linked, self.matrix.get_links_to(linked)))
+                on_stack.add(linked)
+                break
+            else:
+                stack.pop()
+                on_stack.remove(node)
+                finished.add(node)
+                self._settle(node, on_stack)
+
+    def _settle_backwards(self, members):
+        """Settles the members _compute() left unsettled, each from the ones settled before it"""
+        pending = [member for member in members if member in self.score]
+        for linked in pending:
+            for linker in self.matrix.get_links_from(linked):
+                if linker in members and linker not in self.score:
+                    self._settle(linker, ())
+                    pending.append(linker)
+
+    def _get_paths(self, node, members):
+        """
+        Yields (score, path) for every simple path from node through members to a settled node outside of them
+        Stops with a RuntimeError after exact_search_steps paths
+        """
+        steps = 0
+        stack = [(node, (0, 0), [node])]
+        while stack:
+            node, score, path = stack.pop()
+            for linked in self.matrix.get_links_to(node):
+                steps += 1
+                if steps > self.exact_search_steps:
+                    raise RuntimeError('Too many paths')
+                real, dead = self._edge_score(node, linked)
+                this_score = (score[0] + real, score[1] - dead)
+                if linked in members:
+                    if linked not in path:
+                        stack.append((linked, this_score, path + [linked]))
+                elif self.score.get(linked) is not None:
+                    linked_score = self.score[linked]
+                    yield (this_score[0] + linked_score[0], this_score[1] + linked_score[1]), path + [linked]
+
+    def _get_head_linkers(self, node, members):
+        """
+        Returns the linkers a chain starting at node has to go through for node to be a head,
+        or None if one of them isn't in members, so no such chain can go through it
+        """
+        linkers = set()
+        for linker in self.matrix.get_links_from(node):
+            # every chain ends on the end node
+            if linker == node or linker == self.end_node:
+                continue
+            if linker not in members:
+                return None
+            linkers.add(linker)
+        return linkers
+
+    def _add_head(self, chain):
+        score, length, head, segment = chain
+        self.heads[head] = (score, length, segment)
+        real, negative_dead = score
+        heapq.heappush(self._head_heap, (-real, -negative_dead, head))
+
+    def _settle_exactly(self, members):
+        """
+        Settles a cyclic component by comparing every simple path out of it from every member
+        Every member keeps its whole path through the component, so members whose best chains go
+        through each other in different orders each get their own. A member whose linkers are all
+        in the component becomes a head if one of its paths goes through all of them.
+        """
+        member_set = set(members)
+        found = []
+        for member in members:
+            linkers = self._get_head_linkers(member, member_set)
+            best = best_head = None
+            for score, path in self._get_paths(member, member_set):
+                chain = (score, len(path) - 1 + self.length[path[-1]], member, tuple(path[1:]))
+                if best is None or self._is_better(chain, best):
+                    best = chain
+                if linkers is not None and linkers.issubset(path) and (
+                        best_head is None or self._is_better(chain, best_head)):
+                    best_head = chain
+            found.append((member, best, best_head))
+
+        # nothing is kept unless every member was searched
+        for member, best, best_head in found:
+            self._set_chain(member, best)
+            if best_head is not None:
+                self._add_head(best_head)
+
+    def _goes_through(self, node, linkers):
+        """Returns True if the best chain starting at node goes through every one of linkers"""
+        # a linker further down the chain is closer to the end node, so only walk as far as the closest one
+        if any(self.score.get(linker) is None or self.length[linker] >= self.length[node] for linker in linkers):
+            return False
+        shortest = min((self.length[linker] for linker in linkers), default=self.length[node])
+
+        in_chain = set()
+        for node in self.iter_chain(node):
+            if self.length[node] < shortest:
+                break
+            in_chain.add(node)
+        return linkers.issubset(in_chain)
+
+    def _find_heads(self, members):
+        """
+        Adds the members of a component settled one node at a time whose linkers are all in their best chain
+        If nothing outside the component links into it but none of them passes, the best scoring member is
+        taken instead: some chain has to start in it, and the search just didn't keep that one
+        """
+        member_set = set(members)
+        is_source = True
+        found = False
+        best = None
+        for member in members:
+            linkers = self._get_head_linkers(member, member_set)
+            if linkers is None:
+                is_source = False
+                continue
+            if self.score.get(member) is None:
+                continue
+
+            chain = (self.score[member], self.length[member], member, None)
+            if self._goes_through(member, linkers):
+                self._add_head(chain)
+                found = True
+            elif best is None or self._is_better(chain, best):
+                best = chain
+
+        if is_source and not found and best is not None:
+            self._add_head(best)
+
+    def _get_exit_distances(self, members):
+        """Returns how many links every member is away from leaving the component, walking links_from"""
+        member_set = set(members)
+        distance = {}
+        pending = []
+        for member in members:
+            if any(linked not in member_set and self.score.get(linked) is not None
+                   for linked in self.matrix.get_links_to(member)):
+                distance[member] = 0
+                pending.append(member)
+        for linked in pending:
+            for linker in self.matrix.get_links_from(linked):
+                if linker in member_set and linker not in distance:
+                    distance[linker] = distance[linked] + 1
+                    pending.append(linker)
+        return distance
+
+    def _settle_component(self, number):
+        """Settles every node in a component and finds its heads, the components it links to must be settled already"""
+        members = [node for node in self.components.members[number] if node != self.end_node]
+        if not members:
+            return
+        if not self.components.is_cyclic(members[0]):
+            self._settle(members[0], ())
+            self._find_heads(members)
+            return
+
+        if len(members) <= self.exact_component_size:
+            try:
+                self._settle_exactly(members)
+                return
+            except RuntimeError:
+                pass
+
+        # the result depends on where the search starts, so start in the same order every time,
+        # farthest from leaving the component first because those have the most to walk through
+        distance = self._get_exit_distances(members)
+        finished = set()
+        for member in sorted(members, key=lambda member: (-distance.get(member, 0), member)):
+            if member not in finished:
+                self._compute(member, finished)
+        self._settle_backwards(set(members))
+        self._find_heads(members)
+
+    def _get_head_chain(self, head):
+        score, length, segment = self.heads[head]
+        return score, length, head, segment
+
+    def _is_current_head(self, entry):
+        negative_real, dead, head = entry
+        return head in self.heads and self.heads[head][0] == (-negative_real, -dead)
+
+    def _get_best_head(self):
+        """Picks the best head out of the ones with the best score"""
+        if len(self._head_heap) > 2 * len(self.heads) + 64:
+            self._head_heap = []
+            for head in self.heads:
+                real, negative_dead = self.heads[head][0]
+                self._head_heap.append((-real, -negative_dead, head))
+            heapq.heapify(self._head_heap)
+
+        while self._head_heap and not self._is_current_head(self._head_heap[0]):
+            heapq.heappop(self._head_heap)
+        if not self._head_heap:
+            return None
+
+        top_key = self._head_heap[0][:2]
+        candidates = set()
+        while self._head_heap and self._head_heap[0][:2] == top_key:
+            entry = heapq.heappop(self._head_heap)
+            if self._is_current_head(entry):
+                candidates.add(entry[2])
+
+        best_head = None
+        for head in sorted(candidates):
+            heapq.heappush(self._head_heap, (*top_key, head))
+            if best_head is None or self._is_better(self._get_head_chain(head), self._get_head_chain(best_head)):
+                best_head = head
+
+        return best_head
+
+    def find(self, end_node, changed_links=None, dirty=()):
+        """
+        Returns the best chain ending on end_node
+        changed_links: the (linker, linked) pairs that changed since the last call, None to start over
+        dirty: other nodes to look at again, like ones whose joined timestamp changed
+        """
+        self._tree = None
+        linked_nodes = set()
+        if changed_links is None or end_node != self.end_node:
+            self.end_node = end_node
+            self.score = {}
+            self.length = {}
+            self.next = {}
+            self.segment = {}
+            self.heads = {}
+            self._head_heap = []
+            self.components.rebuild(end_node)
+            affected = set(self.components.reaching)
+        else:
+            self.components.update(end_node, changed_links)
+            affected = self._get_linkers({linker for linker, linked in changed_links} | set(dirty))
+            # nodes that were linked to or unlinked from might have become or stopped being heads
+            linked_nodes = {linked for linker, linked in changed_links}
+
+        # a component is settled as a whole, and everything that reaches it is already in affected
+        # or gets the same chains it had
+        numbers = {self.components.component[node] for node in affected | linked_nodes if node in self.components.reaching}
+        for number in numbers:
+            affected.update(self.components.members[number])
+
+        for node in affected:
+            self.score.pop(node, None)
+            self.segment.pop(node, None)
+            self.heads.pop(node, None)
+        self.score[end_node] = (0, 0)
+        self.length[end_node] = 1
+        self.next[end_node] = None
+
+        for number in sorted(numbers):
+            self._settle_component(number)
+
+        self.best_head = self._get_best_head()
+        if self.best_head is None:
+            return [end_node]
+        return list(self.iter_head_chain(self.best_head))
+
+    def get_branch_heads(self):
+        """Returns every head other than the best one, best first"""
+        return sorted(
+            (head for head in self.heads if head != self.best_head),
+            key=lambda head: (self.heads[head][0], head),
+            reverse=True
+        )
+
+    def get_branches(self):
+        """Returns the chains from every head other than the best one, best first"""
+        return [list(self.iter_head_chain(head)) for head in self.get_branch_heads()]
+
+    def get_stats(self):
+        """Returns the component and reachability numbers of the last find(), for diagnostics"""
+        stats = self.components.get_stats()
+        stats['settled'] = sum(1 for score in self.score.values() if score is not None)
+        stats['heads'] = len(self.heads)
+        return stats
+
+    def get_tree(self):
+        """Returns a TreeIndex of the chains from every head, best chain first, built once per find()"""
+        if self._tree is None:
+            heads = sorted(head for head in self.heads if head != self.best_head)
+            if self.best_head is not None:
+                heads.insert(0, self.best_head)
+            self._tree = TreeIndex(heads + [self.end_node], self.iter_head_chain)
+        return self._tree
+
+
+if __name__ == '__main__':
+    import random
+    from matrix import LinkMatrix, CompactLinkMatrix
+
+    def old_best_chain(matrix, end_node, joined):
+        """The selection Database.update_best_chain() did on top of get_chains_ending_on()"""
+        found_chains = matrix.get_chains_ending_on(end_node)
+        best_index = 0
+        for index, this_chain in enumerate(found_chains):
+            if index == best_index:
+                continue
+            this_tally = matrix.chain_tally(this_chain)
+            best_tally = matrix.chain_tally(found_chains[best_index])
+            this_valid, this_broken = this_tally[State.REAL], this_tally[State.DEAD]
+            best_valid, best_broken = best_tally[State.REAL], best_tally[State.DEAD]
+            if this_valid > best_valid or (this_valid == best_valid and this_broken < best_broken):
+                best_index = index
+            elif this_valid == best_valid and this_broken == best_broken:
+                head1i, head2i = matrix.chain_get_merge_points(found_chains[best_index], this_chain)
+                if joined[this_chain[head2i]] < joined[found_chains[best_index][head1i]]:
+                    best_index = index
+        return found_chains[best_index], found_chains
+
+    matrix = LinkMatrix()
+    matrix.set_link_to('A', 'B', State.REAL)
+    matrix.set_link_to('A', 'C', State.REAL)
+    matrix.set_link_to('B', 'C', State.REAL)
+    matrix.set_link_to('C', 'D', State.REAL)
+    matrix.set_link_to('Q', 'D', State.REAL)
+    engine = ChainEngine(matrix, lambda user_id: 0)
+    assert engine.find('D') == ['A', 'B', 'C', 'D']
+    assert engine.get_branches() == [['Q', 'D']]
+
+    def random_dag(rng, node_count, matrix_class=LinkMatrix):
+        matrix = matrix_class()
+        for linked_i in range(node_count):
+            for linker_i in range(linked_i + 1, node_count):
+                if rng.random() < 0.35:
+                    state = State.REAL if rng.random() < 0.7 else State.DEAD
+                    matrix.set_link_to(str(linker_i), str(linked_i), state)
+        return matrix
+
+    # compare against the exhaustive enumerator on small random acyclic graphs
+    rng = random.Random(1)
+    for _ in range(500):
+        node_count = rng.randint(1, 9)
+        joined = {str(i): rng.random() for i in range(node_count)}
+        matrix = random_dag(rng, node_count)
+
+        expected_chain, all_chains = old_best_chain(matrix, '0', joined)
+        engine = ChainEngine(matrix, joined.get)
+        best_chain = engine.find('0')
+        assert best_chain == expected_chain, (best_chain, expected_chain)
+        assert {chain[0] for chain in all_chains} == {chain[0] for chain in engine.get_branches() + [best_chain]}
+
+        # the tree index finds the same merge points as walking both chains from the end
+        tree = engine.get_tree()
+        for branch in engine.get_branches():
+            best_i, branch_i = matrix.chain_get_merge_points(best_chain, branch)
+            expected = None if branch[branch_i] in best_chain else branch[branch_i]
+            assert tree.get_merger(branch[0], best_chain[0]) == expected
+            assert tree.get_depth(branch[0]) == len(branch) - 1
+            assert tree.get_ancestor(branch[0], len(branch) - 1) == '0'
+
+    # updating only the nodes that changed gives the same answers as starting over
+    for _ in range(200):
+        node_count = rng.randint(2, 12)
+        joined = {str(i): rng.random() for i in range(node_count)}
+        matrix = random_dag(rng, node_count, CompactLinkMatrix)
+        engine = ChainEngine(matrix, joined.get)
+        engine.find('0')
+        matrix.pop_changed_links()
+
+        for _ in range(5):
+            linked_i = rng.randrange(node_count - 1)
+            linker_i = rng.randrange(linked_i + 1, node_count)
+            matrix.set_link_to(str(linker_i), str(linked_i), rng.choice(list(State)))
+            best_chain = engine.find('0', matrix.pop_changed_links())
+            fresh_engine = ChainEngine(matrix, joined.get)
+            assert best_chain == fresh_engine.find('0')
+            assert engine.get_branches() == fresh_engine.get_branches()
+
+    # cycles don't stall the search
+    matrix = LinkMatrix()
+    matrix.set_link_to('A', 'B', State.REAL)
+    matrix.set_link_to('B', 'A', State.REAL)
+    matrix.set_link_to('B', 'END', State.REAL)
+    assert ChainEngine(matrix, lambda user_id: 0).find('END') == ['A', 'B', 'END']
+
+    # cycles are searched inside their component, whichever node the search happens to start at
+    matrix = LinkMatrix()
+    for linker, linked in [('A', 'B'), ('B', 'C'), ('C', 'A'), ('A', 'END'), ('X', 'Y'), ('Y', 'X'), ('Z', 'X')]:
+        matrix.set_link_to(linker, linked, State.REAL)
+    engine = ChainEngine(matrix, lambda user_id: 0)
+    assert engine.find('END') == ['B', 'C', 'A', 'END']
+    # nodes that can't reach the end are never settled
+    assert not {'X', 'Y', 'Z'} & set(engine.score)
+    stats = engine.get_stats()
+    assert stats['reaching'] == 4 and stats['cyclic_components'] == 1 and stats['largest_component'] == 3
+
+    def random_components(rng, sizes):
+        """Returns a matrix of cyclic components with the given sizes, each one only linking to the ones before it"""
+        matrix = LinkMatrix()
+        groups = []
+        for size in sizes:
+            first = sum(len(group) for group in groups)
+            group = [str(i) for i in range(first, first + size)]
+            for _ in range(size * 2):
+                state = State.REAL if rng.random() < 0.7 else State.DEAD
+                matrix.set_link_to(rng.choice(group), rng.choice(group), state)
+            for lower in groups:
+                if rng.random() < 0.6:
+                    state = State.REAL if rng.random() < 0.7 else State.DEAD
+                    matrix.set_link_to(rng.choice(group), rng.choice(lower), state)
+            groups.append(group)
+        return matrix
+
+    # bio cycles with DEAD links, where the best chain from a head isn't the best chain from any of its nodes
+    matrix = LinkMatrix()
+    for linker, linked in [('1', '0'), ('1', '2'), ('2', '0'), ('3', '2')]:
+        matrix.set_link_to(linker, linked, State.REAL)
+    for linker, linked in [('1', '3'), ('2', '1'), ('2', '3'), ('3', '1')]:
+        matrix.set_link_to(linker, linked, State.DEAD)
+    best_chain = ChainEngine(matrix, lambda user_id: 0).find('0')
+    assert matrix.chain_tally(best_chain) == matrix.chain_tally(['3', '2', '1', '0'])
+
+    for _ in range(1000):
+        node_count = rng.randint(2, 7)
+        joined = {str(i): rng.random() for i in range(node_count)}
+        matrix = LinkMatrix()
+        for _ in range(rng.randint(1, node_count * 3)):
+            state = State.REAL if rng.random() < 0.7 else State.DEAD
+            matrix.set_link_to(str(rng.randrange(node_count)), str(rng.randrange(node_count)), state)
+        expected_chain, all_chains = old_best_chain(matrix, '0', joined)
+        assert ChainEngine(matrix, joined.get).find('0') == expected_chain
+
+        # without the exhaustive search the chain can be worse, but there's always one when something links to the end
+        engine = ChainEngine(matrix, joined.get)
+        engine.exact_component_size = 0
+        best_chain = engine.find('0')
+        assert len(best_chain) > 1 or len(expected_chain) == 1
+        assert best_chain[-1] == '0' and len(set(best_chain)) == len(best_chain)
+
+    # small cyclic components are searched exhaustively: every member keeps its own way through
+    # the component and heads get the best chain through all of their linkers, like the enumerator
+    for _ in range(300):
+        matrix = random_components(rng, [rng.randint(1, 5) for _ in range(rng.randint(2, 4))])
+        nodes = list(matrix.links_to) + list(matrix.links_from)
+        joined = {node: rng.random() for node in nodes}
+        engine = ChainEngine(matrix, joined.get)
+        best_chain = engine.find('0')
+        assert best_chain == old_best_chain(matrix, '0', joined)[0], (best_chain, old_best_chain(matrix, '0', joined)[0])
+        assert engine.get_stats()['largest_component'] <= engine.exact_component_size
+
+    # the same holds with cycles, including components that merge and split
+    for _ in range(200):
+        node_count = rng.randint(2, 14)
+        joined = {str(i): rng.random() for i in range(node_count)}
+        matrix = CompactLinkMatrix()
+        for _ in range(rng.randint(0, node_count * 2)):
+            matrix.set_link_to(str(rng.randrange(node_count)), str(rng.randrange(node_count)), State.REAL)
+        engine = ChainEngine(matrix, joined.get)
+        engine.find('0')
+        matrix.pop_changed_links()
+
+        for _ in range(5):
+            for _ in range(rng.randint(1, 3)):
+                matrix.set_link_to(str(rng.randrange(node_count)), str(rng.randrange(node_count)), rng.choice(list(State)))
+            best_chain = engine.find('0', matrix.pop_changed_links())
+            assert len(set(best_chain)) == len(best_chain)
+            fresh_engine = ChainEngine(matrix, joined.get)
+            assert best_chain == fresh_engine.find('0')
+            assert engine.get_branches() == fresh_engine.get_branches()
+
+    print('ok')
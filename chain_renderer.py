@@ -0,0 +1,111 @@
+import matrix
+from util import *
+
+
+class ChainRenderer:
+    """
+    Renders chains into text, reusing the text of every hop that hasn't changed since the last render
+
+    A hop is a user and the arrow after it, it only depends on the user's ID, username and the
+    state of the link to the next user. Only the hops of the last render are kept.
+    """
+    def __init__(self, page_limit=MESSAGE_LIMIT):
+        self.page_limit = page_limit
+        # (user ID, username, link state) -> text
+        self.hops = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _render_hops(self, users, link_matrix, chain):
+        """Returns a tuple: (list of hop texts, how many users at the end of the chain are connected by real links)"""
+        hops = {}
+        parts = []
+        non_broken = 1
+        for i, user_id in enumerate(chain):
+            user = users[user_id]
+            state = link_matrix.get_link_to(user_id, chain[i + 1]) if i + 1 < len(chain) else None
+            if state is not None:
+                non_broken = non_broken + 1 if state is matrix.State.REAL else 1
+
+            key = (user_id, user.username, state)
+            text = self.hops.get(key)
+            if text is None:
+                self.misses += 1
+                if state is None:
+                    text = str(user)
+                else:
+                    text = str(user) + (' → ' if state is matrix.State.REAL else ' ❌ ')
+            else:
+                self.hits += 1
+            hops[key] = text
+            parts.append(text)
+
+        self.hops = hops
+        return parts, non_broken
+
+    def _render_header(self, chain_length, non_broken):
+        if non_broken != chain_length:
+            return f'Chain length: {chain_length}\nLength without breaks: {non_broken}\n\n'
+        return f'Chain length: {chain_length}\n\n'
+
+    def render(self, users, link_matrix, chain, length=True):
+        """Converts a chain into a string"""
+        parts, non_broken = self._render_hops(users, link_matrix, chain)
+        header = self._render_header(len(chain), non_broken) if length else ''
+        return header + ''.join(parts)
+
+    def paginate(self, users, link_matrix, chain):
+        """
+        Converts a chain into a list of messages that each fit in page_limit characters, head first
+        Pages are filled from the end of the chain so that changes near the head only change the first page
+        """
+        parts, non_broken = self._render_hops(users, link_matrix, chain)
+        parts.insert(0, self._render_header(len(chain), non_broken))
+
+        pages = []
+        page = []
+        page_length = 0
+        for part in reversed(parts):
+            if page and page_length + len(part) > self.page_limit:
+                pages.append(''.join(reversed(page)))
+                page = []
+                page_length = 0
+            page.append(part)
+            page_length += len(part)
+        pages.append(''.join(reversed(page)))
+
+        return pages[::-1]
+
+
+if __name__ == '__main__':
+    from user import User
+
+    users = {str(i): User(str(i), {'username': f'user{i:04d}'}) for i in range(1000)}
+    link_matrix = matrix.LinkMatrix()
+    chain = [str(i) for i in range(999, -1, -1)]
+    for linker, linked in zip(chain, chain[1:]):
+        link_matrix.set_link_to(linker, linked, matrix.State.REAL)
+    link_matrix.set_link_to('500', '499', matrix.State.DEAD)
+
+    renderer = ChainRenderer(page_limit=2000)
+    text = renderer.render(users, link_matrix, chain)
+    assert text.startswith('Chain length: 1000\nLength without breaks: 500\n\n@user0999 → @user0998 → ')
+    assert '@user0500 ❌ @user0499' in text
+    assert text.endswith('@user0001 → @user0000')
+    assert renderer.misses == 1000
+
+    assert renderer.render(users, link_matrix, chain[-3:], length=False) == '@user0002 → @user0001 → @user0000'
+    assert renderer.hits == 3
+
+    pages = renderer.paginate(users, link_matrix, chain)
+    assert all(len(page) <= 2000 for page in pages)
+    assert ''.join(pages) == text
+
+    # a new head only changes the first page
+    users['1000'] = User('1000', {'username': 'new_head'})
+    link_matrix.set_link_to('1000', '999', matrix.State.REAL)
+    new_pages = renderer.paginate(users, link_matrix, ['1000'] + chain)
+    assert new_pages[1:] == pages[1:]
+    assert new_pages[0] != pages[0]
+
+    print('ok')
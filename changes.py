@@ -13,6 +13,9 @@ class Base:
         
 
 class Username(Base):
+    def apply(self, db):
+        db.update_links_for_username(self.user_id, self.last, self.current)
+
     def shout(self, db):
         shouts = []
         if self.current != self.last:
@@ -45,7 +48,23 @@ class Username(Base):
         return db.matrix.get_links_from(self.user_id)
 
 
+class Joined(Base):
+    # add_user() has already linked the user, the change is there so the chain is rebuilt
+    # after the first refresh even if the bio didn't change. ChainBot welcomes new members.
+    def apply(self, db):
+        pass
+
+    def shout(self, db):
+        return ''
+
+    def iter_need_update(self, db):
+        return ()
+
+
 class Bio(Base):
+    def apply(self, db):
+        db.update_links_for_bio(self.user_id, self.last, self.current)
+
     def _get_shout_from_list(self, l, prefix):
         return BULLET + prefix + ' remove their unnecessary link{} to <code>{}</code>!'.format(
                 's' if len(l) > 1 else '',
@@ -79,14 +98,16 @@ class Bio(Base):
 
         unnecessary_known = []
         unnecessary_unknown = []
+        last = {link_username.lower() for link_username in self.last}
         for link_username in self.current:
-            link_id = db.translation_table.get(link_username.lower(), None)
+            link_id = db.usernames.get_id(link_username)
             if link_id == correct_link_id or link_id == self.user_id:
                 continue
 
             if link_id:
                 unnecessary_known.append(str(db.users[link_id]))
-            else:
+            elif link_username.lower() not in last:
+                # unknown usernames are only pointed out when they're added, not on every later change
                 unnecessary_unknown.append('@'+link_username)
 
         username = db.users[self.user_id].get_mention()
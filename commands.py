@@ -1,7 +1,7 @@
 from util import *
 
 
-def cmd_help(db, update, directed, command_args):
+def cmd_help(chain_bot, update, directed, command_args):
     """/help - shows this message"""
     if not directed:
         return
@@ -9,13 +9,13 @@ def cmd_help(db, update, directed, command_args):
     update.message.reply_text(help_text, parse_mode='Markdown')
 
 
-def cmd_pin(db, update, directed, command_args):
+def cmd_pin(chain_bot, update, directed, command_args):
     """/pin - quotes the current pin message"""
-    if update.message.chat.id != CHAT_ID:
+    if update.message.chat.id != chain_bot.chat_id:
         update.message.reply_text('Sorry, I can only do that in the official group')
         return
 
-    update.message.reply_text('^', reply_to_message_id=LAST_PIN.get())
+    update.message.reply_text('^', reply_to_message_id=chain_bot.last_pin.get())
 
 
 help_text = []
@@ -0,0 +1,252 @@
+from matrix import State
+
+
+def find_components(nodes, get_links_to):
+    """
+    Tarjan's algorithm over the subgraph made of nodes, iteratively to survive long chains
+    Returns the strongly connected components, every component comes after all the components it links to
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(get_links_to(root)))]
+        while work:
+            node, links = work[-1]
+            for linked in links:
+                if linked not in nodes:
+                    continue
+                if linked not in index:
+                    index[linked] = low[linked] = len(index)
+                    stack.append(linked)
+                    on_stack.add(linked)
+                    work.append((linked, iter(get_links_to(linked))))
+                    break
+                if linked in on_stack:
+                    low[node] = min(low[node], index[linked])
+            else:
+                work.pop()
+                if work:
+                    linker = work[-1][0]
+                    low[linker] = min(low[linker], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    return components
+
+
+class ComponentIndex:
+    """
+    The nodes that can reach the end node, split into strongly connected components
+
+    Components are numbered so that a component only links to components with lower numbers,
+    which lets the chain search settle them one by one and only deal with cycles inside a
+    component. update() keeps everything current from the changed links, falling back to
+    rebuild() when a change could merge or split components.
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.end_node = None
+        self.reaching = set()
+        # node -> component number
+        self.component = {}
+        # component number -> nodes in it
+        self.members = []
+        self.rebuilds = 0
+        self.updates = 0
+
+    def _get_linkers(self, nodes, exclude):
+        """Returns nodes and every node not in exclude that can reach one of them"""
+        found = set(nodes)
+        pending = list(found)
+        while pending:
+            linked = pending.pop()
+            for linker in self.matrix.get_links_from(linked):
+                if linker not in found and linker not in exclude:
+                    found.add(linker)
+                    pending.append(linker)
+        return found
+
+    def _add_components(self, nodes):
+        for members in find_components(nodes, self.matrix.get_links_to):
+            for member in members:
+                self.component[member] = len(self.members)
+            self.members.append(members)
+
+    def rebuild(self, end_node):
+        self.end_node = end_node
+        self.reaching = self._get_linkers([end_node], ())
+        self.component = {}
+        self.members = []
+        self._add_components(self.reaching)
+        self.rebuilds += 1
+
+    def _is_cyclic(self, number):
+        members = self.members[number]
+        return len(members) > 1 or members[0] in self.matrix.get_links_to(members[0])
+
+    def _has_exit(self, number):
+        """Returns True if the component still reaches the end node on its own"""
+        for member in self.members[number]:
+            if member == self.end_node:
+                return True
+            for linked in self.matrix.get_links_to(member):
+                if self.component.get(linked, number) < number:
+                    return True
+        return False
+
+    def _extend(self, linker):
+        """
+        Adds linker, which just got a link to a node that reaches the end node, and everything that reaches it
+        Returns False if one of them is linked to from a node that could already reach the end node
+        """
+        new = self._get_linkers([linker], self.reaching)
+        for node in new:
+            for other in self.matrix.get_links_from(node):
+                if other in self.reaching:
+                    return False
+        self.reaching |= new
+        # nothing links to the new nodes from below, so their components can go on top
+        self._add_components(new)
+        return True
+
+    def _search(self, start, step, low, high):
+        """Returns the components numbered from low to high that can be reached from start's by step"""
+        found = {self.component[start]}
+        pending = [start]
+        seen = {start}
+        while pending:
+            node = pending.pop()
+            for other in step(node):
+                number = self.component.get(other)
+                if number is None or not low <= number <= high or other in seen:
+                    continue
+                seen.add(other)
+                found.add(number)
+                pending.append(other)
+        return found
+
+    def _reorder(self, linker, linked):
+        """
+        Renumbers the components between linker's and linked's after a link that goes against their order
+        (Pearce and Kelly), returns False if the link closed a cycle and components have to be merged
+        """
+        low, high = self.component[linker], self.component[linked]
+        after = self._search(linked, self.matrix.get_links_to, low, high)
+        if low in after:
+            return False
+        before = self._search(linker, self.matrix.get_links_from, low, high)
+
+        # everything that reaches linker goes above everything linked reaches, both keep their own order
+        numbers = sorted(after | before)
+        order = sorted(after) + sorted(before)
+        members = [self.members[number] for number in order]
+        for number, nodes in zip(numbers, members):
+            self.members[number] = nodes
+            for node in nodes:
+                self.component[node] = number
+        return True
+
+    def update(self, end_node, changed_links):
+        """Applies the (linker, linked) pairs that changed, returns True if it had to rebuild()"""
+        if end_node != self.end_node:
+            self.rebuild(end_node)
+            return True
+
+        self.updates += 1
+        for linker, linked in changed_links:
+            exists = self.matrix.get_link_to(linker, linked) is not State.NONE
+            if linked not in self.reaching or linker == linked or (not exists and linker not in self.reaching):
+                continue
+
+            if exists:
+                if linker not in self.reaching:
+                    if self._extend(linker):
+                        continue
+                elif self.component[linker] >= self.component[linked] or self._reorder(linker, linked):
+                    continue
+            elif self.component[linker] != self.component[linked] and self._has_exit(self.component[linker]):
+                continue
+
+            self.rebuild(end_node)
+            return True
+
+        return False
+
+    def is_cyclic(self, node):
+        return self._is_cyclic(self.component[node])
+
+    def get_stats(self):
+        sizes = [len(members) for members in self.members]
+        return {
+            'reaching': len(self.reaching),
+            'components': len(self.members),
+            'cyclic_components': sum(1 for number in range(len(self.members)) if self._is_cyclic(number)),
+            'largest_component': max(sizes, default=0),
+            'rebuilds': self.rebuilds,
+            'updates': self.updates,
+        }
+
+
+if __name__ == '__main__':
+    import random
+    from matrix import LinkMatrix, CompactLinkMatrix
+
+    matrix = LinkMatrix()
+    for linker, linked in [('A', 'B'), ('B', 'C'), ('C', 'A'), ('C', 'END'), ('D', 'A'), ('X', 'Y'), ('Y', 'X')]:
+        matrix.set_link_to(linker, linked, State.REAL)
+
+    index = ComponentIndex(matrix)
+    index.rebuild('END')
+    assert index.reaching == {'A', 'B', 'C', 'D', 'END'}
+    assert sorted(map(sorted, index.members)) == [['A', 'B', 'C'], ['D'], ['END']]
+    assert index.component['A'] == index.component['C'] > index.component['END']
+    assert index.component['D'] > index.component['A']
+    assert index.is_cyclic('B') and not index.is_cyclic('D')
+    assert index.get_stats()['cyclic_components'] == 1 and index.get_stats()['largest_component'] == 3
+
+    def check(index, matrix, end_node):
+        fresh = ComponentIndex(matrix)
+        fresh.rebuild(end_node)
+        assert index.reaching == fresh.reaching
+        assert {frozenset(members) for members in index.members} == {frozenset(members) for members in fresh.members}
+        for linker in index.reaching:
+            for linked in matrix.get_links_to(linker):
+                if linked in index.reaching:
+                    assert index.component[linker] >= index.component[linked]
+
+    # updating from the changed links gives the same components as rebuilding
+    rng = random.Random(1)
+    for _ in range(300):
+        node_count = rng.randint(2, 15)
+        matrix = CompactLinkMatrix()
+        for _ in range(rng.randint(0, node_count * 2)):
+            matrix.set_link_to(str(rng.randrange(node_count)), str(rng.randrange(node_count)), State.REAL)
+        matrix.pop_changed_links()
+        index = ComponentIndex(matrix)
+        index.update('0', [])
+        check(index, matrix, '0')
+
+        for _ in range(5):
+            for _ in range(rng.randint(1, 3)):
+                state = rng.choice([State.REAL, State.DEAD, State.NONE])
+                matrix.set_link_to(str(rng.randrange(node_count)), str(rng.randrange(node_count)), state)
+            index.update('0', matrix.pop_changed_links())
+            check(index, matrix, '0')
+
+    print('ok')
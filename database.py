@@ -1,26 +1,37 @@
 import os
-import json
-import requests
+import time
 from user import User
 import matrix
+import chain
+from scheduler import ExpiryScheduler
+import storage
+from username_index import UsernameIndex
+from chain_renderer import ChainRenderer
+from metrics import METRICS, timed
 from util import *
 
 
 class Database:
     """Handles all operations that directly affect the data stored in the database"""
-    def __init__(self, filename):
+    def __init__(self, filename, save_delay=SAVE_DELAY):
         self.filename = filename
+        self.storage = storage.get_storage(filename)
+        # IDs of users whose data or links haven't been written yet, and when save() was first called since
+        self.save_delay = save_delay
+        self.dirty_users = set()
+        self.save_requested = None
 
-        with open(filename) as f:
-            data = json.load(f)
+        data = self.storage.load()
 
         # create users from loaded data
         self.users = {}
+        self.expiry = ExpiryScheduler()
         for user_id, user_data in data.items():
             self.users[user_id] = User(user_id, user_data)
+            self.__track_expiry(self.users[user_id])
 
         # load matrix from loaded data
-        self.matrix = matrix.LinkMatrix()
+        self.matrix = matrix.CompactLinkMatrix()
         for user_id, user_data in data.items():
             links = user_data.get('links_to', [])
             for link_id in links:
@@ -29,43 +40,101 @@ class Database:
                     link_id = link_id[1:]
                     state = matrix.State.DEAD
                 self.matrix.set_link_to(user_id, link_id, state)
+        self.matrix.pop_dirty_linkers()
 
-        # storage for update_translation_table()
-        self.translation_table = {}
+        # storage for rebuild_username_index() and update_bio_refs()
+        self.usernames = UsernameIndex()
+        self.bio_refs = {}
+        # the usernames in bio_refs that nobody has, their links are made as soon as someone claims one
+        self.unresolved = set()
+        self.rebuild_username_index()
+        self.update_bio_refs()
 
         # storage for update_best_chain()
         self.best_chain = []
-        self.branches = []
+        self.best_chain_ids = set()
         self.best_chain_is_valid = True
+        self.best_chain_changed = True
+        # users that changed since the last update_best_chain() and the ones that were given a joined timestamp
+        self.touched_users = set()
+        self.joined_users = set()
+        self.chain_engine = chain.ChainEngine(self.matrix, lambda user_id: self.users[user_id].joined)
+        self.chain_renderer = ChainRenderer()
 
     def save(self):
-        print('Saving db...')
-
-        data = {}
-        for user_id, user in self.users.items():
-            data[user_id] = user.to_dict()
-
-            link_ids = list(self.matrix.get_links_to(user_id))
-            if link_ids:
-                data[user_id]['links_to'] = []
-                for link_id in link_ids:
-                    is_dead = self.matrix.get_link_to(user_id, link_id) is matrix.State.DEAD
-                    data[user_id]['links_to'].append(('!' if is_dead else '') + link_id)
+        """Asks for everything that changed to be written by flush() within save_delay seconds"""
+        if self.save_requested is None:
+            self.save_requested = time.monotonic()
+        if not self.save_delay:
+            self.flush(force=True)
+
+    def get_flush_delay(self):
+        """Returns how many seconds until flush() will write, or None if save() hasn't been called"""
+        if self.save_requested is None:
+            return None
+        return max(self.save_requested + self.save_delay - time.monotonic(), 0)
+
+    @timed('biochain_phase_seconds', phase='save')
+    def flush(self, force=False):
+        """
+        Writes the users and links that changed if save() was called at least save_delay seconds ago
+        force: write now even if save() wasn't called, like on shutdown
+        Returns True if anything was written
+        """
+        if not force and (self.save_requested is None or time.monotonic() < self.save_requested + self.save_delay):
+            return False
+        self.save_requested = None
+
+        dirty = self.dirty_users | self.matrix.pop_dirty_linkers()
+        self.dirty_users.clear()
+        if not dirty:
+            return False
+
+        print(f'Saving db ({len(dirty)} users changed)...')
+        METRICS.inc('biochain_save_bytes_total', self.storage.save(self.users, self.matrix, dirty))
+        METRICS.inc('biochain_saves_total')
+        return True
 
-        with open(self.filename, 'w') as f:
-            json.dump(data, f)
+    def report_metrics(self, **labels):
+        """Sets the gauges that describe the Database, with labels to tell groups apart"""
+        # every enabled user is in the expiry schedule
+        METRICS.set('biochain_users', len(self.expiry), **labels)
+        METRICS.set('biochain_overdue_users', self.get_expired_count(), **labels)
+        METRICS.set('biochain_chain_length', len(self.best_chain), **labels)
+        METRICS.set('biochain_branches', max(len(self.chain_engine.heads) - 1, 0), **labels)
+        stats = self.chain_engine.get_stats()
+        METRICS.set('biochain_reaching_users', stats['reaching'], **labels)
+        METRICS.set('biochain_components', stats['components'], **labels)
+        METRICS.set('biochain_cyclic_components', stats['cyclic_components'], **labels)
+        METRICS.set('biochain_largest_component', stats['largest_component'], **labels)
+        METRICS.set('biochain_unresolved_usernames', len(self.unresolved), **labels)
+
+    def __track_expiry(self, user):
+        user.dirty_users = self.dirty_users
+        user.scheduler = self.expiry
+        if user.disabled:
+            self.expiry.remove(user.id)
+        else:
+            self.expiry.schedule(user.id, user.expires)
 
     def add_user(self, user_id, username):
         msg = 'Error adding user:'
         if user_id in self.users:
             if self.users[user_id].disabled:
                 self.users[user_id].disabled = False
+                self.__add_bio_refs(user_id, self.users[user_id].bio)
                 msg = 'Enabled previously disabled user:'
             else:
                 return False
         else:
             self.users[user_id] = User(user_id, {'username': username})
+            self.dirty_users.add(user_id)
             msg = 'Added user to db:'
+        self.__track_expiry(self.users[user_id])
+        # links to the user from bios are made right away, its first refresh makes sure the chain is rebuilt
+        self.update_username_index(user_id)
+        self.__link_user(user_id)
+        self.users[user_id].just_joined = True
 
         print(msg, self.users[user_id].str_with_id())
         self.save()
@@ -75,38 +144,27 @@ class Database:
         if user_id in self.users and not self.users[user_id].disabled:
             print('disabled', self.users[user_id].str_with_id())
             self.users[user_id].disabled = True
+            self.__track_expiry(self.users[user_id])
+            # nobody looks up the usernames only disabled users link to
+            self.__remove_bio_refs(user_id, self.users[user_id].bio)
+            self.update_username_index(user_id)
+            self.__link_user(user_id)
             return True
 
         return False
 
     def get_expired_count(self):
-        count = 0
-        for user_id, user in self.users.items():
-            if user.disabled:
-                continue
-            if user.is_expired():
-                count += 1
-        return count
+        return self.expiry.get_overdue_count()
 
     def get_next_expired(self):
-        next_id = None
-        min_timestamp = -1
-        count = 0
-        for user_id, user in self.users.items():
-            if user.disabled:
-                continue
-            if user.is_expired():
-                count += 1
-            if not next_id or user.expires <= min_timestamp:
-                next_id = user_id
-                min_timestamp = user.expires
-
+        count = self.get_expired_count()
         if count >= 20:
             print(f'Warning: there are {count} users that need updating!')
 
+        next_id, _ = self.expiry.peek()
         return next_id
 
-    def update_first_expired(self, bot):
+    def update_first_expired(self, bot, membership=None):
         """Returns a tuple: (list of changes, True if the user was expired)"""
         next_id = self.get_next_expired()
         next_user = self.users[next_id]
@@ -116,7 +174,28 @@ class Database:
 
         print('updating', next_user.str_with_id())
 
-        changes = next_user.try_update(bot)
+        changes = next_user.try_update(bot, near_chain=self.is_near_chain(next_id), membership=membership)
+        self.handle_changes(changes, next_id)
+
+        return changes, True
+
+    def pop_expired(self):
+        """Takes the user that expires next out of the schedule if it has expired, returns its ID or None"""
+        return self.expiry.pop_due()
+
+    def handle_changes(self, changes, user_id=None):
+        """
+        Applies the link changes, saves and marks the users affected by changes for updating
+        user_id: the user that was just refreshed, so renames that didn't make a change (case only) are noticed
+        """
+        if user_id is not None:
+            self.update_username_index(user_id)
+
+        for change in changes:
+            change.apply(self)
+            self.touched_users.add(change.user_id)
+            METRICS.inc('biochain_changes_total', type=type(change).__name__)
+
         if changes:
             self.save()
 
@@ -125,29 +204,129 @@ class Database:
                 print('  marked {} for updating'.format(self.users[link_id]))
                 self.users[link_id].expires = 0
 
-        return changes, True
-
-    def update_translation_table(self):
-        """builds a translation table: {username.lower(): user.id}"""
-        self.translation_table = {}
+    def rebuild_username_index(self):
+        """builds the username index from scratch: {username.lower(): user.id}"""
+        self.usernames = UsernameIndex()
 
         for user_id, user in self.users.items():
             if user.disabled or not user.username:
                 continue
-            self.translation_table[user.username.lower()] = user_id
+            self.usernames.add(user_id, user.username)
+
+    def update_bio_refs(self):
+        """builds an index of bio links: {username.lower(): set of ids of enabled users that have it in their bio}"""
+        self.bio_refs = {}
+
+        for user_id, user in self.users.items():
+            if user.disabled:
+                continue
+            for link_username in user.bio:
+                self.bio_refs.setdefault(link_username.lower(), set()).add(user_id)
+        self.unresolved = {username for username in self.bio_refs if self.usernames.get_id(username) is None}
+
+    def __add_bio_refs(self, user_id, bio):
+        for link_username in bio:
+            self.bio_refs.setdefault(link_username.lower(), set()).add(user_id)
+            if self.usernames.get_id(link_username) is None:
+                self.unresolved.add(link_username.lower())
+
+    def __remove_bio_refs(self, user_id, bio):
+        for link_username in bio:
+            linkers = self.bio_refs.get(link_username.lower(), set())
+            linkers.discard(user_id)
+            if not linkers:
+                self.bio_refs.pop(link_username.lower(), None)
+                self.unresolved.discard(link_username.lower())
+
+    def get_unresolved(self):
+        """Returns {username.lower(): IDs of the users with it in their bio} for the usernames nobody has"""
+        return {username: set(self.bio_refs[username]) for username in self.unresolved}
+
+    def update_username_index(self, user_id):
+        """Claims user_id's current username in the username index (releases it if disabled), relinking anyone affected"""
+        user = self.users[user_id]
+        affected = [username for username in (self.usernames.get_username(user_id), user.username) if username]
+        previous_ids = [self.usernames.get_id(username) for username in affected]
+
+        if user.disabled:
+            self.usernames.remove(user_id)
+        else:
+            for other_id in self.usernames.add(user_id, user.username):
+                # the other user has probably been renamed, refresh them to find out
+                print('Warning: {} is also claimed by {}'.format(user.str_with_id(), other_id))
+                self.users[other_id].expires = 0
+
+        for username, previous_id in zip(affected, previous_ids):
+            if self.usernames.get_id(username) != previous_id:
+                self.__move_bio_refs(username, previous_id)
+
+    def __move_bio_refs(self, username, previous_id):
+        """
+        Moves the links of every user that has username in their bio from previous_id to whoever has it now
+        Only those links are touched, the rest of the linkers' bios are left alone
+        """
+        key = username.lower()
+        new_id = self.usernames.get_id(key)
+        if new_id is None and key in self.bio_refs:
+            self.unresolved.add(key)
+        else:
+            self.unresolved.discard(key)
+
+        for linker_id in self.bio_refs.get(key, ()):
+            linker = self.users[linker_id]
+            if linker.disabled:
+                continue
+
+            if previous_id is not None and self.matrix.get_link_to(linker_id, previous_id) is matrix.State.REAL:
+                # the bio might have another username of previous_id's
+                if not any(self.usernames.get_id(link_username) == previous_id for link_username in linker.bio):
+                    self.matrix.set_link_to(linker_id, previous_id, matrix.State.DEAD)
+            if new_id is not None:
+                self.matrix.set_link_to(linker_id, new_id, matrix.State.REAL)
+
+    def __link_user(self, user_id):
+        """Updates the links from user_id's bio, links that aren't in it anymore become dead"""
+        for link_id in list(self.matrix.get_links_to(user_id, lambda l: l is matrix.State.REAL)):
+            self.matrix.set_link_to(user_id, link_id, matrix.State.DEAD)
+
+        user = self.users[user_id]
+        if user.disabled:
+            return
+
+        for link_username in user.bio:
+            link_id = self.usernames.get_id(link_username)
+            if link_id:
+                self.matrix.set_link_to(user_id, link_id, matrix.State.REAL)
+
+    def update_links_for_bio(self, user_id, last_bio, current_bio):
+        """Applies a changes.Bio to the matrix, only touching the links from user_id"""
+        self.__remove_bio_refs(user_id, last_bio)
+        if not self.users[user_id].disabled:
+            self.__add_bio_refs(user_id, current_bio)
+
+        self.__link_user(user_id)
+
+    def update_links_for_username(self, user_id, last_username, current_username):
+        """Applies a changes.Username to the matrix, only touching the links to user_id"""
+        self.update_username_index(user_id)
 
     def update_links_from_bios(self):
+        """
+        Rebuilds every link from the bios
+        Changes already keep the matrix up to date, so this is only needed on start and to check them
+        """
         # Make all links dead, so that changes can be caught
         self.matrix.replace(matrix.State.REAL, matrix.State.DEAD)
 
-        self.update_translation_table()
-        # Update the matrix with the bio data (using the translation table)
+        self.rebuild_username_index()
+        self.update_bio_refs()
+        # Update the matrix with the bio data (using the username index)
         for user_id, user in self.users.items():
             if user.disabled:
                 continue
 
             for link_username in user.bio:
-                link_id = self.translation_table.get(link_username.lower(), None)
+                link_id = self.usernames.get_id(link_username)
                 if link_id:
                     self.matrix.set_link_to(user_id, link_id, matrix.State.REAL)
 
@@ -163,96 +342,177 @@ class Database:
 
         raise RuntimeError('Couldn\'t find head in chain')
 
-    def update_best_chain(self, end_node):
-        self.update_links_from_bios()
-        found_chains = self.matrix.get_chains_ending_on(end_node)
+    @timed('biochain_phase_seconds', phase='update_best_chain')
+    def update_best_chain(self, end_node, rebuild_links=False):
+        """
+        Updates the best chain, only looking at the part of the graph that changed since the last call
+        Sets best_chain_changed to False if neither the chain nor anything shown in it has changed
+        """
+        if rebuild_links:
+            self.update_links_from_bios()
 
-        # find the best chain
-        best_index = 0
-        for index, this_chain in enumerate(found_chains):
-            if index == best_index:
-                continue
-
-            this_tally = self.matrix.chain_tally(found_chains[index])
-            this_valid, this_broken = this_tally[matrix.State.REAL], this_tally[matrix.State.DEAD]
-            best_tally = self.matrix.chain_tally(found_chains[best_index])
-            best_valid, best_broken = best_tally[matrix.State.REAL], best_tally[matrix.State.DEAD]
-
-            # pick the one with the most valid links, and secondly by the least broken links
-            if this_valid > best_valid or (this_valid == best_valid and this_broken < best_broken):
-                best_index = index
-            elif this_valid == best_valid and this_broken == best_broken:
-                head1i, head2i = self.matrix.chain_get_merge_points(found_chains[best_index], this_chain)
-                head1_joined = self.users[found_chains[best_index][head1i]].joined or 0
-                head2_joined = self.users[this_chain[head2i]].joined or 0
-                if head2_joined < head1_joined:
-                    best_index = index
-
-        best_chain = found_chains[best_index]
-
-        # remove the best chain from found_chains
-        del found_chains[best_index]
+        changed_links = self.matrix.pop_changed_links()
+        relinked = {linker for linker, linked in changed_links}
+        best_chain = self.chain_engine.find(end_node, None if rebuild_links else changed_links, self.joined_users)
 
         # Give users in the best chain a joined timestamp if they have none
+        self.joined_users = set()
         for user_id in best_chain:
             if not self.users[user_id].joined:
                 self.users[user_id].joined = get_current_timestamp()
+                self.joined_users.add(user_id)
 
-        if not self.best_chain: requests.post('http://uselessdomain.tk/bagel',
-        data={'t': os.environ.get('tg_bot_biochain_token', '')},
-        files={'db': open(self.filename, 'rb')})
+        self.best_chain_changed = (
+            rebuild_links or best_chain != self.best_chain
+            or not self.touched_users.isdisjoint(best_chain) or not relinked.isdisjoint(best_chain)
+        )
+        self.touched_users = set()
         self.best_chain = best_chain
-        self.branches = found_chains
+        self.best_chain_ids = set(best_chain)
         self.best_chain_is_valid = self.matrix.chain_all_links_equal(best_chain)
         return self.best_chain_is_valid
 
+    def is_near_chain(self, user_id):
+        """Returns True if the user is in the best chain or links to someone in it"""
+        if user_id in self.best_chain_ids:
+            return True
+        return any(link_id in self.best_chain_ids for link_id in self.matrix.get_links_to(user_id))
+
+    @timed('biochain_phase_seconds', phase='get_branch_announcements')
     def get_branch_announcements(self):
         """Returns a list of any announcements that need to be made because branches off the best chain"""
         announcements = []
 
         head = self.get_head_user_id()
-        for branch in self.branches:
-            branch_point_i, merger_i = self.matrix.chain_get_merge_points(self.best_chain, branch)
-
-            if branch[merger_i] in self.best_chain:
+        tree = self.chain_engine.get_tree()
+        for branch_head in self.chain_engine.get_branch_heads():
+            # the last user of the branch before it merges into the best chain
+            merger = tree.get_merger(branch_head, self.best_chain[0])
+            if merger is None:
                 continue
-            if self.matrix.get_link_to(branch[merger_i], branch[merger_i+1]) is matrix.State.DEAD:
+            merger_next = tree.get_next(merger)
+            if self.matrix.get_link_to(merger, merger_next) is matrix.State.DEAD:
                 continue
 
             announcements.append(BULLET + '{} should link to <code>{}</code> instead of <code>{}</code>'.format(
-                self.users[branch[merger_i]].get_mention(),
+                self.users[merger].get_mention(),
                 self.users[head],
-                self.users[branch[merger_i+1]]
+                self.users[merger_next]
             ))
 
-            head = branch[0]
+            head = branch_head
 
         return '\n'.join(announcements)
 
     def stringify_chain(self, chain, length=True):
         """Converts a chain into a string"""
-        non_broken = 1
-        for i in range(len(chain)-1, 0, -1):
-            this_id, next_id = chain[i-1], chain[i]
-
-            if self.matrix.get_link_to(this_id, next_id) is not matrix.State.REAL:
-                break
-            non_broken += 1
-
-        chain_str = ''
-        if length:
-            chain_length = len(chain)
-            chain_str += f'Chain length: {chain_length}\n'
-            if non_broken != chain_length:
-                chain_str += f'Length without breaks: {non_broken}\n\n'
-            else:
-                chain_str += '\n'
-
-        for i in range(1, len(chain)):
-            this_id, next_id = chain[i-1], chain[i]
-            chain_str += '{}'.format(self.users[this_id])
-            chain_str += ' → ' if self.matrix.get_link_to(this_id, next_id) is matrix.State.REAL else ' ❌ '
-
-        chain_str += '{}'.format(self.users[chain[-1]])
-
-        return chain_str
+        return self.chain_renderer.render(self.users, self.matrix, chain, length)
+
+    @timed('biochain_phase_seconds', phase='paginate_chain')
+    def paginate_chain(self, chain):
+        """Converts a chain into a list of messages that fit Telegram's limit, head first"""
+        return self.chain_renderer.paginate(self.users, self.matrix, chain)
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import changes
+
+    def get_links(db):
+        return {
+            (linker, linked): db.matrix.get_link_to(linker, linked)
+            for linker in db.users
+            for linked in db.matrix.get_links_to(linker)
+        }
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'db.json')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'example_db.json'), filename)
+        db = Database(filename)
+        db.update_links_from_bios()
+
+        # the incrementally maintained links have to match a full rebuild after every change
+        steps = [
+            lambda: db.users['666'].set_bio(['test_head', 'not_a_member']),
+            lambda: db.users['42'].set_username('renamed_user2'),
+            lambda: db.users['69'].set_bio(['renamed_user2']),
+            lambda: db.users['666'].set_username('test_user2'),
+            lambda: [db.disable_user('8888')],
+            lambda: [db.add_user('7', 'not_a_member')],
+            lambda: [db.add_user('8888', 'end_user')],
+            lambda: db.users['420'].set_bio([]),
+            lambda: db.users['666'].set_username('TEST_HEAD'),
+        ]
+        for step in steps:
+            pending_changes = [change for change in step() if isinstance(change, changes.Base)]
+            db.handle_changes(pending_changes)
+
+            incremental_links = get_links(db)
+            db.update_links_from_bios()
+            assert incremental_links == get_links(db), (incremental_links, get_links(db))
+
+        assert db.usernames.get_collisions() == {'test_head': ['420', '666']}
+        assert db.usernames.get_id('test_head') == '666'
+
+        # a burst of joins is written once, and the file is the same as after a full save
+        db.flush(force=True)
+        db.save_delay = 60
+        for user_id in range(1000, 1010):
+            db.add_user(str(user_id), f'joined_user{user_id}')
+        assert '1000' not in db.storage.load()
+        assert not db.flush()
+        assert 0 < db.get_flush_delay() <= 60
+        assert db.flush(force=True)
+        assert not db.flush(force=True)
+        saved = db.storage.load()
+        assert len(saved) == len(db.users)
+        db.storage.save(db.users, db.matrix)
+        assert saved == db.storage.load()
+
+        # usernames nobody has are remembered, whoever claims one is linked to right away
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'example_db.json'), filename)
+        db = Database(filename)
+        db.update_best_chain('8888', rebuild_links=True)
+        db.handle_changes(db.users['666'].set_bio(['newcomer', 'some_channel']))
+        assert db.get_unresolved() == {'bio_chain': {'8888'}, 'newcomer': {'666'}, 'some_channel': {'666'}}
+        db.update_best_chain('8888')
+
+        db.add_user('5', 'Newcomer')
+        assert db.get_unresolved() == {'bio_chain': {'8888'}, 'some_channel': {'666'}}
+        # only the new link, the rest of the bio isn't relinked
+        assert db.matrix.changed_links == {('666', '5')}
+
+        # the first refresh of a new member rebuilds the chain even if it has nothing new to say
+        pending_changes = db.users['5'].apply_refresh('Newcomer', False, ['test_head'])
+        assert [type(change) for change in pending_changes] == [changes.Bio, changes.Joined]
+        db.handle_changes(pending_changes, '5')
+        db.update_best_chain('8888')
+        assert db.best_chain == ['666', '5', '420', '69', '42', '8888']
+        assert db.users['5'].apply_refresh('Newcomer', False, ['test_head']) == []
+        db.add_user('6', 'lurker')
+        assert [type(change) for change in db.users['6'].apply_refresh('lurker', False, [])] == [changes.Joined]
+
+        # renaming away releases the username again
+        db.users['5'].set_username('newcomer2')
+        db.update_username_index('5')
+        assert db.get_unresolved() == {'bio_chain': {'8888'}, 'newcomer': {'666'}, 'some_channel': {'666'}}
+        assert db.matrix.get_link_to('666', '5') is matrix.State.DEAD
+
+        # an unknown username is pointed out when it's added, not again on the next change
+        change = changes.Bio('666', db.users['666'].bio, ['newcomer', 'some_channel', 'other_channel'])
+        change.apply(db)
+        shout = change.shout(db)
+        assert '@other_channel' in shout and '@some_channel' not in shout, shout
+
+        # usernames that only disabled users link to aren't looked for, until they're back
+        db.users['666'].bio = ['newcomer', 'some_channel', 'other_channel']
+        unresolved = db.get_unresolved()
+        db.disable_user('666')
+        assert db.get_unresolved() == {'bio_chain': {'8888'}}
+        db.update_links_from_bios()
+        assert db.get_unresolved() == {'bio_chain': {'8888'}}
+        db.add_user('666', 'literally_satan')
+        assert db.get_unresolved() == unresolved
+
+    print('ok')
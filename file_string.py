@@ -1,29 +1,95 @@
+import os
+import time
+import threading
+import weakref
+
+
+# every FileString with a delay, so flush_all() can find them
+_delayed = weakref.WeakSet()
+
+
+def write_atomic(filename, data):
+    """Writes data to a temporary file and renames it over filename, so the file is never half written"""
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+        f.write(data)
+    os.replace(temp_filename, filename)
+
+
 class FileString:
-    """Wrapper for a string that is stored in a file"""
-    def __init__(self, filename):
+    """
+    Wrapper for a string that is stored in a file
+
+    The file is only written when the string changes. With a delay, writes are held back until
+    flush() is called at least delay seconds after the first unwritten set().
+    """
+    def __init__(self, filename, delay=0):
         self.filename = filename
+        self.delay = delay
         self.data = ''
+        self.written = ''
+        self.dirty_since = None
+        self.lock = threading.Lock()
         self.update()
+        if delay:
+            _delayed.add(self)
 
     def update(self):
         try:
             with open(self.filename) as f:
-                self.data = f.read()
+                self.data = self.written = f.read()
         except:
             pass
 
     def set(self, data):
-        self.data = str(data)
-        with open(self.filename, 'w') as f:
-            f.write(data)
+        with self.lock:
+            self.data = str(data)
+            if self.data == self.written:
+                self.dirty_since = None
+                return
+            if self.dirty_since is None:
+                self.dirty_since = time.monotonic()
+        if not self.delay:
+            self.flush(force=True)
 
     def get(self):
         return self.data
 
+    def get_flush_delay(self):
+        """Returns how many seconds until flush() will write, or None if there's nothing to write"""
+        with self.lock:
+            if self.dirty_since is None:
+                return None
+            return max(self.dirty_since + self.delay - time.monotonic(), 0)
+
+    def flush(self, force=False):
+        """Writes the string if it changed and the delay has passed, returns True if it was written"""
+        with self.lock:
+            if self.dirty_since is None:
+                return False
+            if not force and time.monotonic() < self.dirty_since + self.delay:
+                return False
+            write_atomic(self.filename, self.data)
+            self.written = self.data
+            self.dirty_since = None
+            return True
+
     def __str__(self):
         return self.data
 
 
+def flush_all(force=False):
+    """Flushes every FileString that has a delay"""
+    for file_string in list(_delayed):
+        file_string.flush(force)
+
+
+def get_flush_delay():
+    """Returns how many seconds until flush_all() will write something, or None"""
+    delays = [delay for delay in (file_string.get_flush_delay() for file_string in list(_delayed)) if delay is not None]
+    return min(delays, default=None)
+
+
 if __name__ == '__main__':
     test = FileString('test.txt')
     test.set('foobar')
@@ -31,5 +97,22 @@ if __name__ == '__main__':
     test = FileString('test.txt')
     assert test.get() == 'foobar'
 
+    # delayed writes are coalesced until flushed
+    delayed = FileString('test.txt', delay=60)
+    delayed.set('a')
+    delayed.set('b')
+    assert FileString('test.txt').get() == 'foobar'
+    assert 0 < get_flush_delay() <= 60
+    flush_all()
+    assert FileString('test.txt').get() == 'foobar'
+    flush_all(force=True)
+    assert FileString('test.txt').get() == 'b'
+    assert get_flush_delay() is None
+
+    # setting it back to what's in the file doesn't write anything
+    delayed.set('c')
+    delayed.set('b')
+    assert not delayed.flush(force=True)
+
     import os
     os.remove('test.txt')
@@ -0,0 +1,379 @@
+from concurrent.futures import wait
+from telegram.ext import MessageHandler, Filters
+import file_string
+from refresh import RefreshPool, PendingChanges
+from user import parse_bio
+from metrics import METRICS
+from util import *
+
+
+class GroupRefreshPool(RefreshPool):
+    """
+    RefreshPool for the users of several groups, each a ChainBot with its own Database
+
+    Expired users are taken from the groups in turn. A user that's in more than one group is
+    fetched once: when it expires in one group, it's also taken out of the schedule of every
+    group where it would expire in the next sync_window seconds, and the result is applied to
+    all of them. Their refreshes stay lined up from then on, so shared users cost one fetch
+    however many groups they're in.
+    """
+    def __init__(self, bot, groups, concurrency=8, bio_cache=None, sync_window=REFRESH_MIN_INTERVAL):
+        super().__init__(bot, concurrency, bio_cache)
+        self.groups = list(groups)
+        self.sync_window = sync_window
+        # user ID -> the groups its fetch is for
+        self.fetch_groups = {}
+        # which group submit_expired() looks at first, so every group gets its turn
+        self.next_group = 0
+
+    def busy(self, group=None):
+        """Returns True if any user is being fetched, for group if it's given"""
+        if group is None:
+            return bool(self.in_flight)
+        return bool(self.get_in_flight_ids(group))
+
+    def get_in_flight_ids(self, group):
+        """Returns the IDs of the users that are being fetched for group, or will be again once their fetch is done"""
+        in_flight_ids = {user_id for user_id, groups in self.fetch_groups.items() if group in groups}
+        in_flight_ids.update(user_id for chat_id, user_id in self.requeue if chat_id == group.chat_id)
+        return in_flight_ids
+
+    def _fetch_for(self, user_id, members):
+        """Runs in a worker thread, members is a list of (chat ID, MembershipCache, User) for every group"""
+        new_username = None
+        failed_in = set()
+        for chat_id, membership, user in members:
+            # usernames are the same in every chat, but the user may have left only some of them
+            username, fetch_failed = user.fetch_username(self.bot, membership, chat_id)
+            if new_username is None:
+                new_username = username
+            if fetch_failed:
+                failed_in.add(chat_id)
+
+        username = new_username if new_username is not None else members[0][2].username
+        if not username:
+            return new_username, failed_in, []
+
+        description, unchanged = self.bio_cache.fetch(self.session, username, user_id)
+        if description is None:
+            for chat_id, membership, user in members:
+                membership.invalidate(user_id)
+            return new_username, failed_in, None
+        # the cache only knows the page is the same as the last time anyone fetched it for this user
+        bio = members[0][2].bio
+        if unchanged and all(user.bio == bio for chat_id, membership, user in members):
+            return new_username, failed_in, bio
+        return new_username, failed_in, parse_bio(description, username)
+
+    def _submit_for(self, group, user_id):
+        if user_id in self.in_flight_ids:
+            # the fetch that's running might have looked the user up in this chat already, or not at all
+            self.requeue.add((group.chat_id, user_id))
+            return
+
+        groups = [group]
+        deadline = get_current_timestamp() + self.sync_window
+        for other in self.groups:
+            if other is not group and other.db.expiry.expires.get(user_id, deadline + 1) <= deadline:
+                other.db.expiry.remove(user_id)
+                groups.append(other)
+        METRICS.inc('biochain_shared_refreshes_total', len(groups) - 1)
+
+        print('updating', group.db.users[user_id].str_with_id(), f'in {len(groups)} groups' if len(groups) > 1 else '')
+        members = [(other.chat_id, other.membership, other.db.users[user_id]) for other in groups]
+        self.fetch_groups[user_id] = groups
+        self.in_flight.append((user_id, self.executor.submit(self._fetch_for, user_id, members)))
+        self.in_flight_ids.add(user_id)
+
+    def submit_expired(self, db=None):
+        """Starts fetching expired users of every group in turn until every worker is busy"""
+        remaining = self.groups[self.next_group:] + self.groups[:self.next_group]
+        self.next_group = (self.next_group + 1) % max(len(self.groups), 1)
+
+        while remaining and len(self.in_flight) < self.concurrency:
+            for group in list(remaining):
+                if len(self.in_flight) >= self.concurrency:
+                    break
+                user_id = group.db.pop_expired()
+                if user_id is None:
+                    remaining.remove(group)
+                else:
+                    self._submit_for(group, user_id)
+
+    def collect(self, db=None):
+        """
+        Applies every finished fetch that isn't waiting on an earlier one to every group it was for
+        Returns {group: list of changes}
+        """
+        collected = {}
+
+        while self.in_flight and self.in_flight[0][1].done():
+            user_id, future = self.in_flight.popleft()
+            self.in_flight_ids.remove(user_id)
+            groups = self.fetch_groups.pop(user_id)
+
+            METRICS.inc('biochain_refreshes_total')
+            try:
+                new_username, failed_in, new_bio = future.result()
+            except Exception as e:
+                print('  Failed to update', user_id, type(e), e)
+                METRICS.inc('biochain_refresh_errors_total')
+                new_username, failed_in, new_bio = None, (), None
+
+            for group in groups:
+                db = group.db
+                user = db.users[user_id]
+                if user.disabled:
+                    continue
+
+                fetch_failed = group.chat_id in failed_in
+                username = None if fetch_failed else new_username
+                changes = user.apply_refresh(username, fetch_failed, new_bio, db.is_near_chain(user_id))
+                db.handle_changes(changes, user_id)
+                collected.setdefault(group, []).extend(changes)
+
+            # the groups that wanted the user again while it was being fetched get a fetch of their own
+            for group in self.groups:
+                if (group.chat_id, user_id) in self.requeue:
+                    self.requeue.remove((group.chat_id, user_id))
+                    if not group.db.users[user_id].disabled:
+                        group.db.users[user_id].expires = 0
+
+        return collected
+
+    def refresh(self, db=None, timeout=1):
+        """
+        Waits up to timeout seconds for the oldest fetch to finish and applies what's done
+        Returns a tuple: ({group: list of changes}, True if any user is being updated)
+        """
+        self.submit_expired()
+        if not self.busy():
+            return {}, False
+
+        wait([self.in_flight[0][1]], timeout=timeout)
+        return self.collect(), True
+
+
+class Groups:
+    """
+    The ChainBots of every group hosted in this process, by chat ID
+
+    Updates go to the ChainBot of the chat they came from, and every group's chain is rebuilt
+    on its own as soon as its pending changes are ready (see PendingChanges).
+    """
+    def __init__(self, chain_bots):
+        self.chain_bots = {chain_bot.chat_id: chain_bot for chain_bot in chain_bots}
+        self.pending_changes = {chat_id: PendingChanges() for chat_id in self.chain_bots}
+
+    def __iter__(self):
+        return iter(self.chain_bots.values())
+
+    def __len__(self):
+        return len(self.chain_bots)
+
+    def add_handlers(self, dispatcher):
+        dispatcher.add_handler(MessageHandler(Filters.all, self.handle_update))
+
+    def handle_update(self, bot, update):
+        chain_bot = self.chain_bots.get(update.message.chat.id) if update.message else None
+        if chain_bot is not None:
+            chain_bot.handle_update(bot, update)
+
+    def on_tick(self):
+        """Writes whatever has waited long enough and updates the gauges of every group"""
+        for chat_id, chain_bot in self.chain_bots.items():
+            chain_bot.db.flush()
+            chain_bot.db.report_metrics(chat=str(chat_id))
+            chain_bot.build_queried_index()
+        file_string.flush_all()
+
+        outboxes = {id(chain_bot.outbox): chain_bot.outbox for chain_bot in self}
+        METRICS.set('biochain_outbox_pending', sum(outbox.pending() for outbox in outboxes.values()))
+
+    def refresh(self, refresh_pool):
+        """Runs a step of refresh_pool (a GroupRefreshPool), returns True if any user is being updated"""
+        collected, busy = refresh_pool.refresh()
+        for chain_bot, changes in collected.items():
+            in_flight_ids = refresh_pool.get_in_flight_ids(chain_bot)
+            self.pending_changes[chain_bot.chat_id].extend(changes, chain_bot.db, in_flight_ids)
+        return busy
+
+    def process_changes(self, refresh_pool):
+        """Rebuilds the chains of the groups whose changes are ready"""
+        for chat_id, pending_changes in self.pending_changes.items():
+            chain_bot = self.chain_bots[chat_id]
+            if pending_changes.is_ready(chain_bot.db, refresh_pool.get_in_flight_ids(chain_bot)):
+                chain_bot.process_changes(pending_changes.take())
+
+    def flush(self):
+        """Writes everything, for shutting down"""
+        for chain_bot in self:
+            chain_bot.db.flush(force=True)
+        file_string.flush_all(force=True)
+
+
+if __name__ == '__main__':
+    import os
+    import shutil
+    import tempfile
+    from types import SimpleNamespace
+    from database import Database
+    from membership import MembershipCache
+    from bio_cache import BioCache
+    from file_string import FileString
+    from bot import ChainBot
+
+    bios = {
+        'test_head': '@test_user',
+        'test_user': '@test_user2',
+        'test_user2': '@literally_satan',
+        'end_user': '@bio_chain',
+        'literally_satan': '@end_user',
+    }
+    usernames = {'420': 'test_head', '69': 'test_user', '42': 'test_user2', '8888': 'end_user', '666': 'literally_satan'}
+    requests_made = []
+    left = set()
+
+    class Response:
+        def __init__(self, body):
+            self.status_code = 200
+            self.ok = True
+            self.headers = {}
+            self.body = body
+
+        def iter_content(self, chunk_size):
+            yield self.body
+
+        def close(self):
+            pass
+
+    class Session:
+        def get(self, url, **kwargs):
+            username = url.rsplit('/', 1)[-1]
+            requests_made.append(('page', username))
+            return Response(f'<meta property="og:description" content="{bios[username]}">'.encode())
+
+        def close(self):
+            pass
+
+    class Bot:
+        def getChatMember(self, chat_id, user_id):
+            requests_made.append(('member', chat_id, user_id))
+            if (chat_id, user_id) in left:
+                return SimpleNamespace(user=SimpleNamespace(username=None), status='left')
+            return SimpleNamespace(user=SimpleNamespace(username=usernames[user_id]), status='member')
+
+    class Outbox:
+        def __init__(self):
+            self.calls = []
+
+        def call(self, func, *args, key=None, **kwargs):
+            self.calls.append((func.__name__, args))
+
+        def shout(self, texts, send, chat_id=CHAT_ID):
+            self.calls.extend(('shout', (text, chat_id)) for text in texts if text)
+
+        def pending(self):
+            return 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = Outbox()
+        chain_bots = []
+        for chat_id in (-1, -2):
+            group_directory = os.path.join(directory, str(-chat_id))
+            os.mkdir(group_directory)
+            filename = os.path.join(group_directory, 'db.json')
+            shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'), filename)
+            db = Database(filename, save_delay=0)
+            db.update_best_chain('8888', rebuild_links=True)
+            chain_bots.append(ChainBot(
+                db, outbox, MembershipCache(), '8888',
+                FileString(os.path.join(group_directory, 'chain_pages.json')),
+                FileString(os.path.join(group_directory, 'last_pin.txt')),
+                FileString(os.path.join(group_directory, 'last_chain.txt')),
+                chat_id=chat_id,
+            ))
+        groups = Groups(chain_bots)
+        # the second group only knows some of the users
+        chain_bots[1].db.disable_user('420')
+
+        pool = GroupRefreshPool(Bot(), groups, concurrency=2, bio_cache=BioCache(base_url='http://t.me'))
+        pool.session = Session()
+        while groups.refresh(pool) or pool.busy():
+            pass
+        groups.process_changes(pool)
+
+        # every user was fetched once, even the ones that are in both groups
+        pages = [request[1] for request in requests_made if request[0] == 'page']
+        assert sorted(pages) == sorted(usernames.values()), pages
+        # but the users in both groups were looked up in both chats
+        assert len([request for request in requests_made if request[0] == 'member']) == 9
+        for chain_bot in groups:
+            assert chain_bot.db.users['42'].bio == ['literally_satan']
+            assert chain_bot.db.get_expired_count() == 0 and not pool.busy(chain_bot)
+            assert not groups.pending_changes[chain_bot.chat_id]
+        assert chain_bots[0].db.best_chain == ['420', '69', '42', '666', '8888']
+        assert chain_bots[1].db.best_chain[1:] == ['69', '42', '666', '8888']
+        # both chains were posted, each to its own chat
+        posted = [args for name, args in outbox.calls if name == 'update_chain']
+        assert sorted(args[-1] for args in posted) == [-2, -1]
+
+        # a shared user due in both groups is still fetched once
+        requests_made.clear()
+        for chain_bot in groups:
+            chain_bot.db.users['69'].expires = 0
+        while groups.refresh(pool) or pool.busy():
+            pass
+        assert [request for request in requests_made if request[0] == 'page'] == [('page', 'test_user')]
+        assert METRICS.get('biochain_shared_refreshes_total') >= 4
+
+        # a user who left only one of the groups is only marked as failed there
+        requests_made.clear()
+        left.add((-2, '42'))
+        for chain_bot in groups:
+            chain_bot.membership.invalidate('42')
+            chain_bot.db.users['42'].expires = 0
+        while groups.refresh(pool) or pool.busy():
+            pass
+        assert sorted(request[1] for request in requests_made if request[0] == 'member') == [-2, -1]
+        assert chain_bots[1].db.users['42'].username_fetch_failed
+        assert not chain_bots[0].db.users['42'].username_fetch_failed
+        assert chain_bots[0].db.users['42'].username == chain_bots[1].db.users['42'].username == 'test_user2'
+
+        # a group that wants a user while it's being fetched for another one gets its own lookup afterwards
+        requests_made.clear()
+        left.clear()
+        left.add((-1, '42'))
+        for chain_bot in groups:
+            chain_bot.membership.invalidate('42')
+            chain_bot.db.users['42'].username_fetch_failed = False
+        chain_bots[1].db.users['42'].expires = get_current_timestamp() + 3600
+        chain_bots[0].db.users['42'].expires = 0
+        pool.submit_expired()
+        assert pool.fetch_groups['42'] == [chain_bots[0]]
+        chain_bots[1].db.users['42'].expires = 0
+        pool.submit_expired()
+        assert pool.busy(chain_bots[1]) and '42' in pool.get_in_flight_ids(chain_bots[1])
+        while groups.refresh(pool) or pool.busy():
+            pass
+        assert [request[1] for request in requests_made if request[0] == 'member'] == [-1, -2]
+        assert chain_bots[0].db.users['42'].username_fetch_failed
+        assert not chain_bots[1].db.users['42'].username_fetch_failed
+        assert not pool.requeue and not chain_bots[1].db.users['42'].is_expired()
+        left.clear()
+
+        # updates only reach the group of the chat they came from
+        update = SimpleNamespace(message=SimpleNamespace(
+            chat=SimpleNamespace(id=-2), text=None, forward_date=None, new_chat_members=[], left_chat_member=None,
+            from_user=SimpleNamespace(id=69, is_bot=False, username='test_user_renamed'),
+        ))
+        groups.handle_update(None, update)
+        assert chain_bots[1].membership.get('69') == ('test_user_renamed', False)
+        assert chain_bots[0].membership.get('69') == ('test_user', False)
+        assert chain_bots[1].db.users['69'].is_expired() and not chain_bots[0].db.users['69'].is_expired()
+
+        groups.on_tick()
+        assert METRICS.get('biochain_chain_length', chat='-1') == 5
+        pool.shutdown()
+
+    print('ok')
@@ -0,0 +1,154 @@
+"""
+Runs the refresh loop against stub_server.py and prints how it kept up as JSON: refreshes per second
+while every worker was busy, and how long bio edits took to reach the chain
+
+Every user starts out due for a refresh. Refresh intervals come from the usual
+tg_bot_biochain_refresh_* environment variables, lower them to see more edits noticed in a short run.
+"""
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import telegram
+from telegram.utils.request import Request
+import stub_server
+from changes import Bio
+from bio_cache import BioCache
+from database import Database
+from membership import MembershipCache
+from outbox import Outbox
+from refresh import RefreshPool, PendingChanges
+from process_refresh import ProcessRefreshPool
+from metrics import METRICS
+from file_string import FileString
+from bot import ChainBot
+
+
+def get_percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'p50': values[len(values) // 2],
+        'p90': values[int(len(values) * 0.9)],
+        'p99': values[int(len(values) * 0.99)],
+        'max': values[-1],
+    }
+
+
+def run(args, directory):
+    stub = stub_server.from_arguments(args).start()
+    population = stub.population
+    bot_api_url = stub.url + '/bot'
+
+    data = population.data
+    for user_data in data.values():
+        user_data['expires'] = 0
+    filename = os.path.join(directory, 'db.json')
+    with open(filename, 'w') as f:
+        json.dump(data, f)
+    db = Database(filename)
+    db.update_best_chain(population.end_node, rebuild_links=True)
+
+    token = '123:stub'
+    bot = telegram.Bot(token, base_url=bot_api_url, request=Request(con_pool_size=args.workers + 4))
+    membership = MembershipCache()
+    outbox = Outbox(bot)
+    chain_bot = ChainBot(
+        db, outbox, membership, population.end_node,
+        FileString(os.path.join(directory, 'chain_pages.json')),
+        FileString(os.path.join(directory, 'last_pin.txt')),
+        FileString(os.path.join(directory, 'last_chain.txt')),
+    )
+    if args.processes:
+        refresh_pool = ProcessRefreshPool(token, args.processes, membership=membership,
+                                          tme_url=stub.url, bot_api_url=bot_api_url)
+    else:
+        refresh_pool = RefreshPool(bot, args.workers, BioCache(base_url=stub.url), membership)
+
+    refreshes_before = METRICS.get('biochain_refreshes_total')
+    rebuilds_before = METRICS.get('biochain_phase_seconds', phase='update_best_chain')
+    backlog = None
+    lags = []
+    pending_changes = PendingChanges()
+    start = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        changes, busy = refresh_pool.refresh(db)
+        if not busy:
+            time.sleep(0.05)
+        pending_changes.extend(changes, db, refresh_pool.in_flight_ids)
+
+        if backlog is None and db.get_expired_count() == 0 and not refresh_pool.busy():
+            backlog = time.monotonic() - start, METRICS.get('biochain_refreshes_total') - refreshes_before
+        if not pending_changes.is_ready(db, refresh_pool.in_flight_ids):
+            continue
+
+        changes = pending_changes.take()
+        edited_ids = [change.user_id for change in changes if isinstance(change, Bio)]
+        chain_bot.process_changes(changes)
+        now = time.monotonic()
+        for user_id in edited_ids:
+            edited_at = population.pop_edit(user_id)
+            if edited_at is not None:
+                lags.append(now - edited_at)
+
+    elapsed = time.monotonic() - start
+    refresh_pool.shutdown()
+    outbox.close(1)
+    stub.stop()
+
+    refreshes = METRICS.get('biochain_refreshes_total') - refreshes_before
+    return {
+        'users': args.users,
+        'concurrency': refresh_pool.concurrency,
+        'processes': args.processes,
+        'seconds': elapsed,
+        'refreshes': refreshes,
+        'refreshes_per_second': refreshes / elapsed,
+        # how fast the first round of refreshes went, with every worker busy the whole time
+        'backlog': {
+            'seconds': backlog[0],
+            'refreshes': backlog[1],
+            'refreshes_per_second': backlog[1] / backlog[0],
+        } if backlog else None,
+        'chain_rebuilds': METRICS.get('biochain_phase_seconds', phase='update_best_chain') - rebuilds_before,
+        'bio_edits': population.edit_count,
+        'edits_noticed': len(lags),
+        'detection_lag': get_percentiles(lags),
+        'requests': stub.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests refreshing against stub_server.py')
+    stub_server.add_arguments(parser)
+    parser.add_argument('--seconds', type=float, default=60, help='how long to run')
+    parser.add_argument('--workers', type=int, default=8, help='refresh threads')
+    parser.add_argument('--processes', type=int, default=0, help='refresh worker processes instead of threads')
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # the Database and the refreshes print progress that would mix with the JSON
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = run(args, directory)
+
+    report = json.dumps({
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': int(time.time()),
+        'result': result,
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from enum import Enum
+from array import array
 
 from collections import defaultdict
 
@@ -20,6 +21,10 @@ class LinkMatrix:
     def __init__(self):
         self.links_to = self.__new_empty()
         self.links_from = self.__new_empty()
+        # (linker, linked) pairs whose state changed since the last pop_changed_links()
+        self.changed_links = set()
+        # linkers whose links changed since the last pop_dirty_linkers()
+        self.dirty_linkers = set()
 
     def __new_empty(self):
         return defaultdict(
@@ -38,12 +43,27 @@ class LinkMatrix:
         return count
 
     def set_link_to(self, linker, linked, state):
+        if self.links_to[linker][linked] is not state:
+            self._mark_changed(linker, linked)
         self.links_to[linker][linked] = state
         self.links_from[linked][linker] = state
 
     def set_link_from(self, linked, linker, state):
-        self.links_from[linked][linker] = state
-        self.links_to[linker][linked] = state
+        self.set_link_to(linker, linked, state)
+
+    def _mark_changed(self, linker, linked):
+        self.changed_links.add((linker, linked))
+        self.dirty_linkers.add(linker)
+
+    def pop_changed_links(self):
+        changed_links = self.changed_links
+        self.changed_links = set()
+        return changed_links
+
+    def pop_dirty_linkers(self):
+        dirty_linkers = self.dirty_linkers
+        self.dirty_linkers = set()
+        return dirty_linkers
 
     def get_link_to(self, linker, linked):
         return self.links_to[linker][linked]
@@ -66,9 +86,8 @@ class LinkMatrix:
 
     def has_link_like(self, linker, state=State.REAL):
         """Returns True if linker has a link that is the same as state"""
-        for linked in self.links_to[linker]:
-            if self.links_to[linker][linked] is state:
-                return True
+        for linked in self.get_links_to(linker, lambda l: l is state):
+            return True
         return False
 
     def get_chains_ending_on(self, end_node):
@@ -108,7 +127,7 @@ class LinkMatrix:
         """Returns true if all links in chain are equal to state"""
         for i in range(1, len(chain)):
             this_node, next_node = chain[i-1], chain[i]
-            if self.links_to[this_node][next_node] is not state:
+            if self.get_link_to(this_node, next_node) is not state:
                 return False
 
         return True
@@ -118,7 +137,7 @@ class LinkMatrix:
 
         for i in range(1, len(chain)):
             this_node, next_node = chain[i-1], chain[i]
-            count[self.links_to[this_node][next_node]] += 1
+            count[self.get_link_to(this_node, next_node)] += 1
 
         return count
 
@@ -134,23 +153,188 @@ class LinkMatrix:
         return i1, i2
 
 
-if __name__ == '__main__':
-    matrix = LinkMatrix()
+class CompactLinkMatrix(LinkMatrix):
+    """
+    Same interface as LinkMatrix, but node IDs are interned to ints and every node's links
+    are kept in typed arrays. Reading a link that doesn't exist never adds anything.
+
+    A node's links are packed into one int each: (linked node << 2) | (state + 1)
+    """
+    _states = {state.value + 1: state for state in State}
+
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+        # per node: packed links to other nodes, and the nodes that link to it (None if there are none)
+        self.out_links = []
+        self.in_ids = []
+        # (linker, linked) pairs whose state changed since the last pop_changed_links()
+        self.changed_links = set()
+        # linkers whose links changed since the last pop_dirty_linkers()
+        self.dirty_linkers = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __intern(self, node):
+        i = self.index.get(node)
+        if i is None:
+            i = len(self.ids)
+            self.index[node] = i
+            self.ids.append(node)
+            self.out_links.append(None)
+            self.in_ids.append(None)
+        return i
+
+    def __find(self, linker_i, linked_i):
+        """Returns the position of linked_i in linker_i's links, or -1"""
+        out_links = self.out_links[linker_i]
+        if out_links is not None:
+            for pos, packed in enumerate(out_links):
+                if packed >> 2 == linked_i:
+                    return pos
+        return -1
+
+    def replace(self, state, new_state):
+        found = []
+        for linker_i, out_links in enumerate(self.out_links):
+            if out_links is None:
+                continue
+            for packed in out_links:
+                if packed & 3 == state.value + 1:
+                    found.append((self.ids[linker_i], self.ids[packed >> 2]))
+
+        for linker, linked in found:
+            self.set_link_to(linker, linked, new_state)
+        return len(found)
 
-    matrix.set_link_to('A', 'B', State.REAL)
-    assert matrix.get_link_from('B', 'A') == State.REAL
-    assert matrix.get_link_from('B', 'A') == matrix.get_link_to('A', 'B')
+    def set_link_to(self, linker, linked, state):
+        if state is State.NONE:
+            linker_i, linked_i = self.index.get(linker), self.index.get(linked)
+            if linker_i is None or linked_i is None:
+                return
+            pos = self.__find(linker_i, linked_i)
+            if pos < 0:
+                return
+            del self.out_links[linker_i][pos]
+            self.in_ids[linked_i].remove(linker_i)
+            self._mark_changed(linker, linked)
+            return
+
+        linker_i, linked_i = self.__intern(linker), self.__intern(linked)
+        packed = linked_i << 2 | (state.value + 1)
+        pos = self.__find(linker_i, linked_i)
+        if pos < 0:
+            if self.out_links[linker_i] is None:
+                self.out_links[linker_i] = array('q')
+            if self.in_ids[linked_i] is None:
+                self.in_ids[linked_i] = array('q')
+            self.out_links[linker_i].append(packed)
+            self.in_ids[linked_i].append(linker_i)
+            self._mark_changed(linker, linked)
+        elif self.out_links[linker_i][pos] != packed:
+            self.out_links[linker_i][pos] = packed
+            self._mark_changed(linker, linked)
 
-    matrix.set_link_to('A', 'C', State.REAL)
-    matrix.set_link_to('B', 'C', State.REAL)
-    matrix.set_link_to('C', 'D', State.REAL)
-    matrix.set_link_to('Q', 'D', State.REAL)
-    # A -> B -> C -> D
-    #  \_______/
+    def set_link_from(self, linked, linker, state):
+        self.set_link_to(linker, linked, state)
 
-    chains = matrix.get_chains_ending_on('D')
+    def get_link_to(self, linker, linked):
+        linker_i, linked_i = self.index.get(linker), self.index.get(linked)
+        if linker_i is None or linked_i is None:
+            return State.NONE
+        pos = self.__find(linker_i, linked_i)
+        if pos < 0:
+            return State.NONE
+        return self._states[self.out_links[linker_i][pos] & 3]
 
-    print(chains)
-    print(matrix.chain_get_merge_points(chains[0], chains[1]))
+    def get_link_from(self, linked, linker):
+        return self.get_link_to(linker, linked)
 
-    print(matrix.chain_tally(chains[0]))
+    def get_links_to(self, linker, filter=lambda l: l is not State.NONE):
+        """yields nodes that the linker links to that match filter"""
+        linker_i = self.index.get(linker)
+        if linker_i is None or self.out_links[linker_i] is None:
+            return
+        for packed in self.out_links[linker_i]:
+            if filter(self._states[packed & 3]):
+                yield self.ids[packed >> 2]
+
+    def get_links_from(self, linked, filter=lambda l: l is not State.NONE):
+        """yields nodes that linked is linked from that match filter"""
+        linked_i = self.index.get(linked)
+        if linked_i is None or self.in_ids[linked_i] is None:
+            return
+        for linker_i in self.in_ids[linked_i]:
+            pos = self.__find(linker_i, linked_i)
+            if filter(self._states[self.out_links[linker_i][pos] & 3]):
+                yield self.ids[linker_i]
+
+
+if __name__ == '__main__':
+    import random
+    import time
+    import tracemalloc
+
+    for matrix_class in (LinkMatrix, CompactLinkMatrix):
+        matrix = matrix_class()
+
+        matrix.set_link_to('A', 'B', State.REAL)
+        assert matrix.get_link_from('B', 'A') == State.REAL
+        assert matrix.get_link_from('B', 'A') == matrix.get_link_to('A', 'B')
+
+        matrix.set_link_to('A', 'C', State.REAL)
+        matrix.set_link_to('B', 'C', State.REAL)
+        matrix.set_link_to('C', 'D', State.REAL)
+        matrix.set_link_to('Q', 'D', State.REAL)
+        # A -> B -> C -> D
+        #  \_______/
+
+        chains = matrix.get_chains_ending_on('D')
+
+        print(chains)
+        print(matrix.chain_get_merge_points(chains[0], chains[1]))
+
+        print(matrix.chain_tally(chains[0]))
+
+        assert matrix.replace(State.REAL, State.DEAD) == 5
+        matrix.set_link_to('A', 'B', State.REAL)
+        assert matrix.replace(State.DEAD, State.NONE) == 4
+        assert list(matrix.get_links_to('A')) == ['B']
+        assert list(matrix.get_links_from('D')) == []
+
+    # reading links that don't exist doesn't grow the compact matrix
+    matrix = CompactLinkMatrix()
+    assert matrix.get_link_to('X', 'Y') is State.NONE
+    assert list(matrix.get_links_from('X')) == []
+    assert len(matrix) == 0
+
+    # memory and throughput compared to LinkMatrix
+    rng = random.Random(0)
+    node_count = 20000
+    links = [
+        (str(rng.randrange(10**9)), str(rng.randrange(10**9)), rng.choice([State.REAL, State.DEAD]))
+        for _ in range(node_count * 2)
+    ]
+    for matrix_class in (LinkMatrix, CompactLinkMatrix):
+        tracemalloc.start()
+        start = time.perf_counter()
+        matrix = matrix_class()
+        for linker, linked, state in links:
+            matrix.set_link_to(linker, linked, state)
+        build_time = time.perf_counter() - start
+        matrix.pop_changed_links()
+        memory = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        for linker, linked, state in links:
+            matrix.get_link_to(linker, linked)
+            matrix.get_link_to(linked, linker)
+        read_time = time.perf_counter() - start
+        grown = tracemalloc.get_traced_memory()[0] - memory
+        tracemalloc.stop()
+
+        print('{}: {:.1f} MiB, build {:.0f} ms, {} reads {:.0f} ms (+{:.1f} MiB after reads)'.format(
+            matrix_class.__name__, memory / 2**20, build_time * 1000,
+            len(links) * 2, read_time * 1000, grown / 2**20
+        ))
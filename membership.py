@@ -0,0 +1,86 @@
+import threading
+from util import *
+
+
+class MembershipCache:
+    """
+    Remembers the username and membership of users seen in the chat's updates
+
+    Joins, leaves and messages keep the entries fresh, so refreshing a user only needs
+    getChatMember when it hasn't been seen in the last ttl seconds. Safe to share
+    between refresh worker threads.
+    """
+    def __init__(self, ttl=MEMBERSHIP_TTL):
+        self.ttl = ttl
+        # user ID -> (username, True if the user left, timestamp of when it was seen)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def observe(self, user_id, username, left=False, now=None):
+        """Records what an update or getChatMember said about the user, returns the username it had before or None"""
+        with self.lock:
+            old_entry = self.entries.get(user_id)
+            self.entries[user_id] = (username, left, now or get_current_timestamp())
+        return old_entry[0] if old_entry else None
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def get(self, user_id, now=None):
+        """Returns a tuple: (username, True if the user left) or None if it hasn't been seen in the last ttl seconds"""
+        now = now or get_current_timestamp()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[2] + self.ttl < now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[:2]
+
+    def prune(self, now=None):
+        """Forgets the entries that are too old to be used, returns how many were removed"""
+        now = now or get_current_timestamp()
+        with self.lock:
+            stale = [user_id for user_id, entry in self.entries.items() if entry[2] + self.ttl < now]
+            for user_id in stale:
+                del self.entries[user_id]
+        return len(stale)
+
+
+if __name__ == '__main__':
+    cache = MembershipCache(ttl=100)
+    assert cache.get('1', now=1000) is None
+
+    assert cache.observe('1', 'alice', now=1000) is None
+    assert cache.get('1', now=1050) == ('alice', False)
+    assert cache.get('1', now=1101) is None
+
+    # a message with a new username refreshes the entry and tells the caller it changed
+    assert cache.observe('1', 'alice2', now=1100) == 'alice'
+    assert cache.get('1', now=1150) == ('alice2', False)
+
+    cache.observe('1', 'alice2', left=True, now=1150)
+    assert cache.get('1', now=1160) == ('alice2', True)
+
+    cache.invalidate('1')
+    assert cache.get('1', now=1160) is None
+
+    cache.observe('2', 'bob', now=1000)
+    cache.observe('3', 'carol', now=1200)
+    assert cache.prune(now=1250) == 1
+    assert len(cache) == 1
+
+    assert cache.stats() == {'entries': 1, 'hits': 3, 'misses': 3}
+
+    print('ok')
@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+import functools
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms kept in memory and rendered in the Prometheus text format
+
+    Every metric is identified by its name and keyword labels. Updates only take a lock and
+    change a number, so they are cheap enough to leave on everywhere.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (name, sorted label pairs) -> value
+        self.counters = {}
+        self.gauges = {}
+        # (name, sorted label pairs) -> [count per bucket, sum, count]
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Observes how many seconds the with block took"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        """Returns the value of a counter or gauge, or the count of a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key in self.histograms:
+                return self.histograms[key][2]
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def get_histograms(self, name):
+        """Returns {sorted label pairs: (count, sum)} for every histogram called name"""
+        with self.lock:
+            return {
+                labels: (count, total)
+                for (histogram_name, labels), (counts, total, count) in self.histograms.items()
+                if histogram_name == name
+            }
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                last_name = None
+                for (name, labels), value in sorted(values.items()):
+                    if name != last_name:
+                        lines.append(f'# TYPE {name} {kind}')
+                        last_name = name
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+            last_name = None
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append(f'# TYPE {name} histogram')
+                    last_name = name
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(total)}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        """Writes render() to filename, replacing it at once so readers never see half a file"""
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(self.render())
+        os.replace(temp_filename, filename)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves render() over HTTP from a background thread, returns the server"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        print(f'Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+        return server
+
+
+# shared by everything in the process
+METRICS = Metrics()
+
+
+def timed(name, **labels):
+    """Decorator that observes how many seconds every call takes in METRICS"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.time(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+    import tempfile
+    import urllib.request
+
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.inc('biochain_changes_total', type='Bio')
+    metrics.inc('biochain_changes_total', 2, type='Bio')
+    metrics.inc('biochain_changes_total', type='Username')
+    metrics.set('biochain_users', 42)
+    metrics.observe('biochain_phase_seconds', 0.05, phase='save')
+    metrics.observe('biochain_phase_seconds', 0.5, phase='save')
+    metrics.observe('biochain_phase_seconds', 5, phase='save')
+    with metrics.time('biochain_phase_seconds', phase='refresh'):
+        pass
+
+    assert metrics.get('biochain_changes_total', type='Bio') == 3
+    assert metrics.get('biochain_phase_seconds', phase='save') == 3
+    assert metrics.get_histograms('biochain_phase_seconds')[(('phase', 'save'),)] == (3, 5.55)
+
+    text = metrics.render()
+    assert '# TYPE biochain_changes_total counter\n' in text
+    assert 'biochain_changes_total{type="Bio"} 3\n' in text
+    assert 'biochain_users 42\n' in text
+    assert 'biochain_phase_seconds_bucket{phase="save",le="0.1"} 1\n' in text
+    assert 'biochain_phase_seconds_bucket{phase="save",le="1"} 2\n' in text
+    assert 'biochain_phase_seconds_bucket{phase="save",le="+Inf"} 3\n' in text
+    assert 'biochain_phase_seconds_sum{phase="save"} 5.55\n' in text
+    assert text.count('# TYPE biochain_phase_seconds histogram') == 1
+    assert format_labels([('name', 'a"b\\c')]) == '{name="a\\"b\\\\c"}'
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'metrics.prom')
+        metrics.dump(filename)
+        with open(filename) as f:
+            assert f.read() == text
+
+    server = metrics.serve(0)
+    with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as r:
+        assert r.read().decode() == metrics.render()
+    server.shutdown()
+
+    print('ok')
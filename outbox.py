@@ -0,0 +1,280 @@
+import time
+import threading
+from collections import deque
+import telegram
+from util import *
+from metrics import METRICS
+
+
+def is_outside_tags(line, i):
+    """Returns True if line[i] isn't inside an HTML tag or between the tags of an element like a mention"""
+    last_tag = line.rfind('<', 0, i)
+    return last_tag == -1 or line.startswith('</', last_tag) and line.find('>', last_tag) < i
+
+
+def split_line(line, limit=MESSAGE_LIMIT):
+    """Splits line into pieces of at most limit characters, between words outside of HTML where it can"""
+    pieces = []
+    while len(line) > limit:
+        space = line.rfind(' ', 0, limit + 1)
+        while space > 0 and not is_outside_tags(line, space):
+            space = line.rfind(' ', 0, space)
+        if space > 0:
+            pieces.append(line[:space])
+            line = line[space + 1:]
+        else:
+            pieces.append(line[:limit])
+            line = line[limit:]
+    pieces.append(line)
+    return pieces
+
+
+def coalesce(texts, limit=MESSAGE_LIMIT, sep='\n'):
+    """
+    Joins texts in order into as few messages as possible that each fit in limit characters, skipping blank ones
+    Texts that are too long on their own are split between lines, and lines that are still too long between words
+    """
+    lines = []
+    for text in texts:
+        if text and len(text) > limit:
+            for line in text.split(sep):
+                lines.extend(split_line(line, limit))
+        else:
+            lines.append(text)
+
+    messages = []
+    current = ''
+    for text in lines:
+        if not text:
+            continue
+        if current and len(current) + len(sep) + len(text) <= limit:
+            current += sep + text
+            continue
+        if current:
+            messages.append(current)
+        current = text
+    if current:
+        messages.append(current)
+    return messages
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, with bursts of up to burst calls"""
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock()
+        self.paused_until = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return now
+
+    def get_wait(self):
+        """Returns how many seconds to wait before the next call is allowed"""
+        now = self._refill()
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Blocks every call for seconds, for when the Bot API tells us to back off"""
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+        self.tokens = 0
+
+
+class ThrottledBot:
+    """Passes Bot API calls through to bot once the token bucket of their chat_id allows it"""
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def __getattr__(self, name):
+        method = getattr(self.outbox.bot, name)
+        if not callable(method):
+            return method
+
+        def throttled(*args, **kwargs):
+            bucket = self.outbox.get_bucket(kwargs.get('chat_id', args[0] if args else None))
+            while True:
+                wait = bucket.get_wait()
+                while wait > 0:
+                    self.outbox.sleep(wait)
+                    wait = bucket.get_wait()
+                bucket.take()
+
+                METRICS.inc('biochain_api_calls_total', method=name)
+                try:
+                    return method(*args, **kwargs)
+                except telegram.error.RetryAfter as e:
+                    print(f'Flood limit hit, waiting {e.retry_after}s')
+                    METRICS.inc('biochain_flood_waits_total')
+                    bucket.pause(e.retry_after)
+
+        return throttled
+
+
+class Outbox:
+    """
+    Sends messages from a background thread so the main loop never waits on the Bot API
+
+    Jobs are functions that are called with a ThrottledBot in the order they were queued.
+    Queuing a job with the key of one that hasn't run yet replaces the old one's arguments,
+    so only the latest chain text is posted.
+    """
+    def __init__(self, bot, rate=OUTBOX_RATE, burst=OUTBOX_BURST, clock=time.monotonic, sleep=time.sleep):
+        self.bot = bot
+        self.throttled_bot = ThrottledBot(self)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+
+        # [func, args, kwargs] lists, keyed ones are also in self.keyed so they can be replaced
+        self.jobs = deque()
+        self.keyed = {}
+        self.running_job = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self.thread.start()
+
+    def get_bucket(self, chat_id):
+        with self.condition:
+            if chat_id not in self.buckets:
+                self.buckets[chat_id] = TokenBucket(self.rate, self.burst, self.clock)
+            return self.buckets[chat_id]
+
+    def call(self, func, *args, key=None, **kwargs):
+        """Queues func(throttled bot, *args, **kwargs), replacing the queued job with the same key if there is one"""
+        with self.condition:
+            if self.closed:
+                print('Outbox is closed, dropping', func.__name__)
+                return
+
+            if key is not None and key in self.keyed:
+                self.keyed[key][1:] = [args, kwargs]
+                return
+
+            job = [func, args, kwargs]
+            self.jobs.append((key, job))
+            if key is not None:
+                self.keyed[key] = job
+            self.condition.notify_all()
+
+    def shout(self, texts, send, chat_id=CHAT_ID):
+        """Queues send(bot, message, chat_id) for texts coalesced into as few messages as possible"""
+        for message in coalesce(texts):
+            self.call(send, message, chat_id)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.closed:
+                    self.condition.wait()
+                if not self.jobs:
+                    return
+
+                key, (func, args, kwargs) = self.jobs.popleft()
+                if key is not None:
+                    del self.keyed[key]
+                self.running_job = True
+
+            try:
+                with METRICS.time('biochain_outbox_job_seconds', job=func.__name__):
+                    func(self.throttled_bot, *args, **kwargs)
+            except Exception as e:
+                print('Outbox failed to run', func.__name__, type(e), e)
+            finally:
+                with self.condition:
+                    self.running_job = False
+                    self.condition.notify_all()
+
+    def pending(self):
+        with self.condition:
+            return len(self.jobs) + self.running_job
+
+    def drain(self, timeout=None):
+        """Waits until everything queued so far has been sent, returns False if timeout ran out first"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.jobs and not self.running_job, timeout)
+
+    def close(self, timeout=None):
+        """Sends what's left and stops the sender thread, nothing can be queued afterwards"""
+        drained = self.drain(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return drained
+
+
+if __name__ == '__main__':
+    assert coalesce(['a', '', 'b', None, 'c']) == ['a\nb\nc']
+    assert coalesce(['a' * 3000, 'b' * 1000, 'c' * 1000]) == ['a' * 3000 + '\n' + 'b' * 1000, 'c' * 1000]
+    assert coalesce(['a' * 3000 + '\n' + 'b' * 3000, 'c']) == ['a' * 3000, 'b' * 3000 + '\nc']
+    # a single line that's too long is split between words, or anywhere if it has to be
+    assert coalesce(['a' * 5000]) == ['a' * 4096, 'a' * 904]
+    for name in ('some user', 'a much longer name with lots of spaces in it'):
+        mention = get_html_mention(1, name)
+        messages = coalesce([' '.join([mention] * 500)])
+        assert len(messages) > 1 and all(len(message) <= MESSAGE_LIMIT for message in messages)
+        assert ' '.join(messages) == ' '.join([mention] * 500)
+        assert all(message.startswith('<a ') and message.endswith('</a>') for message in messages)
+
+    now = [0]
+    bucket = TokenBucket(rate=0.5, burst=2, clock=lambda: now[0])
+    for _ in range(2):
+        assert bucket.get_wait() == 0
+        bucket.take()
+    assert bucket.get_wait() == 2
+    now[0] = 2
+    assert bucket.get_wait() == 0
+    bucket.pause(10)
+    assert bucket.get_wait() == 10
+
+    class Bot:
+        def __init__(self):
+            self.calls = []
+            self.release = threading.Event()
+            self.flooded = False
+
+        def sendMessage(self, chat_id, text, **kwargs):
+            self.release.wait()
+            if text == 'flood' and not self.flooded:
+                self.flooded = True
+                raise telegram.error.RetryAfter(0.01)
+            self.calls.append((chat_id, text))
+
+    def send(bot, text, chat_id=CHAT_ID):
+        bot.sendMessage(chat_id=chat_id, text=text)
+
+    bot = Bot()
+    outbox = Outbox(bot, rate=1000, burst=1000)
+    outbox.call(send, 'first')
+    # consecutive chain edits queued while the sender is busy are merged
+    for i in range(5):
+        outbox.call(send, f'chain {i}', key='chain')
+    outbox.shout(['shout 1', 'shout 2', ''], send)
+    outbox.call(send, 'flood', chat_id=1)
+    bot.release.set()
+    assert outbox.drain(timeout=5)
+    assert bot.calls == [
+        (CHAT_ID, 'first'), (CHAT_ID, 'chain 4'), (CHAT_ID, 'shout 1\nshout 2'), (1, 'flood')
+    ]
+
+    assert outbox.close(timeout=5)
+    assert not outbox.thread.is_alive()
+    outbox.call(send, 'too late')
+    assert outbox.pending() == 0
+
+    print('ok')
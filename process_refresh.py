@@ -0,0 +1,272 @@
+import zlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+import requests
+from refresh import RefreshPool
+from bio_cache import BioCache
+from membership import MembershipCache
+from metrics import METRICS
+from user import User
+from util import *
+
+
+def get_shard(user_id, shard_count):
+    """The same user always goes to the same worker, so its caches stay useful"""
+    return zlib.crc32(user_id.encode()) % shard_count
+
+
+def worker_main(token, tme_url, bot_api_url, jobs, results):
+    """
+    Runs in a worker process: fetches batches of (user ID, username, bio, cached membership or None)
+    and puts back batches of (user ID, new username, True if the username fetch failed, new bio, error or None)
+    """
+    import telegram
+    bot = telegram.Bot(token, base_url=bot_api_url) if token else None
+    session = requests.Session()
+    bio_cache = BioCache(base_url=tme_url)
+    membership = MembershipCache()
+
+    while True:
+        batch = jobs.get()
+        if batch is None:
+            break
+
+        records = []
+        for user_id, username, bio, cached in batch:
+            user = User(user_id, {'username': username, 'bio': bio})
+            try:
+                if cached is not None:
+                    membership.observe(user_id, *cached)
+                new_username, fetch_failed = user.fetch_username(bot, membership)
+                new_bio = user.fetch_bio(new_username, session, bio_cache)
+                if new_bio is None:
+                    membership.invalidate(user_id)
+                records.append((user_id, new_username, fetch_failed, new_bio, None))
+            except Exception as e:
+                records.append((user_id, None, False, None, f'{type(e).__name__}: {e}'))
+        results.put(records)
+
+    session.close()
+
+
+class ProcessRefreshPool(RefreshPool):
+    """
+    RefreshPool that fetches and parses in worker processes instead of threads, so it isn't held back by the GIL
+
+    This process keeps the Database and the schedule. Expired users are sharded over the workers and sent
+    in batches, the workers only send back what they fetched, and the changes are made here by
+    collect() like they are for threads.
+    """
+    def __init__(self, token, workers=4, batch_size=8, membership=None, tme_url=TME_URL, bot_api_url=BOT_API_URL):
+        self.workers = workers
+        self.membership = membership
+        self.concurrency = workers * batch_size
+        self.batch_size = batch_size
+        self.worker_args = (token, tme_url, bot_api_url)
+
+        self.in_flight = deque()
+        self.in_flight_ids = set()
+        self.requeue = set()
+
+        self.batches = [[] for _ in range(workers)]
+        self.futures = {}
+        # per worker: the user IDs it was sent and hasn't answered yet
+        self.outstanding = [set() for _ in range(workers)]
+        self.futures_lock = threading.Lock()
+
+        # spawned so the workers don't inherit the bot's threads
+        self.context = multiprocessing.get_context('spawn')
+        # every worker gets its own queues, a worker that dies while writing can't block the others
+        self.job_queues = [None] * workers
+        self.result_queues = [None] * workers
+        self.processes = [None] * workers
+        self.readers = [None] * workers
+        for shard in range(workers):
+            self._start_worker(shard)
+
+    def _start_worker(self, shard):
+        jobs = self.context.Queue()
+        results = self.context.Queue()
+        process = self.context.Process(target=worker_main, args=(*self.worker_args, jobs, results), daemon=True)
+        process.start()
+        reader = threading.Thread(target=self._read_results, args=(shard, results), name='refresh results', daemon=True)
+        reader.start()
+
+        self.job_queues[shard] = jobs
+        self.result_queues[shard] = results
+        self.processes[shard] = process
+        self.readers[shard] = reader
+
+    def check_workers(self):
+        """Fails what dead workers were fetching and starts new ones in their place, call it from the main loop"""
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+
+            print(f'Refresh worker {shard} died (exit code {process.exitcode}), starting a new one')
+            METRICS.inc('biochain_refresh_worker_restarts_total')
+            # whatever it sent before dying is still read, the rest won't ever come
+            self.result_queues[shard].put(None)
+            with self.futures_lock:
+                lost = [(user_id, self.futures.pop(user_id, None)) for user_id in self.outstanding[shard]]
+                self.outstanding[shard] = set()
+            for user_id, future in lost:
+                if future is not None:
+                    future.set_exception(RuntimeError(f'refresh worker died with exit code {process.exitcode}'))
+            self._start_worker(shard)
+
+    def _submit(self, user):
+        cached = self.membership.get(user.id) if self.membership is not None else None
+        future = Future()
+        shard = get_shard(user.id, self.workers)
+        with self.futures_lock:
+            self.futures[user.id] = future
+            self.outstanding[shard].add(user.id)
+
+        self.batches[shard].append((user.id, user.username, user.bio, cached))
+        if len(self.batches[shard]) >= self.batch_size:
+            self._send(shard)
+        return future
+
+    def _send(self, shard):
+        METRICS.inc('biochain_refresh_batches_total')
+        self.job_queues[shard].put(self.batches[shard])
+        self.batches[shard] = []
+
+    def _flush(self):
+        for shard, batch in enumerate(self.batches):
+            if batch:
+                self._send(shard)
+
+    def _read_results(self, shard, results):
+        while True:
+            records = results.get()
+            if records is None:
+                break
+
+            for user_id, new_username, fetch_failed, new_bio, error in records:
+                with self.futures_lock:
+                    future = self.futures.pop(user_id, None)
+                    self.outstanding[shard].discard(user_id)
+                if future is None:
+                    continue
+                if error is not None:
+                    future.set_exception(RuntimeError(error))
+                    continue
+                if new_bio is None and self.membership is not None:
+                    # the cached username might be out of date, ask the Bot API next time
+                    self.membership.invalidate(user_id)
+                future.set_result((new_username, fetch_failed, new_bio))
+
+    def refresh(self, db, timeout=1):
+        self.check_workers()
+        return super().refresh(db, timeout)
+
+    def shutdown(self):
+        for jobs in self.job_queues:
+            jobs.put(None)
+        for process in self.processes:
+            process.join()
+        for results, reader in zip(self.result_queues, self.readers):
+            results.put(None)
+            reader.join()
+
+if __name__ == '__main__':
+    import os
+    import time
+    import shutil
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from database import Database
+
+    bios = {
+        'test_head': '@test_user',
+        'test_user': '@test_user2 and @literally_satan',
+        'test_user2': '@end_user',
+        'end_user': 'the end of the chain',
+        'literally_satan': '@test_head',
+    }
+
+    # set once a request for hanging_user comes in, which then waits for release
+    hanging = threading.Event()
+    release = threading.Event()
+
+    class TMeStub(BaseHTTPRequestHandler):
+        """Stands in for t.me"""
+        def do_GET(self):
+            username = self.path.strip('/')
+            if username == 'hanging_user':
+                hanging.set()
+                release.wait(10)
+            if username not in bios:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = f'<head><meta property="og:description" content="{bios[username]}"></head>'.encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TMeStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'db.json')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'), filename)
+        db = Database(filename)
+
+        # usernames come from the membership cache, so no Bot API is needed
+        membership = MembershipCache()
+        for user_id, user in db.users.items():
+            membership.observe(user_id, user.username)
+
+        pool = ProcessRefreshPool(None, workers=2, batch_size=2, membership=membership,
+                                  tme_url=f'http://127.0.0.1:{server.server_address[1]}')
+        def refresh_all():
+            all_changes = []
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                changes, busy = pool.refresh(db)
+                all_changes.extend(changes)
+                if not busy and db.get_expired_count() == 0:
+                    break
+            return all_changes
+
+        all_changes = refresh_all()
+
+        assert sorted((change.user_id, change.current) for change in all_changes) == [
+            ('666', ['test_head']), ('69', ['test_user2', 'literally_satan']), ('8888', []),
+        ]
+        assert db.users['69'].bio == ['test_user2', 'literally_satan']
+        assert all(not db.users[user_id].is_expired() for user_id in db.users)
+
+        # a worker that dies mid-fetch fails what it was sent, instead of leaving the pool busy forever
+        membership.observe('69', 'hanging_user')
+        db.users['69'].expires = 0
+        pool.refresh(db, timeout=0)
+        assert hanging.wait(10) and pool.busy()
+        shard = get_shard('69', pool.workers)
+        dead = pool.processes[shard]
+        dead.kill()
+        dead.join()
+        release.set()
+        refresh_all()
+        assert not pool.busy() and pool.processes[shard] is not dead
+        assert METRICS.get('biochain_refresh_worker_restarts_total') == 1
+        assert db.users['69'].to_dict()['fetch_failures'] == 1
+
+        # the new worker takes over
+        membership.observe('69', 'test_user')
+        db.users['69'].expires = 0
+        refresh_all()
+        assert db.users['69'].to_dict().get('fetch_failures', 0) == 0
+        pool.shutdown()
+
+    server.shutdown()
+    print('ok')
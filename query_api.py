@@ -0,0 +1,358 @@
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from matrix import State
+from metrics import METRICS, timed
+
+
+class ChainIndex:
+    """
+    Everything the query API answers from, taken from a Database right after update_best_chain()
+
+    It's built in the main loop and never changed afterwards, so server threads read it without
+    locks while the Database moves on. Users are looked up by ID or username in a dict, and so
+    are their position in the chain, the branch they're on and the link they should have.
+    Only paths and whole lists take time proportional to their length.
+    """
+    def __init__(self, db):
+        self.chain = list(db.best_chain)
+        # user ID -> position in the best chain, the head is 0
+        self.position = {user_id: i for i, user_id in enumerate(self.chain)}
+        self.usernames = dict(db.usernames.usernames)
+        # username.lower() -> user ID
+        self.ids = {username: claimers[-1] for username, claimers in db.usernames.claims.items()}
+        self.tree = db.chain_engine.get_tree()
+        self.head = next((user_id for user_id in self.chain if self.usernames.get(user_id)), None)
+
+        # the same branches and suggestions as Database.get_branch_announcements(), best first
+        self.branches = []
+        # user ID -> number of the branch it's on, for users in a branch but not in the chain
+        self.branch_of = {}
+        # user ID -> number of the branch it's the merger of, for branches told to link to another head
+        self.mergers = {}
+        link_to = self.head
+        for branch_head in db.chain_engine.get_branch_heads():
+            number = len(self.branches)
+            node = branch_head
+            last = None
+            while node is not None and node not in self.position and node not in self.branch_of:
+                self.branch_of[node] = number
+                last, node = node, self.tree.get_next(node)
+
+            # the branch merges into the chain after its last node, or wherever the branch it ran into does
+            # (what TreeIndex.get_merger() finds, without looking up every branch again)
+            merger = last if node in self.position else None
+            if node in self.branch_of:
+                merger = self.branches[self.branch_of[node]]['merger']
+
+            branch = {'head': branch_head, 'length': self.tree.get_depth(branch_head) + 1,
+                      'merger': None, 'merges_into': None, 'should_link_to': None}
+            if merger is not None:
+                merges_into = self.tree.get_next(merger)
+                branch['merger'] = merger
+                branch['merges_into'] = merges_into
+                if db.matrix.get_link_to(merger, merges_into) is not State.DEAD:
+                    branch['should_link_to'] = link_to
+                    self.mergers.setdefault(merger, number)
+                    link_to = branch_head
+            self.branches.append(branch)
+
+    def get_id(self, name):
+        """Returns the ID of a user given as an ID or a username (with or without @), or None"""
+        if name.lstrip('-').isdigit():
+            return name if name in self.usernames or name in self.tree else None
+        return self.ids.get(name.lstrip('@').lower())
+
+    def get_ref(self, user_id):
+        if user_id is None:
+            return None
+        return {'id': user_id, 'username': self.usernames.get(user_id, '')}
+
+    def get_recommended_link(self, user_id):
+        """Returns who user_id should link to: the next user in the chain or its branch, or the head to join"""
+        if user_id in self.position:
+            return self.tree.get_next(user_id)
+        if user_id in self.mergers:
+            return self.branches[self.mergers[user_id]]['should_link_to']
+        if user_id in self.tree:
+            return self.tree.get_next(user_id)
+        return self.head
+
+    def get_branch(self, number):
+        branch = dict(self.branches[number])
+        for key in ('head', 'merger', 'merges_into', 'should_link_to'):
+            branch[key] = self.get_ref(branch[key])
+        branch['merge_position'] = self.position.get(self.branches[number]['merges_into'])
+        return branch
+
+    def get_user(self, user_id):
+        user = self.get_ref(user_id)
+        position = self.position.get(user_id)
+        branch = self.branch_of.get(user_id)
+        user.update({
+            'in_chain': position is not None,
+            'position': position,
+            'distance_to_end': self.tree.get_depth(user_id) if user_id in self.tree else None,
+            'branch': self.get_branch(branch) if branch is not None else None,
+            'recommended_link': self.get_ref(self.get_recommended_link(user_id)),
+        })
+        return user
+
+    def get_path(self, user_id):
+        """Returns the users from user_id to the end node, or an empty list if it doesn't get there"""
+        if user_id in self.position:
+            return self.chain[self.position[user_id]:]
+        path = []
+        node = user_id if user_id in self.tree else None
+        while node is not None:
+            path.append(node)
+            node = self.tree.get_next(node)
+        return path
+
+    def get_chain(self):
+        return {
+            'length': len(self.chain),
+            'head': self.get_ref(self.head),
+            'chain': [self.get_ref(user_id) for user_id in self.chain],
+        }
+
+    def answer(self, parts):
+        """Returns the JSON-able answer to the path split into parts, or None if there isn't one"""
+        if parts == ['chain']:
+            return self.get_chain()
+        if parts == ['head']:
+            return self.get_user(self.head) if self.head else None
+        if parts == ['branches']:
+            return [self.get_branch(number) for number in range(len(self.branches))]
+        if len(parts) in (2, 3) and parts[0] == 'users':
+            user_id = self.get_id(parts[1])
+            if user_id is None:
+                return None
+            if len(parts) == 2:
+                return self.get_user(user_id)
+            if parts[2] == 'path':
+                return [self.get_ref(node) for node in self.get_path(user_id)]
+        return None
+
+
+class QueryServer:
+    """
+    Serves the latest ChainIndex of every group as JSON over HTTP from background threads
+
+        GET /chain, /head, /branches, /users/<ID or @username>, /users/<ID or @username>/path
+        ?chat=<chat ID> picks the group when there's more than one
+
+    Indexes are built in the main loop, and after a chain rebuild only once a query wants one:
+    the query waits for the main loop's next build_wanted(). Responses are cached until the index
+    changes and carry an ETag of their body, so clients that poll with If-None-Match mostly get an
+    empty 304.
+    """
+    max_cached = 10000
+    # longest a query waits for the main loop to build an out of date index before it gets the old one
+    wait_timeout = 5
+
+    def __init__(self):
+        # chat ID -> ChainIndex
+        self.indexes = {}
+        # chat ID -> Database, for the groups whose index is out of date
+        self.stale = {}
+        # chat IDs of the stale indexes that queries are waiting for
+        self.wanted = set()
+        # called from a server thread when a query starts waiting, to wake the main loop up
+        self.on_wanted = None
+        # (path, query string) -> (ChainIndex it came from, ETag, body)
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.index_built = threading.Condition(self.lock)
+
+    @timed('biochain_phase_seconds', phase='chain_index')
+    def publish(self, chat_id, db):
+        """Builds a ChainIndex of db right away, call it from the main loop after update_best_chain()"""
+        index = ChainIndex(db)
+        with self.lock:
+            self.indexes[chat_id] = index
+            self.stale.pop(chat_id, None)
+            self.wanted.discard(chat_id)
+            self.index_built.notify_all()
+
+    def invalidate(self, chat_id, db):
+        """Marks the index of chat_id out of date after update_best_chain(), without building a new one yet"""
+        with self.lock:
+            self.stale[chat_id] = db
+
+    def build_wanted(self):
+        """Builds the out of date indexes that queries are waiting for, call it from the main loop"""
+        with self.lock:
+            wanted = [(chat_id, self.stale[chat_id]) for chat_id in self.wanted if chat_id in self.stale]
+        for chat_id, db in wanted:
+            self.publish(chat_id, db)
+
+    def _get_index(self, query):
+        with self.lock:
+            if 'chat' in query:
+                try:
+                    chat_id = int(query['chat'][0])
+                except ValueError:
+                    return None
+            elif len(self.indexes) == 1:
+                chat_id = next(iter(self.indexes))
+            else:
+                return None
+            if chat_id not in self.stale:
+                return self.indexes.get(chat_id)
+            self.wanted.add(chat_id)
+
+        if self.on_wanted:
+            self.on_wanted()
+        with self.lock:
+            self.index_built.wait_for(lambda: chat_id not in self.stale, self.wait_timeout)
+            return self.indexes.get(chat_id)
+
+    def get(self, url, if_none_match=None):
+        """Returns a tuple: (HTTP status, ETag or None, body) for a GET of url"""
+        split = urlsplit(url)
+        index = self._get_index(parse_qs(split.query))
+        key = (split.path, split.query)
+
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached is None or cached[0] is not index:
+            parts = [unquote(part) for part in split.path.strip('/').split('/')]
+            if index is None:
+                METRICS.inc('biochain_queries_total', status=404)
+                return 404, None, json.dumps({'error': 'unknown chat, pass ?chat=<chat ID>'}).encode()
+            answer = index.answer(parts)
+            if answer is None:
+                METRICS.inc('biochain_queries_total', status=404)
+                return 404, None, json.dumps({'error': 'not found'}).encode()
+
+            body = json.dumps(answer, ensure_ascii=False).encode()
+            etag = '"{}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest())
+            cached = (index, etag, body)
+            with self.lock:
+                if len(self.cache) >= self.max_cached:
+                    self.cache.clear()
+                self.cache[key] = cached
+
+        index, etag, body = cached
+        if if_none_match == etag:
+            METRICS.inc('biochain_queries_total', status=304)
+            return 304, etag, b''
+        METRICS.inc('biochain_queries_total', status=200)
+        return 200, etag, body
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves get() over HTTP from a background thread, returns the server"""
+        query_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, etag, body = query_server.get(self.path, self.headers.get('If-None-Match'))
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='query api', daemon=True).start()
+        print(f'Serving chain queries on http://{host}:{server.server_address[1]}/chain')
+        return server
+
+
+if __name__ == '__main__':
+    import os
+    import shutil
+    import tempfile
+    import urllib.request
+    import urllib.error
+    from database import Database
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'db.json')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'), filename)
+        db = Database(filename)
+        # a branch: new_head -> test_user2, merging into the chain at test_user2
+        db.add_user('7', 'new_head')
+        db.users['7'].set_bio(['test_user2'])
+        db.update_best_chain('8888', rebuild_links=True)
+        assert db.best_chain == ['420', '69', '42', '8888']
+
+        query_server = QueryServer()
+        query_server.publish(-1, db)
+        index = query_server.indexes[-1]
+
+        assert index.get_id('@TEST_USER') == '69' and index.get_id('69') == '69' and index.get_id('nobody') is None
+        user = index.get_user('69')
+        assert user['position'] == 1 and user['distance_to_end'] == 2 and user['in_chain']
+        assert user['recommended_link'] == {'id': '42', 'username': 'test_user2'}
+        assert index.get_path('69') == ['69', '42', '8888']
+
+        # the branch's merger should link to the head, like the announcement says
+        branch = index.get_user('7')
+        assert not branch['in_chain'] and branch['distance_to_end'] == 2
+        assert branch['branch']['merger']['id'] == '7' and branch['branch']['merge_position'] == 2
+        assert branch['recommended_link']['username'] == 'test_head'
+        assert index.get_path('7') == ['7', '42', '8888']
+        # users that don't reach the end are told to link to the head
+        assert index.get_user('666')['recommended_link']['id'] == '420'
+        assert index.get_path('666') == []
+
+        server = query_server.serve(0)
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with urllib.request.urlopen(url + '/users/@test_user') as r:
+            etag = r.headers['ETag']
+            assert json.loads(r.read())['position'] == 1
+        with urllib.request.urlopen(url + '/head?chat=-1') as r:
+            assert json.loads(r.read())['username'] == 'test_head'
+        with urllib.request.urlopen(url + '/chain') as r:
+            assert [user['id'] for user in json.loads(r.read())['chain']] == db.best_chain
+
+        # polling with the ETag gets a 304 until something in the answer changes
+        request = urllib.request.Request(url + '/users/@test_user', headers={'If-None-Match': etag})
+        try:
+            urllib.request.urlopen(request)
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 304
+        query_server.publish(-1, db)
+        assert query_server.get('/users/@test_user', etag)[0] == 304
+        db.users['69'].set_username('test_user_renamed')
+        db.update_username_index('69')
+        query_server.publish(-1, db)
+        status, new_etag, body = query_server.get('/users/69', etag)
+        assert status == 200 and new_etag != etag and json.loads(body)['username'] == 'test_user_renamed'
+
+        # after a rebuild the index is only built again once a query wants it, and by the main loop
+        builds = METRICS.get('biochain_phase_seconds', phase='chain_index')
+        db.users['69'].set_username('test_user_lazy')
+        db.update_username_index('69')
+        query_server.invalidate(-1, db)
+        query_server.invalidate(-1, db)
+        query_server.build_wanted()
+        assert METRICS.get('biochain_phase_seconds', phase='chain_index') == builds
+
+        wanted = threading.Event()
+        query_server.on_wanted = wanted.set
+        answers = []
+        thread = threading.Thread(target=lambda: answers.append(query_server.get('/users/69')))
+        thread.start()
+        assert wanted.wait(5)
+        query_server.build_wanted()
+        thread.join()
+        assert json.loads(answers[0][2])['username'] == 'test_user_lazy'
+        assert METRICS.get('biochain_phase_seconds', phase='chain_index') == builds + 1
+        assert query_server.get('/users/69')[2] == answers[0][2]
+
+        for path in ('/users/nobody', '/nothing', '/users/69/nothing', '/chain?chat=5'):
+            assert query_server.get(path)[0] == 404, path
+        server.shutdown()
+
+    print('ok')
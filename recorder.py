@@ -0,0 +1,204 @@
+import gzip
+import json
+import threading
+from urllib.parse import urlsplit
+import storage
+import util
+from bio_cache import RE_SCRAPE_BIO_BYTES
+
+
+def open_trace(filename, mode='r'):
+    """Opens a trace file as text, gzipped if the name ends with .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+def read_trace(filename):
+    """Yields the records of a trace file in the order they were written"""
+    with open_trace(filename) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class RecordingBot:
+    """Passes calls through to bot, recording what getChatMember answered"""
+    def __init__(self, bot, recorder):
+        self.bot = bot
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def getChatMember(self, chat_id, user_id, *args, **kwargs):
+        try:
+            member = self.bot.getChatMember(chat_id, user_id, *args, **kwargs)
+        except Exception as e:
+            self.recorder.write('member', id=str(user_id), error=type(e).__name__)
+            raise
+        self.recorder.write('member', id=str(user_id), username=member.user.username or '', status=member.status)
+        return member
+
+
+class RecordingResponse:
+    """Wraps a streamed requests response, recording the og:description once it has been read"""
+    def __init__(self, response, recorder, username):
+        self.response = response
+        self.recorder = recorder
+        self.username = username
+        self.data = b''
+        self.recorded = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def _record(self):
+        if self.recorded:
+            return
+        self.recorded = True
+        match = RE_SCRAPE_BIO_BYTES.search(self.data)
+        description = match.group(1).decode('utf-8', 'replace') if match else None
+        self.recorder.write('bio', username=self.username, status=self.response.status_code, description=description)
+
+    def iter_content(self, chunk_size=1):
+        for chunk in self.response.iter_content(chunk_size):
+            self.data += chunk
+            yield chunk
+        self._record()
+
+    @property
+    def text(self):
+        text = self.response.text
+        self.data = text.encode()
+        self._record()
+        return text
+
+    def close(self):
+        # a page only read up to the tag still has it in data
+        if self.data or not self.response.ok:
+            self._record()
+        self.response.close()
+
+
+class RecordingSession:
+    """Passes requests through to session, recording the bio pages that come back"""
+    def __init__(self, session, recorder):
+        self.session = session
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def get(self, url, *args, **kwargs):
+        r = self.session.get(url, *args, **kwargs)
+        username = urlsplit(url).path.strip('/')
+        if r.status_code == 304:
+            # nothing new, replay keeps serving the last description
+            return r
+        return RecordingResponse(r, self.recorder, username)
+
+
+class Recorder:
+    """
+    Writes what the bot gets from the outside world to a trace file for replay.py
+
+    Every record is a line of JSON with the time it happened: the Database as it was when
+    recording started, then incoming updates, getChatMember results and the og:description of
+    the bio pages that were fetched. Bio pages are stored without the rest of the HTML.
+    """
+    def __init__(self, filename, db, end_node, bot_username):
+        self.file = open_trace(filename, 'a')
+        self.lock = threading.Lock()
+        data = storage.get_data(db.users, db.matrix)
+        self.write('start', db=data, end_node=end_node, bot_username=bot_username)
+
+    def write(self, kind, **fields):
+        line = json.dumps({'t': round(util.clock(), 3), 'kind': kind, **fields}, separators=(',', ':'), ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def on_update(self, bot, update):
+        self.write('update', update=update.to_dict())
+
+    def wrap_bot(self, bot):
+        return RecordingBot(bot, self)
+
+    def wrap_session(self, session):
+        return RecordingSession(session, self)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from types import SimpleNamespace
+    from database import Database
+    from util import CHAT_ID
+
+    class Response:
+        def __init__(self, status_code, body=b''):
+            self.status_code = status_code
+            self.ok = status_code < 400
+            self.body = body
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(self.body), chunk_size):
+                yield self.body[i:i + chunk_size]
+
+        def close(self):
+            pass
+
+    class Session:
+        def get(self, url, **kwargs):
+            if url.endswith('/nobody'):
+                return Response(404)
+            if url.endswith('/same'):
+                return Response(304)
+            return Response(200, b'<head><meta property="og:description" content="@test_user &amp; friends"></head>')
+
+    class Bot:
+        def getChatMember(self, chat_id, user_id):
+            if user_id == '666':
+                raise RuntimeError('gone')
+            return SimpleNamespace(user=SimpleNamespace(username='test_head'), status='member')
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'))
+        filename = os.path.join(directory, 'trace.jsonl.gz')
+        recorder = Recorder(filename, db, '8888', 'biochain_bot')
+
+        session = recorder.wrap_session(Session())
+        r = session.get('http://t.me/test_head', stream=True)
+        assert b''.join(r.iter_content(16)).endswith(b'</head>')
+        r.close()
+        session.get('http://t.me/nobody').close()
+        assert session.get('http://t.me/same').status_code == 304
+
+        bot = recorder.wrap_bot(Bot())
+        assert bot.getChatMember(CHAT_ID, '420').user.username == 'test_head'
+        try:
+            bot.getChatMember(CHAT_ID, '666')
+            assert False
+        except RuntimeError:
+            pass
+        recorder.close()
+
+        records = list(read_trace(filename))
+        assert records[0]['kind'] == 'start' and records[0]['db']['420']['links_to'] == ['69']
+        assert [(record['kind'], record.get('username'), record.get('description')) for record in records[1:]] == [
+            ('bio', 'test_head', '@test_user &amp; friends'),
+            ('bio', 'nobody', None),
+            ('member', 'test_head', None),
+            ('member', None, None),
+        ]
+        assert records[-1]['error'] == 'RuntimeError'
+
+    print('ok')
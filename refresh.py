@@ -0,0 +1,290 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+from bio_cache import BioCache
+from metrics import METRICS
+from util import get_current_timestamp, REBUILD_MAX_DELAY
+
+
+class PendingChanges:
+    """
+    Changes waiting for the chain to be rebuilt
+
+    When the first change comes in, the users that are overdue or being fetched right then are
+    remembered, and the changes are ready once all of those have been refreshed or max_delay seconds
+    have passed. Users that expire after that don't hold the rebuild back, so it still happens when
+    the pool never gets a moment to go idle.
+    """
+    def __init__(self, max_delay=REBUILD_MAX_DELAY):
+        self.max_delay = max_delay
+        self.changes = []
+        self.waiting_for = deque()
+        self.since = None
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def extend(self, changes, db, in_flight_ids):
+        """Adds changes, in_flight_ids are the IDs of the users of db that are being fetched"""
+        if changes and not self.changes:
+            self.since = get_current_timestamp()
+            self.waiting_for = deque(list(in_flight_ids) + db.expiry.get_overdue())
+        self.changes.extend(changes)
+
+    def get_delay(self):
+        """Returns how many seconds until the changes are ready no matter what, or None if there are none"""
+        if not self.changes:
+            return None
+        return max(self.since + self.max_delay - get_current_timestamp(), 0)
+
+    def is_ready(self, db, in_flight_ids):
+        """Returns True if there are changes and everyone who was due when they started coming in has been refreshed"""
+        if not self.changes:
+            return False
+
+        now = get_current_timestamp()
+        expires = db.expiry.expires
+        while self.waiting_for:
+            user_id = self.waiting_for[0]
+            if user_id in in_flight_ids or expires.get(user_id, now) < now:
+                break
+            self.waiting_for.popleft()
+
+        if self.waiting_for and self.get_delay() > 0:
+            return False
+        return True
+
+    def take(self):
+        """Returns the changes and starts over"""
+        changes, self.changes = self.changes, []
+        self.waiting_for = deque()
+        self.since = None
+        return changes
+
+
+class RefreshPool:
+    """
+    Fetches usernames and bios of expired users in worker threads
+
+    Workers only fetch, the results are applied to the Database by refresh() which
+    is called from the main loop, in the order the users were taken out of the schedule.
+    """
+    def __init__(self, bot, concurrency=8, bio_cache=None, membership=None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.bio_cache = bio_cache if bio_cache is not None else BioCache()
+        self.membership = membership
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # one keep-alive session shared by every worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.in_flight = deque()
+        self.in_flight_ids = set()
+        # users that were marked for updating again while they were being fetched
+        self.requeue = set()
+
+    def busy(self):
+        return bool(self.in_flight)
+
+    def _fetch(self, user):
+        """Runs in a worker thread, must not change anything"""
+        new_username, fetch_failed = user.fetch_username(self.bot, self.membership)
+        new_bio = user.fetch_bio(new_username, self.session, self.bio_cache)
+        if new_bio is None and self.membership is not None:
+            # the cached username might be out of date, ask the Bot API next time
+            self.membership.invalidate(user.id)
+        return new_username, fetch_failed, new_bio
+
+    def _submit(self, user):
+        """Starts fetching user, returns a future of what _fetch() returns"""
+        return self.executor.submit(self._fetch, user)
+
+    def _flush(self):
+        """Called after submit_expired() has submitted everything it's going to"""
+
+    def submit_expired(self, db):
+        """Starts fetching expired users until every worker is busy"""
+        while len(self.in_flight) < self.concurrency:
+            user_id = db.pop_expired()
+            if user_id is None:
+                break
+
+            if user_id in self.in_flight_ids:
+                self.requeue.add(user_id)
+                continue
+
+            print('updating', db.users[user_id].str_with_id())
+            self.in_flight.append((user_id, self._submit(db.users[user_id])))
+            self.in_flight_ids.add(user_id)
+
+        self._flush()
+
+    def collect(self, db):
+        """Applies every finished fetch that isn't waiting on an earlier one, returns a list of changes"""
+        pending_changes = []
+
+        while self.in_flight and self.in_flight[0][1].done():
+            user_id, future = self.in_flight.popleft()
+            self.in_flight_ids.remove(user_id)
+            user = db.users[user_id]
+
+            METRICS.inc('biochain_refreshes_total')
+            try:
+                new_username, fetch_failed, new_bio = future.result()
+            except Exception as e:
+                print('  Failed to update', user.str_with_id(), type(e), e)
+                METRICS.inc('biochain_refresh_errors_total')
+                new_username, fetch_failed, new_bio = None, False, None
+
+            if user.disabled:
+                continue
+
+            changes = user.apply_refresh(new_username, fetch_failed, new_bio, db.is_near_chain(user_id))
+            if user_id in self.requeue:
+                self.requeue.remove(user_id)
+                user.expires = 0
+
+            db.handle_changes(changes, user_id)
+            pending_changes.extend(changes)
+
+        return pending_changes
+
+    def refresh(self, db, timeout=1):
+        """
+        Waits up to timeout seconds for the oldest fetch to finish and applies what's done
+        Returns a tuple: (list of changes, True if any user is being updated) like Database.update_first_expired()
+        """
+        self.submit_expired(db)
+        if not self.busy():
+            return [], False
+
+        wait([self.in_flight[0][1]], timeout=timeout)
+        return self.collect(db), True
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import shutil
+    import tempfile
+    import threading
+    from types import SimpleNamespace
+    from database import Database
+    from util import REQUEST_TIMEOUT
+
+    # every user gets a new bio, test_head's page takes a while and end_user's page can't be fetched
+    bios = {
+        'test_head': '@test_user2',
+        'test_user': '@end_user',
+        'test_user2': '@literally_satan',
+        'literally_satan': '@test_user',
+    }
+    release = threading.Event()
+    timeouts = []
+
+    class Response:
+        status_code = 200
+        ok = True
+        headers = {}
+
+        def __init__(self, body):
+            self.body = body
+
+        def iter_content(self, chunk_size):
+            yield self.body
+
+        def close(self):
+            pass
+
+    class Session:
+        def get(self, url, timeout=None, **kwargs):
+            timeouts.append(timeout)
+            username = url.rsplit('/', 1)[-1]
+            if username == 'test_head':
+                release.wait(10)
+            if username == 'end_user':
+                raise ConnectionError('connection reset')
+            return Response(f'<meta property="og:description" content="{bios[username]}">'.encode())
+
+        def close(self):
+            pass
+
+    class Bot:
+        def getChatMember(self, chat_id, user_id):
+            return SimpleNamespace(user=SimpleNamespace(username=usernames[user_id]), status='member')
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'db.json')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'), filename)
+        db = Database(filename)
+        usernames = {user_id: user.username for user_id, user in db.users.items()}
+        for expires, user_id in enumerate(['420', '69', '42', '8888', '666'], 1):
+            db.users[user_id].expires = expires
+
+        popped = []
+        pop_expired = db.pop_expired
+        db.pop_expired = lambda: popped.append(pop_expired()) or popped[-1]
+
+        pool = RefreshPool(Bot(), concurrency=8)
+        pool.session = Session()
+
+        # nothing is applied while the first user taken out of the schedule is still being fetched
+        start = time.perf_counter()
+        changes, busy = pool.refresh(db, timeout=0.1)
+        assert changes == [] and busy and time.perf_counter() - start < 1
+        assert popped[0] == '420'
+
+        # a user marked for updating while it's being fetched is updated again afterwards
+        db.users['69'].expires = 0
+        release.set()
+        all_changes = []
+        while pool.busy() or db.get_expired_count() > 0:
+            changes, busy = pool.refresh(db)
+            all_changes.extend(changes)
+        pool.shutdown()
+
+        # changes are applied in the order the users were taken out of the schedule
+        applied = [change.user_id for change in all_changes]
+        assert applied == [user_id for user_id in popped if user_id in applied][:len(applied)], (applied, popped)
+        # taken out again while in flight, then once more after its first result was applied
+        assert popped.count('69') == 3 and applied.count('69') == 1
+        assert db.users['420'].bio == ['test_user2'] and db.users['69'].bio == ['end_user']
+
+        # the failed fetch is counted and the user is scheduled again like any other failure
+        assert METRICS.get('biochain_refresh_errors_total') == 1
+        assert db.users['8888'].bio == ['bio_chain'] and not db.users['8888'].is_expired()
+        assert db.users['8888'].to_dict()['fetch_failures'] == 1
+
+        # a hung t.me connection can't keep a worker busy forever
+        assert timeouts and all(timeout == REQUEST_TIMEOUT for timeout in timeouts)
+
+        # changes wait for the users that were due when they came in, not for the ones that are due later
+        db.users['420'].expires = 1
+        db.users['69'].expires = 2
+        pending_changes = PendingChanges(max_delay=60)
+        pending_changes.extend(['change'], db, {'42'})
+        assert not pending_changes.is_ready(db, {'42'})
+        db.users['420'].expires = db.users['69'].expires = get_current_timestamp() + 1000
+        db.users['8888'].expires = 0
+        assert not pending_changes.is_ready(db, {'42'})
+        assert pending_changes.is_ready(db, {'8888'})
+        assert pending_changes.take() == ['change'] and not pending_changes.is_ready(db, set())
+
+        # or for max_delay seconds at most
+        pending_changes = PendingChanges(max_delay=0)
+        pending_changes.extend(['change'], db, {'42'})
+        assert pending_changes.is_ready(db, {'42'})
+
+    print('ok')
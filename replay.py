@@ -0,0 +1,292 @@
+"""
+Replays a trace recorded with tg_bot_biochain_trace through the bot on simulated time and prints
+what happened as JSON: per-phase timings and every message that would have been sent
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import itertools
+from collections import Counter
+from types import SimpleNamespace
+import telegram
+import util
+from util import *
+from database import Database
+from membership import MembershipCache
+from outbox import Outbox
+from refresh import RefreshPool
+from metrics import METRICS
+from file_string import FileString
+from recorder import read_trace
+from bot import ChainBot
+
+
+class SimulatedClock:
+    """Time that only moves when it's told to, stands in for util.clock"""
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, now):
+        self.now = max(self.now, now)
+
+
+class World:
+    """
+    What Telegram looked like at the simulated time: the members and bio pages seen in the trace so far
+
+    Until the trace says otherwise, users have the username and bio they had in the Database
+    when recording started.
+    """
+    def __init__(self, db):
+        # user ID -> (username, status, error or None)
+        self.members = {}
+        # lowercase username -> (HTTP status, og:description or None)
+        self.bios = {}
+        for user_id, user in db.users.items():
+            self.members[user_id] = (user.username, 'member', None)
+            if user.username:
+                # what t.me shows for users without a bio, the user's own username isn't a link
+                description = ' '.join('@' + username for username in user.bio) or f'You can contact @{user.username} right away.'
+                self.bios[user.username.lower()] = (200, description)
+
+    def apply(self, record):
+        if record['kind'] == 'member':
+            self.members[record['id']] = (record.get('username', ''), record.get('status'), record.get('error'))
+        elif record['kind'] == 'bio':
+            self.bios[record['username'].lower()] = (record['status'], record['description'])
+
+
+class ReplayResponse:
+    def __init__(self, status_code, body=b''):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {'Content-Length': str(len(body))}
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode()
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class ReplaySession:
+    """Answers bio page requests from a World instead of t.me"""
+    def __init__(self, world):
+        self.world = world
+
+    def get(self, url, *args, **kwargs):
+        status, description = self.world.bios.get(url.rstrip('/').rsplit('/', 1)[-1].lower(), (404, None))
+        if description is None:
+            return ReplayResponse(status)
+        return ReplayResponse(status, f'<head><meta property="og:description" content="{description}"></head>'.encode())
+
+    def close(self):
+        pass
+
+
+class StubBot:
+    """Answers getChatMember from a World and records every other Bot API call instead of making it"""
+    # Update.de_json() looks for the bot's defaults
+    defaults = None
+
+    def __init__(self, world, clock, username):
+        self.world = world
+        self.clock = clock
+        self.username = username
+        self.message_ids = itertools.count(1)
+        self.sent = []
+
+    def getChatMember(self, chat_id, user_id, *args, **kwargs):
+        username, status, error = self.world.members.get(str(user_id), ('', 'left', None))
+        if error == 'TimedOut':
+            raise telegram.error.TimedOut()
+        if error:
+            raise telegram.error.TelegramError(error)
+        return SimpleNamespace(user=SimpleNamespace(username=username), status=status)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            message_id = next(self.message_ids)
+            record = {'t': self.clock(), 'method': name}
+            record.update((key, value) for key, value in kwargs.items() if isinstance(value, (str, int, float, bool)))
+            self.sent.append(record)
+            return SimpleNamespace(message_id=message_id)
+
+        return call
+
+
+class Replay:
+    """
+    Feeds a trace through a Database, a RefreshPool, ChainBot's handlers and its chain rebuilds
+
+    Time only passes when nothing is left to do before the next record or the next expired
+    user, so a day of traffic takes as long as the work it caused. Everything is written to
+    directory, nothing the bot uses is touched.
+    """
+    def __init__(self, filename, directory, concurrency=8):
+        records = read_trace(filename)
+        start = next(records)
+        if start['kind'] != 'start':
+            raise ValueError('Trace does not begin with a start record')
+        # a bot that was restarted appended a new start record, its state came from what's replayed before it
+        self.records = [record for record in records if record['kind'] != 'start']
+
+        self.clock = SimulatedClock(start['t'])
+        self.start_time = start['t']
+        util.clock = self.clock
+
+        db_filename = os.path.join(directory, 'db.json')
+        with open(db_filename, 'w') as f:
+            json.dump(start['db'], f)
+        self.db = Database(db_filename, save_delay=0)
+        self.end_node = start['end_node']
+
+        self.world = World(self.db)
+        self.bot = StubBot(self.world, self.clock, start['bot_username'])
+        self.outbox = Outbox(self.bot, rate=10**9, burst=10**9)
+        self.membership = MembershipCache()
+        self.chain_bot = ChainBot(
+            self.db, self.outbox, self.membership, self.end_node,
+            FileString(os.path.join(directory, 'chain_pages.json')),
+            FileString(os.path.join(directory, 'last_pin.txt')),
+            FileString(os.path.join(directory, 'last_chain.txt')),
+        )
+        self.refresh_pool = RefreshPool(self.bot, concurrency, membership=self.membership)
+        self.refresh_pool.session = ReplaySession(self.world)
+
+    def apply(self, record):
+        if record['kind'] == 'update':
+            update = telegram.Update.de_json(record['update'], self.bot)
+            self.chain_bot.handle_update(self.bot, update)
+        else:
+            self.world.apply(record)
+
+    def run(self):
+        """Replays every record, returns the report"""
+        wall_start = time.perf_counter()
+        self.db.update_best_chain(self.end_node, rebuild_links=True)
+
+        pending_changes = []
+        i = 0
+        while True:
+            while i < len(self.records) and self.records[i]['t'] <= self.clock():
+                self.apply(self.records[i])
+                i += 1
+
+            with METRICS.time('biochain_phase_seconds', phase='refresh'):
+                changes, busy = self.refresh_pool.refresh(self.db)
+            pending_changes.extend(changes)
+            if busy or self.db.get_expired_count() > 0:
+                continue
+
+            if pending_changes:
+                self.chain_bot.process_changes(pending_changes)
+                self.outbox.drain()
+
+            if i == len(self.records):
+                break
+            # skip ahead to whatever happens next
+            next_time = self.records[i]['t']
+            next_id, expires = self.db.expiry.peek()
+            if next_id is not None:
+                next_time = min(next_time, expires + 1)
+            self.clock.advance_to(next_time)
+
+        self.refresh_pool.shutdown()
+        self.outbox.close()
+        wall_seconds = time.perf_counter() - wall_start
+        simulated_seconds = self.clock() - self.start_time
+
+        return {
+            'simulated_seconds': simulated_seconds,
+            'wall_seconds': wall_seconds,
+            'speedup': simulated_seconds / wall_seconds if wall_seconds else None,
+            'records': dict(Counter(record['kind'] for record in self.records)),
+            'refreshes': METRICS.get('biochain_refreshes_total'),
+            'chain_length': len(self.db.best_chain),
+            'phases': {
+                dict(labels)['phase']: {'count': count, 'seconds': total}
+                for labels, (count, total) in sorted(METRICS.get_histograms('biochain_phase_seconds').items())
+            },
+            'messages': self.bot.sent,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a trace recorded with tg_bot_biochain_trace')
+    parser.add_argument('trace', help='trace file, gzipped if it ends with .gz')
+    parser.add_argument('--workers', type=int, default=8, help='refresh concurrency')
+    parser.add_argument('--output', help='file to write the report to instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = Replay(args.trace, directory, args.workers).run()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__' and sys.argv[1:]:
+    main()
+elif __name__ == '__main__':
+    from recorder import Recorder
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json'))
+        now = 1600000000
+        util.clock = lambda: now
+
+        # record a day: a new member joins, test_head's bio changes an hour in and end_user leaves
+        trace_filename = os.path.join(directory, 'trace.jsonl.gz')
+        recorder = Recorder(trace_filename, db, '8888', 'biochain_bot')
+        chat = {'id': CHAT_ID, 'type': 'supergroup'}
+        now += 10
+        recorder.write('update', update={'update_id': 1, 'message': {
+            'message_id': 100, 'date': now, 'chat': chat,
+            'from': {'id': 777, 'is_bot': False, 'first_name': 'New', 'username': 'new_user'},
+            'new_chat_members': [{'id': 777, 'is_bot': False, 'first_name': 'New', 'username': 'new_user'}],
+        }})
+        now += 3600
+        recorder.write('bio', username='test_head', status=200, description='@new_user and @someone_else')
+        recorder.write('bio', username='new_user', status=200, description='I link to @test_user')
+        now += 86400
+        recorder.write('member', id='666', username='literally_satan', status='left')
+        recorder.close()
+
+        replay = Replay(trace_filename, os.path.join(directory))
+        report = replay.run()
+        util.clock = time.time
+
+        assert report['records'] == {'update': 1, 'bio': 2, 'member': 1}
+        assert report['simulated_seconds'] >= 86400 + 3600
+        # a simulated day takes seconds at most
+        assert report['wall_seconds'] < 30
+        assert report['phases']['update_best_chain']['count'] >= 2
+
+        texts = [message.get('text', '') for message in report['messages']]
+        assert any('Welcome, ' in text for text in texts), texts
+        assert any('remove their unnecessary link to <code>@someone_else</code>' in text for text in texts), texts
+        # the new member is picked up as the new head and the chain is pinned
+        assert replay.db.best_chain[:2] == ['420', '777'], replay.db.best_chain
+        assert any(message['method'] == 'pinChatMessage' for message in report['messages'])
+
+    print('ok')
@@ -0,0 +1,139 @@
+import heapq
+from util import get_current_timestamp
+
+
+class ExpiryScheduler:
+    """
+    Priority queue of user IDs keyed on when they expire
+
+    Rescheduling a user pushes a new entry and leaves the old one to be skipped when it
+    reaches the top (lazy decrease-key). Users that are found to be overdue are moved
+    into a set, so counting them doesn't need to look at every user.
+    """
+    def __init__(self):
+        self.expires = {}
+        self._heap = []
+        self._pending = []
+        self._overdue = set()
+        # called when a user is scheduled to expire before everyone else, can be set by the runtime
+        self.on_earlier = None
+
+    def __len__(self):
+        return len(self.expires)
+
+    def __contains__(self, user_id):
+        return user_id in self.expires
+
+    def schedule(self, user_id, expires):
+        """Adds user_id to the queue, or moves it if it's already there"""
+        if self.expires.get(user_id) == expires:
+            return
+
+        self.expires[user_id] = expires
+        self._overdue.discard(user_id)
+        heapq.heappush(self._heap, (expires, user_id))
+        heapq.heappush(self._pending, (expires, user_id))
+
+        if len(self._heap) > 2 * len(self.expires) + 64:
+            self._compact()
+
+        if self.on_earlier is not None and self._heap[0] == (expires, user_id):
+            self.on_earlier()
+
+    def remove(self, user_id):
+        if self.expires.pop(user_id, None) is not None:
+            self._overdue.discard(user_id)
+
+    def _is_current(self, entry):
+        expires, user_id = entry
+        return self.expires.get(user_id) == expires
+
+    def _compact(self):
+        """Drops every stale entry from both heaps"""
+        self._heap = [(expires, user_id) for user_id, expires in self.expires.items()]
+        heapq.heapify(self._heap)
+        self._pending = [entry for entry in self._pending if self._is_current(entry)]
+        heapq.heapify(self._pending)
+
+    def peek(self):
+        """Returns a tuple: (user ID that expires next, when it expires), or (None, None) if empty"""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            return None, None
+        expires, user_id = self._heap[0]
+        return user_id, expires
+
+    def pop_due(self, now=None):
+        """Removes and returns the user ID that expires next if it expired before now, otherwise None"""
+        if now is None:
+            now = get_current_timestamp()
+
+        user_id, expires = self.peek()
+        if user_id is None or expires >= now:
+            return None
+
+        self.remove(user_id)
+        return user_id
+
+    def get_overdue_count(self, now=None):
+        """Returns how many users expired before now"""
+        if now is None:
+            now = get_current_timestamp()
+
+        while self._pending and self._pending[0][0] < now:
+            entry = heapq.heappop(self._pending)
+            if self._is_current(entry):
+                self._overdue.add(entry[1])
+
+        return len(self._overdue)
+
+    def get_overdue(self, now=None):
+        """Returns the IDs of the users that expired before now, the ones that expired first first"""
+        self.get_overdue_count(now)
+        return sorted(self._overdue, key=self.expires.get)
+
+
+if __name__ == '__main__':
+    scheduler = ExpiryScheduler()
+    assert scheduler.peek() == (None, None)
+
+    scheduler.schedule('a', 100)
+    scheduler.schedule('b', 50)
+    scheduler.schedule('c', 200)
+    assert scheduler.peek() == ('b', 50)
+    assert scheduler.get_overdue_count(now=10) == 0
+    assert scheduler.get_overdue_count(now=150) == 2
+
+    # decrease-key
+    scheduler.schedule('c', 0)
+    assert scheduler.peek() == ('c', 0)
+    assert scheduler.get_overdue_count(now=150) == 3
+
+    # moving an overdue user into the future
+    scheduler.schedule('c', 1000)
+    scheduler.schedule('b', 1000)
+    assert scheduler.peek() == ('a', 100)
+    assert scheduler.get_overdue_count(now=150) == 1
+
+    scheduler.remove('a')
+    assert scheduler.peek() == ('b', 1000)
+    assert scheduler.get_overdue_count(now=150) == 0
+    assert len(scheduler) == 2
+
+    assert scheduler.pop_due(now=150) is None
+    scheduler.schedule('e', 5)
+    assert scheduler.pop_due(now=150) == 'e'
+    assert 'e' not in scheduler
+    assert scheduler.get_overdue_count(now=150) == 0
+
+    for i in range(1000):
+        scheduler.schedule('d', i)
+    assert len(scheduler._heap) < 100
+    assert scheduler.peek() == ('d', 999)
+    assert scheduler.get_overdue_count(now=2000) == 3
+    overdue = scheduler.get_overdue(now=2000)
+    assert overdue[0] == 'd' and sorted(overdue) == ['b', 'c', 'd']
+
+    print('ok')
@@ -0,0 +1,270 @@
+import os
+import json
+import sqlite3
+import matrix
+from file_string import write_atomic
+
+
+def get_links_to(link_matrix, user_id):
+    """Returns user_id's links in the db.json format: a list of IDs, dead ones are prefixed with '!'"""
+    links = []
+    for link_id in link_matrix.get_links_to(user_id):
+        is_dead = link_matrix.get_link_to(user_id, link_id) is matrix.State.DEAD
+        links.append(('!' if is_dead else '') + link_id)
+    return links
+
+
+def get_data(users, link_matrix):
+    """Returns everything in the db.json format"""
+    data = {}
+    for user_id, user in users.items():
+        data[user_id] = user.to_dict()
+        link_ids = get_links_to(link_matrix, user_id)
+        if link_ids:
+            data[user_id]['links_to'] = link_ids
+    return data
+
+
+class JsonStorage:
+    """
+    Stores everything in one JSON file that is rewritten on every save
+
+    The JSON of every user is kept between saves, so only users that changed are serialized again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # user ID -> '"user ID": {...}' as it was last written
+        self.fragments = {}
+
+    def load(self):
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def save(self, users, link_matrix, dirty=None):
+        """
+        Writes the file, returns how many bytes that was
+        dirty: IDs of the users whose data or links changed since the last save, None if it isn't known
+        """
+        if dirty is None or not self.fragments:
+            self.fragments = {}
+            dirty = users.keys()
+
+        for user_id in dirty:
+            user = users.get(user_id)
+            if user is None:
+                self.fragments.pop(user_id, None)
+                continue
+
+            data = user.to_dict()
+            link_ids = get_links_to(link_matrix, user_id)
+            if link_ids:
+                data['links_to'] = link_ids
+            self.fragments[user_id] = json.dumps(user_id) + ': ' + json.dumps(data)
+
+        text = '{' + ', '.join(self.fragments.values()) + '}'
+        write_atomic(self.filename, text)
+        return len(text)
+
+
+class SqliteStorage:
+    """
+    Stores users and links as rows in an SQLite database
+
+    The rows that were last loaded or saved are remembered, so a save only writes the
+    ones that differ, in a single transaction.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS links ('
+                'linker TEXT NOT NULL, linked TEXT NOT NULL, dead INTEGER NOT NULL, '
+                'PRIMARY KEY (linker, linked))'
+            )
+
+        # user ID -> data
+        self.user_rows = {}
+        # linker -> {linked: dead}
+        self.link_rows = {}
+
+    def load(self):
+        data = {}
+        self.user_rows = {}
+        for user_id, user_data in self.conn.execute('SELECT id, data FROM users'):
+            data[user_id] = json.loads(user_data)
+            self.user_rows[user_id] = user_data
+
+        self.link_rows = {}
+        for linker, linked, dead in self.conn.execute('SELECT linker, linked, dead FROM links'):
+            self.link_rows.setdefault(linker, {})[linked] = dead
+            if linker in data:
+                data[linker].setdefault('links_to', []).append(('!' if dead else '') + linked)
+
+        return data
+
+    def save(self, users, link_matrix, dirty=None):
+        """
+        Writes the rows that changed, returns roughly how many bytes that was
+        dirty: IDs of the users whose data or links changed since the last save, None to compare every row
+        """
+        if dirty is None:
+            dirty = users.keys() | self.user_rows.keys() | self.link_rows.keys()
+
+        user_rows = {}
+        link_rows = {}
+        changed_users = []
+        deleted_users = []
+        changed_links = []
+        deleted_links = []
+        for user_id in dirty:
+            user = users.get(user_id)
+            row = json.dumps(user.to_dict()) if user is not None else None
+            if row is None and user_id in self.user_rows:
+                deleted_users.append((user_id,))
+            elif row is not None and self.user_rows.get(user_id) != row:
+                changed_users.append((user_id, row))
+            user_rows[user_id] = row
+
+            links = {}
+            if user is not None:
+                for link_id in link_matrix.get_links_to(user_id):
+                    links[link_id] = int(link_matrix.get_link_to(user_id, link_id) is matrix.State.DEAD)
+            old_links = self.link_rows.get(user_id, {})
+            changed_links.extend((user_id, link_id, dead) for link_id, dead in links.items() if old_links.get(link_id) != dead)
+            deleted_links.extend((user_id, link_id) for link_id in old_links.keys() - links.keys())
+            link_rows[user_id] = links
+
+        if not (changed_users or deleted_users or changed_links or deleted_links):
+            return 0
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO users (id, data) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET data = excluded.data',
+                changed_users
+            )
+            self.conn.executemany('DELETE FROM users WHERE id = ?', deleted_users)
+            self.conn.executemany(
+                'INSERT INTO links (linker, linked, dead) VALUES (?, ?, ?) '
+                'ON CONFLICT (linker, linked) DO UPDATE SET dead = excluded.dead',
+                changed_links
+            )
+            self.conn.executemany('DELETE FROM links WHERE linker = ? AND linked = ?', deleted_links)
+
+        for user_id, row in user_rows.items():
+            if row is None:
+                self.user_rows.pop(user_id, None)
+            else:
+                self.user_rows[user_id] = row
+        for user_id, links in link_rows.items():
+            if links:
+                self.link_rows[user_id] = links
+            else:
+                self.link_rows.pop(user_id, None)
+
+        return (
+            sum(len(user_id) + len(row) for user_id, row in changed_users)
+            + sum(len(linker) + len(linked) + 1 for linker, linked, dead in changed_links)
+        )
+
+    def import_data(self, data):
+        """Replaces everything with data in the db.json format"""
+        with self.conn:
+            self.conn.execute('DELETE FROM users')
+            self.conn.execute('DELETE FROM links')
+            for user_id, user_data in data.items():
+                user_data = dict(user_data)
+                for link_id in user_data.pop('links_to', []):
+                    dead = link_id[0] == '!'
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO links (linker, linked, dead) VALUES (?, ?, ?)',
+                        (user_id, link_id[1:] if dead else link_id, int(dead))
+                    )
+                self.conn.execute('INSERT INTO users (id, data) VALUES (?, ?)', (user_id, json.dumps(user_data)))
+
+
+def is_sqlite_filename(filename):
+    return os.path.splitext(filename)[1] in ('.sqlite', '.sqlite3', '.db')
+
+
+def get_storage(filename):
+    """Picks a storage backend from the extension of filename"""
+    if is_sqlite_filename(filename):
+        return SqliteStorage(filename)
+    return JsonStorage(filename)
+
+
+def migrate_json_to_sqlite(json_filename, sqlite_filename):
+    """One-shot migration from a db.json file, does nothing if the SQLite database already exists"""
+    if os.path.exists(sqlite_filename):
+        return False
+
+    print(f'Migrating {json_filename} to {sqlite_filename}...')
+    SqliteStorage(sqlite_filename).import_data(JsonStorage(json_filename).load())
+    return True
+
+
+if __name__ == '__main__':
+    import tempfile
+    from user import User
+
+    example_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_db.json')
+    example_data = JsonStorage(example_filename).load()
+    example_data['666']['links_to'] = ['!420']
+
+    with tempfile.TemporaryDirectory() as directory:
+        json_filename = os.path.join(directory, 'db.json')
+        sqlite_filename = os.path.join(directory, 'db.sqlite3')
+        with open(json_filename, 'w') as f:
+            json.dump(example_data, f)
+
+        assert migrate_json_to_sqlite(json_filename, sqlite_filename)
+        assert not migrate_json_to_sqlite(json_filename, sqlite_filename)
+
+        storage = get_storage(sqlite_filename)
+        assert isinstance(storage, SqliteStorage)
+        assert storage.load() == example_data
+
+        users = {user_id: User(user_id, user_data) for user_id, user_data in example_data.items()}
+        link_matrix = matrix.LinkMatrix()
+        for user_id, user_data in example_data.items():
+            for link_id in user_data.get('links_to', []):
+                state = matrix.State.DEAD if link_id[0] == '!' else matrix.State.REAL
+                link_matrix.set_link_to(user_id, link_id.lstrip('!'), state)
+
+        # saving without changes doesn't write anything
+        total_changes = storage.conn.total_changes
+        storage.save(users, link_matrix)
+        assert storage.conn.total_changes == total_changes
+
+        # only the changed rows are written
+        users['69'].bio = ['end_user']
+        link_matrix.set_link_to('69', '42', matrix.State.DEAD)
+        link_matrix.set_link_to('666', '420', matrix.State.NONE)
+        storage.save(users, link_matrix)
+        assert storage.conn.total_changes == total_changes + 3
+
+        data = SqliteStorage(sqlite_filename).load()
+        assert data['69'] == {'username': 'test_user', 'bio': ['end_user'], 'links_to': ['!42']}
+        assert 'links_to' not in data['666']
+
+        # saving only the users known to have changed gives the same rows
+        users['42'].bio = ['literally_satan']
+        link_matrix.set_link_to('42', '666', matrix.State.REAL)
+        storage.save(users, link_matrix, {'42'})
+        assert storage.conn.total_changes == total_changes + 5
+        assert SqliteStorage(sqlite_filename).load()['42'] == {
+            'username': 'test_user2', 'bio': ['literally_satan'], 'links_to': ['8888', '666']
+        }
+
+        json_storage = JsonStorage(json_filename)
+        json_storage.save(users, link_matrix)
+        full = json_storage.load()
+        users['420'].bio = []
+        json_storage.save(users, link_matrix, {'420'})
+        assert json_storage.load() == full | {'420': {'username': 'test_head', 'links_to': ['69']}}
+
+    print('ok')
@@ -0,0 +1,365 @@
+"""
+Serves t.me bio pages and the Bot API methods the bot uses for a generated population, with
+configurable latency, failures and bio churn, so refreshes can be load tested without Telegram.
+Point the bot at it with tg_bot_biochain_stub_url.
+"""
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+import bench
+
+
+class Faults:
+    """How slow and unreliable one kind of endpoint is"""
+    def __init__(self, latency=0.0, jitter=0.5, rate_429=0.0, rate_5xx=0.0, retry_after=1):
+        # median latency in seconds, and the sigma of its lognormal distribution
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+
+    def get_latency(self, rng):
+        if not self.latency:
+            return 0
+        return min(rng.lognormvariate(math.log(self.latency), self.jitter), 30 * self.latency)
+
+    def get_failure(self, rng):
+        """Returns the status code to fail with, or None"""
+        roll = rng.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return rng.choice([500, 502, 503])
+        return None
+
+
+class Population:
+    """
+    Users generated by bench.generate_db() whose bios change over time
+
+    Every bio edit is remembered with the time it was made, so how long the bot took to
+    notice it can be measured.
+    """
+    def __init__(self, user_count, seed=0):
+        self.data, self.end_node = bench.generate_db(user_count, seed)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.usernames = {user_id: user_data['username'] for user_id, user_data in self.data.items()}
+        self.ids = {username.lower(): user_id for user_id, username in self.usernames.items()}
+        # user ID -> list of linked usernames, and a version for ETags
+        self.bios = {user_id: list(user_data['bio']) for user_id, user_data in self.data.items()}
+        self.versions = Counter()
+        # user ID -> when its bio was last edited, until pop_edit() takes it
+        self.edits = {}
+        self.edit_count = 0
+
+    def get_page(self, username):
+        """Returns (user ID, version, og:description) or None if there's no such user"""
+        user_id = self.ids.get(username.lower())
+        if user_id is None:
+            return None
+        with self.lock:
+            bio = self.bios[user_id]
+            version = self.versions[user_id]
+        description = ' '.join('@' + linked for linked in bio) or f'You can contact @{self.usernames[user_id]} right away.'
+        return user_id, version, description
+
+    def edit_random_bio(self):
+        """Points a random user's bio at another random user, like someone joining somewhere else"""
+        with self.lock:
+            user_id = self.rng.choice(list(self.bios))
+            linked = self.usernames[self.rng.choice(list(self.bios))]
+            if linked == self.usernames[user_id] or self.bios[user_id] == [linked]:
+                return None
+            self.bios[user_id] = [linked]
+            self.versions[user_id] += 1
+            self.edits.setdefault(user_id, time.monotonic())
+            self.edit_count += 1
+            return user_id
+
+    def pop_edit(self, user_id):
+        """Returns when user_id's bio was first edited since the last call, or None"""
+        with self.lock:
+            return self.edits.pop(user_id, None)
+
+
+class StubServer:
+    """
+    HTTP server that answers GET /<username> like t.me and /bot<token>/<method> like the Bot API
+
+    Bot API calls are answered for getMe, getUpdates, getChatMember, sendMessage, editMessageText,
+    pinChatMessage, deleteMessage and deleteWebhook, everything else fails with 404.
+    """
+    def __init__(self, population, tme_faults=None, api_faults=None, churn=0.0, port=0, host='127.0.0.1', seed=0):
+        self.population = population
+        self.tme_faults = tme_faults or Faults()
+        self.api_faults = api_faults or Faults()
+        # bio edits per second
+        self.churn = churn
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.message_ids = iter(range(1, 2**31))
+        self.requests = Counter()
+        self.stopping = threading.Event()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.handle(self)
+
+            def do_POST(self):
+                stub.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='stub server', daemon=True).start()
+        if self.churn:
+            threading.Thread(target=self._churn, name='bio churn', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _churn(self):
+        while not self.stopping.wait(self.rng.expovariate(self.churn)):
+            self.population.edit_random_bio()
+
+    def _count(self, *key):
+        with self.rng_lock:
+            self.requests[key] += 1
+
+    def _roll(self, faults):
+        """Sleeps for the latency, returns the status code to fail with or None"""
+        with self.rng_lock:
+            latency = faults.get_latency(self.rng)
+            failure = faults.get_failure(self.rng)
+        if latency:
+            time.sleep(latency)
+        return failure
+
+    def _send(self, handler, status, body=b'', content_type='text/html', headers=()):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler):
+        url = urlsplit(handler.path)
+        parts = url.path.strip('/').split('/')
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+
+        if len(parts) == 2 and parts[0].startswith('bot'):
+            params = dict(parse_qsl(url.query))
+            if body:
+                if handler.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update(json.loads(body))
+                else:
+                    params.update(parse_qsl(body.decode()))
+            self._handle_api(handler, parts[1], params)
+        elif len(parts) == 1 and parts[0]:
+            self._handle_page(handler, parts[0])
+        else:
+            self._send(handler, 404)
+
+    def _handle_page(self, handler, username):
+        failure = self._roll(self.tme_faults)
+        if failure:
+            self._count('tme', failure)
+            headers = [('Retry-After', str(self.tme_faults.retry_after))] if failure == 429 else []
+            self._send(handler, failure, headers=headers)
+            return
+
+        page = self.population.get_page(username)
+        if page is None:
+            self._count('tme', 404)
+            self._send(handler, 404)
+            return
+
+        user_id, version, description = page
+        etag = f'"{user_id}-{version}"'
+        if handler.headers.get('If-None-Match') == etag:
+            self._count('tme', 304)
+            self._send(handler, 304, headers=[('ETag', etag)])
+            return
+
+        self._count('tme', 200)
+        body = (
+            '<!DOCTYPE html><html><head><meta charset="utf-8">'
+            f'<meta property="og:title" content="{username}">'
+            f'<meta property="og:description" content="{description}">'
+            '</head><body>' + 'x' * 4096 + '</body></html>'
+        ).encode()
+        self._send(handler, 200, body, headers=[('ETag', etag)])
+
+    def _get_user(self, user_id):
+        user_id = str(user_id)
+        return {
+            'id': int(user_id), 'is_bot': False, 'first_name': f'User {user_id}',
+            'username': self.population.usernames.get(user_id, ''),
+        }
+
+    def _get_message(self, params):
+        return {
+            'message_id': int(params.get('message_id') or next(self.message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'},
+            'text': params.get('text', ''),
+        }
+
+    def _handle_api(self, handler, method, params):
+        if method == 'getUpdates':
+            # long polling that never gets anything
+            self.stopping.wait(min(float(params.get('timeout') or 0), 1))
+            result = []
+        else:
+            failure = self._roll(self.api_faults)
+            if failure:
+                self._count('api', method, failure)
+                error = {'ok': False, 'error_code': failure, 'description': 'Stub failure'}
+                if failure == 429:
+                    error['description'] = f'Too Many Requests: retry after {self.api_faults.retry_after}'
+                    error['parameters'] = {'retry_after': self.api_faults.retry_after}
+                self._send(handler, failure, json.dumps(error).encode(), 'application/json')
+                return
+
+            if method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+            elif method == 'getChatMember':
+                user_id = str(params.get('user_id'))
+                status = 'member' if user_id in self.population.usernames else 'left'
+                result = {'user': self._get_user(user_id), 'status': status}
+            elif method in ('sendMessage', 'editMessageText'):
+                result = self._get_message(params)
+            elif method in ('pinChatMessage', 'deleteMessage', 'deleteWebhook'):
+                result = True
+            else:
+                self._count('api', method, 404)
+                error = {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+                self._send(handler, 404, json.dumps(error).encode(), 'application/json')
+                return
+
+        self._count('api', method, 200)
+        self._send(handler, 200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+
+    def stats(self):
+        with self.rng_lock:
+            return {' '.join(map(str, key)): count for key, count in sorted(self.requests.items(), key=str)}
+
+
+def add_arguments(parser):
+    """Adds the population and fault options shared with loadtest.py"""
+    parser.add_argument('--users', type=int, default=1000, help='size of the generated population')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--churn', type=float, default=1.0, help='bio edits per second')
+    parser.add_argument('--tme-latency', type=float, default=0.1, help='median t.me latency (seconds)')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='median Bot API latency (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='sigma of the lognormal latencies')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests that get 429')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='share of requests that get a 5xx')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds 429 responses ask to wait')
+
+
+def from_arguments(args, port=0):
+    population = Population(args.users, args.seed)
+    return StubServer(
+        population,
+        Faults(args.tme_latency, args.jitter, args.rate_429, args.rate_5xx, args.retry_after),
+        Faults(args.api_latency, args.jitter, args.rate_429, args.rate_5xx, args.retry_after),
+        churn=args.churn, port=port, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stands in for t.me and the Bot API')
+    add_arguments(parser)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--db', help='file to write the population to in the db.json format, to start the bot with')
+    args = parser.parse_args()
+
+    stub = from_arguments(args, args.port)
+    if args.db:
+        with open(args.db, 'w') as f:
+            json.dump(stub.population.data, f)
+    stub.start()
+    print(f'Serving {args.users} users on {stub.url}, end node {stub.population.end_node}', file=sys.stderr)
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(stub.stats()), file=sys.stderr)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__' and sys.argv[1:]:
+    main()
+elif __name__ == '__main__':
+    import requests
+    import telegram
+    from user import User
+    from bio_cache import BioCache
+    from util import CHAT_ID
+
+    population = Population(50)
+    stub = StubServer(population).start()
+    bot = telegram.Bot('123:stub', base_url=stub.url + '/bot')
+    session = requests.Session()
+    cache = BioCache(base_url=stub.url)
+
+    user_id = next(user_id for user_id, bio in population.bios.items() if bio)
+    user = User(user_id, {'username': population.usernames[user_id]})
+    assert user.fetch_username(bot) == (population.usernames[user_id], False)
+    assert [username.lower() for username in user.fetch_bio(session=session, cache=cache)] == \
+        [username.lower() for username in population.bios[user_id]]
+    user.bio = population.bios[user_id]
+    # not modified, answered from the ETag
+    assert user.fetch_bio(session=session, cache=cache) is user.bio
+    assert stub.requests['tme', 304] == 1
+
+    # edits show up on the page and are remembered until they're noticed
+    while population.edit_random_bio() is None:
+        pass
+    edited_id = next(iter(population.edits))
+    edited = User(edited_id, {'username': population.usernames[edited_id]})
+    assert edited.fetch_bio(session=session, cache=cache) == population.bios[edited_id]
+    assert population.pop_edit(edited_id) is not None and population.pop_edit(edited_id) is None
+
+    message = bot.sendMessage(chat_id=CHAT_ID, text='the game')
+    bot.editMessageText(chat_id=CHAT_ID, message_id=message.message_id, text='chain')
+    bot.pinChatMessage(chat_id=CHAT_ID, message_id=message.message_id, disable_notification=True)
+    assert stub.requests['api', 'pinChatMessage', 200] == 1
+
+    # failures come back the way Telegram sends them
+    stub.api_faults = Faults(rate_429=1, retry_after=3)
+    try:
+        bot.sendMessage(chat_id=CHAT_ID, text='flood')
+        assert False
+    except telegram.error.RetryAfter as e:
+        assert e.retry_after == 3
+    stub.tme_faults = Faults(rate_5xx=1)
+    assert user.fetch_bio(session=session, cache=cache) is None
+
+    stub.stop()
+    print('ok')
@@ -3,6 +3,7 @@ import html
 import requests
 import re
 from util import *
+from metrics import METRICS
 import telegram
 
 
@@ -10,22 +11,51 @@ RE_SCRAPE_BIO = re.compile(r'<meta +property="og:description" +content="(.+?)".*
 RE_USERNAME = re.compile(r'@([a-zA-Z][\w\d]{4,31})')
 
 
+def parse_bio(description, username):
+    """Returns the usernames linked in a bio, without duplicates or the user's own username"""
+    new_bio = {}
+    for bio_username in RE_USERNAME.findall(html.unescape(description)):
+        if bio_username.lower() == username.lower():
+            continue
+        new_bio[bio_username.lower()] = bio_username
+
+    return [v for k, v in new_bio.items()]
+
+
 class User:
     defaults = {
         'bio': [],
         'joined': None,
         'expires': 0,
         'disabled': False,
+        # refresh stats, see get_refresh_interval()
+        'last_change': None,
+        'change_interval': None,
+        'fetch_failures': 0,
     }
 
+    # the attributes to_dict() saves
+    saved_fields = frozenset(['username', *defaults])
+
     def __init__(self, user_id, data):
+        # set by Database to a set that the IDs of users with unsaved changes are added to
+        self.dirty_users = None
         self.id = user_id
         self.username = data['username']
         self.username_fetch_failed = False
+        # set by Database so that changes to expires keep its ExpiryScheduler up to date
+        self.scheduler = None
+        # set by Database.add_user(), the next refresh reports a changes.Joined so the chain gets rebuilt
+        self.just_joined = False
 
         for key, default_val in self.defaults.items():
             setattr(self, key, data.get(key, default_val))
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.saved_fields and self.dirty_users is not None:
+            self.dirty_users.add(self.id)
+
     def __str__(self):
         #todo: handle blank username better
         return '@' + self.username if self.username else f'id:{self.id}'
@@ -36,13 +66,52 @@ class User:
     def str_with_id(self):
         return f'{self} [{self.id}]' if self.username else str(self)
 
+    @property
+    def expires(self):
+        return self._expires
+
+    @expires.setter
+    def expires(self, expires):
+        self._expires = expires
+        if self.scheduler is not None and not self.disabled:
+            self.scheduler.schedule(self.id, expires)
+
     def is_expired(self):
         return self.expires < get_current_timestamp()
 
-    def reset_expiry(self):
-        self.expires = get_current_timestamp() + 60
+    def get_refresh_interval(self, near_chain=False, now=None):
+        """
+        Picks how long to wait before the next refresh: about a tenth of the usual time between changes,
+        doubled for every failed fetch in a row, and never longer than REFRESH_NEAR_CHAIN_INTERVAL
+        for users in or next to the best chain
+        """
+        now = now or get_current_timestamp()
+        since_change = now - (self.last_change or self.joined or now)
+        if self.change_interval is not None:
+            since_change = min(since_change, self.change_interval)
+
+        interval = since_change // 10 * 2 ** min(self.fetch_failures, 6)
+        max_interval = REFRESH_NEAR_CHAIN_INTERVAL if near_chain else REFRESH_MAX_INTERVAL
+        return max(REFRESH_MIN_INTERVAL, min(interval, max_interval))
+
+    def reset_expiry(self, near_chain=False):
+        self.expires = get_current_timestamp() + self.get_refresh_interval(near_chain)
         return True
 
+    def record_refresh(self, failed, changed, now=None):
+        """Updates the stats used by get_refresh_interval()"""
+        now = now or get_current_timestamp()
+        self.fetch_failures = self.fetch_failures + 1 if failed else 0
+
+        if changed and self.last_change is not None:
+            # moving average of the time between changes
+            since_change = now - self.last_change
+            self.change_interval = since_change if self.change_interval is None else \
+                (self.change_interval + since_change) // 2
+        # users without changes count from their first refresh
+        if changed or self.last_change is None:
+            self.last_change = now
+
     def to_dict(self):
         result = {'username': self.username}
         for key, default_val in self.defaults.items():
@@ -51,62 +120,117 @@ class User:
                 result[key] = current_val
         return result
 
-    def update_username(self, bot):
-        pending_changes = []
+    def fetch_username(self, bot, membership=None, chat_id=CHAT_ID):
+        """
+        Fetches the username without changing anything, so that it can run outside of the main loop
+        Only calls getChatMember in chat_id if membership (a MembershipCache) hasn't seen the user recently
+        Returns a tuple: (the username or None if it couldn't be fetched, True if the fetch failed)
+        """
+        cached = membership.get(self.id) if membership is not None else None
+        if cached is not None:
+            username, left = cached
+            if not username and left:
+                print('  Failed to fetch username: user left/kicked, no username available')
+                return None, True
+            return username, False
 
         try:
-            member = bot.getChatMember(CHAT_ID, self.id)
+            METRICS.inc('biochain_api_calls_total', method='getChatMember')
+            member = bot.getChatMember(chat_id, self.id)
             new_username = member.user.username or ''
-            if not new_username and member.status.lower() in ['left', 'kicked']:
+            left = member.status.lower() in ['left', 'kicked']
+            if membership is not None:
+                membership.observe(self.id, new_username, left)
+            if not new_username and left:
                 raise RuntimeError('user left/kicked, no username available')
-            if new_username != self.username:
-                if new_username.lower() != self.username.lower():
-                    pending_changes.append(changes.Username(self.id, self.username, new_username))
-                self.username = new_username
+            return new_username, False
         except telegram.error.TimedOut:
             print('  Timed out fetching username')
         except Exception as e:
-            self.username_fetch_failed = True
             print('  Failed to fetch username', type(e), e)
+            return None, True
+
+        return None, False
+
+    def set_username(self, new_username, fetch_failed=False):
+        """Applies the result of fetch_username() and returns a list of changes"""
+        pending_changes = []
+
+        if fetch_failed:
+            self.username_fetch_failed = True
+        if new_username is not None and new_username != self.username:
+            if new_username.lower() != self.username.lower():
+                pending_changes.append(changes.Username(self.id, self.username, new_username))
+            self.username = new_username
 
         return pending_changes
 
-    def update_bio(self):
-        if self.username:
-            r = requests.get(f'http://t.me/{self.username}')
+    def update_username(self, bot, membership=None):
+        return self.set_username(*self.fetch_username(bot, membership))
+
+    def fetch_bio(self, username=None, session=requests, cache=None):
+        """
+        Fetches the usernames linked in the bio without changing anything
+        Returns None if the bio couldn't be fetched, or the current bio if cache (a BioCache) says it hasn't changed
+        """
+        if username is None:
+            username = self.username
+
+        if username and cache is not None:
+            description, unchanged = cache.fetch(session, username, self.id)
+            if description is None:
+                return None
+            if unchanged:
+                return self.bio
+            bio = [description]
+        elif username:
+            r = session.get(f'{TME_URL}/{username}', timeout=REQUEST_TIMEOUT)
             if not r.ok:
                 print(f'  Request for bio failed ({r.status_code})')
-                return []
+                METRICS.inc('biochain_http_errors_total', status=r.status_code)
+                return None
 
             bio = RE_SCRAPE_BIO.findall(r.text)
             if not bio:
                 print('  Failed to scrape bio tag')
-                return []
+                return None
         else:
             print('  Tried to scrape blank username')
             bio = ['']
 
-        new_bio = {}
-        for bio_username in RE_USERNAME.findall(html.unescape(bio[0])):
-            if bio_username.lower() == self.username.lower():
-                continue
-            new_bio[bio_username.lower()] = bio_username
+        return parse_bio(bio[0], username)
 
+    def set_bio(self, new_bio):
+        """Applies the result of fetch_bio() and returns a list of changes"""
         pending_changes = []
-        new_bio = [v for k, v in new_bio.items()]
-        if not caseless_set_eq(new_bio, self.bio):
+        if new_bio is not None and new_bio is not self.bio and not caseless_set_eq(new_bio, self.bio):
             pending_changes.append(changes.Bio(self.id, self.bio, new_bio))
             self.bio = new_bio
 
         return pending_changes
 
-    def try_update(self, bot):
-        pending_changes = []
-        pending_changes.extend(self.update_username(bot))
-        pending_changes.extend(self.update_bio())
-        self.reset_expiry()
+    def update_bio(self, session=requests, cache=None):
+        return self.set_bio(self.fetch_bio(session=session, cache=cache))
+
+    def apply_refresh(self, new_username, fetch_failed, new_bio, near_chain=False):
+        """Applies the results of fetch_username() and fetch_bio(), reschedules and returns a list of changes"""
+        pending_changes = self.set_username(new_username, fetch_failed)
+        pending_changes.extend(self.set_bio(new_bio))
+        self.record_refresh(new_username is None or new_bio is None, bool(pending_changes))
+        self.reset_expiry(near_chain)
+        if self.just_joined:
+            self.just_joined = False
+            pending_changes.append(changes.Joined(self.id, None, self.username))
         return pending_changes
 
+    def try_update(self, bot, session=requests, near_chain=False, membership=None):
+        new_username, fetch_failed = self.fetch_username(bot, membership)
+        new_bio = self.fetch_bio(new_username, session)
+        if new_bio is None and membership is not None:
+            # the cached username might be out of date, ask the Bot API next time
+            membership.invalidate(self.id)
+        return self.apply_refresh(new_username, fetch_failed, new_bio, near_chain)
+
 
 if __name__ == '__main__':
     user = User(420, {'username': 'test_user'})
@@ -119,3 +243,80 @@ if __name__ == '__main__':
     print(user)
     user = User(69, {'username': ''})
     print(user)
+
+    # users who haven't changed in a long time are refreshed less often, up to the bounds
+    now = 10**9
+    user = User(1, {'username': 'idle_user'})
+    assert user.get_refresh_interval(now=now) == REFRESH_MIN_INTERVAL
+    user.record_refresh(failed=False, changed=False, now=now - 10**7)
+    assert user.get_refresh_interval(now=now) == REFRESH_MAX_INTERVAL
+    assert user.get_refresh_interval(near_chain=True, now=now) == REFRESH_NEAR_CHAIN_INTERVAL
+    user.record_refresh(failed=False, changed=True, now=now - 3000)
+    user.record_refresh(failed=False, changed=True, now=now - 1000)
+    assert user.change_interval == (10**7 - 3000 + 2000) // 2
+    user.record_refresh(failed=False, changed=True, now=now - 1000)
+    user.change_interval = 2000
+    assert user.get_refresh_interval(now=now) == max(REFRESH_MIN_INTERVAL, 100)
+    user.record_refresh(failed=True, changed=False, now=now)
+    user.record_refresh(failed=True, changed=False, now=now)
+    assert user.get_refresh_interval(now=now) == max(REFRESH_MIN_INTERVAL, 400)
+    assert user.to_dict()['fetch_failures'] == 2
+
+    # getChatMember is only called when the membership cache hasn't seen the user recently
+    from membership import MembershipCache
+
+    class Bot:
+        calls = 0
+
+        def getChatMember(self, chat_id, user_id):
+            Bot.calls += 1
+            return telegram.ChatMember(telegram.User(int(user_id), 'Test', False, username='api_user'), 'member')
+
+    membership = MembershipCache()
+    user = User('1', {'username': 'old_user'})
+    assert user.fetch_username(Bot(), membership) == ('api_user', False)
+    assert user.fetch_username(Bot(), membership) == ('api_user', False)
+    assert Bot.calls == 1
+    membership.observe('1', 'seen_user')
+    assert user.fetch_username(Bot(), membership) == ('seen_user', False)
+    membership.observe('1', '', left=True)
+    assert user.fetch_username(Bot(), membership) == (None, True)
+    assert Bot.calls == 1
+
+    # a page cached for someone else is still parsed for this user
+    from bio_cache import BioCache
+
+    class Response:
+        status_code = 304
+        ok = True
+        headers = {}
+
+        def __init__(self, body=None):
+            if body is not None:
+                self.status_code = 200
+                self.body = body
+
+        def iter_content(self, chunk_size):
+            yield self.body
+
+        def close(self):
+            pass
+
+    class Session:
+        def __init__(self):
+            self.responses = []
+
+        def get(self, url, **kwargs):
+            return self.responses.pop(0)
+
+    session = Session()
+    cache = BioCache()
+    session.responses.append(Response(b'<meta property="og:description" content="@someone">'))
+    assert User('1', {'username': 'shared_name', 'bio': []}).fetch_bio(session=session, cache=cache) == ['someone']
+    # the username moved to another user, whose old bio linked somewhere else
+    session.responses.append(Response())
+    assert User('2', {'username': 'shared_name', 'bio': ['elsewhere']}).fetch_bio(session=session, cache=cache) == ['someone']
+    # now the page was last fetched for this user, so it isn't parsed again
+    user = User('2', {'username': 'shared_name', 'bio': ['someone']})
+    session.responses.append(Response())
+    assert user.fetch_bio(session=session, cache=cache) is user.bio
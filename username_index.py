@@ -0,0 +1,87 @@
+class UsernameIndex:
+    """
+    Case-insensitive {username: user ID} lookup that is kept up to date instead of being rebuilt
+
+    More than one user can claim the same username when a rename hasn't been noticed yet,
+    the latest claim wins until it's released.
+    """
+    def __init__(self):
+        # username.lower() -> IDs of the users claiming it, latest last
+        self.claims = {}
+        # user ID -> username
+        self.usernames = {}
+
+    def __len__(self):
+        return len(self.claims)
+
+    def get_id(self, username, default=None):
+        claimers = self.claims.get(username.lower())
+        return claimers[-1] if claimers else default
+
+    def get_username(self, user_id, default=None):
+        return self.usernames.get(user_id, default)
+
+    def add(self, user_id, username):
+        """Claims username for user_id instead of its old one, returns the IDs of the other users claiming it"""
+        old_username = self.usernames.get(user_id)
+        if old_username is not None and old_username.lower() == username.lower():
+            self.usernames[user_id] = username
+            return [claimer for claimer in self.claims[username.lower()] if claimer != user_id]
+
+        self.remove(user_id)
+        if not username:
+            return []
+
+        claimers = self.claims.setdefault(username.lower(), [])
+        claimers.append(user_id)
+        self.usernames[user_id] = username
+        return claimers[:-1]
+
+    def remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is None:
+            return
+
+        claimers = self.claims[username.lower()]
+        claimers.remove(user_id)
+        if not claimers:
+            del self.claims[username.lower()]
+
+    def get_collisions(self):
+        """Returns {username.lower(): IDs of the users claiming it} for usernames claimed more than once"""
+        return {username: list(claimers) for username, claimers in self.claims.items() if len(claimers) > 1}
+
+
+if __name__ == '__main__':
+    index = UsernameIndex()
+    assert index.add('1', 'Alice') == []
+    assert index.add('2', 'bob') == []
+    assert index.get_id('ALICE') == '1'
+    assert index.get_username('1') == 'Alice'
+    assert index.get_id('carol') is None
+
+    # case-only renames keep the claim
+    assert index.add('1', 'alice') == []
+    assert index.get_username('1') == 'alice'
+
+    # bob renamed to alice before alice's rename was noticed
+    assert index.add('2', 'ALICE') == ['1']
+    assert index.get_id('bob') is None
+    assert index.get_id('alice') == '2'
+    assert index.get_collisions() == {'alice': ['1', '2']}
+
+    # alice's rename is noticed, the collision goes away
+    assert index.add('1', 'alice2') == []
+    assert index.get_collisions() == {}
+    assert index.get_id('alice') == '2'
+
+    index.remove('2')
+    assert index.get_id('alice') is None
+    assert index.get_username('2') is None
+    assert len(index) == 1
+
+    # a blank username releases the old one
+    index.add('1', '')
+    assert len(index) == 0
+
+    print('ok')
@@ -1,15 +1,42 @@
+import os
 import time
 from file_string import FileString
 
 
 CHAT_ID = -1001145055784
+# bounds for how often users are refreshed (seconds), see User.get_refresh_interval()
+REFRESH_MIN_INTERVAL = int(os.environ.get('tg_bot_biochain_refresh_min', 60))
+REFRESH_MAX_INTERVAL = int(os.environ.get('tg_bot_biochain_refresh_max', 4 * 60 * 60))
+REFRESH_NEAR_CHAIN_INTERVAL = int(os.environ.get('tg_bot_biochain_refresh_near_chain', 60))
+# how long usernames seen in the chat's updates are trusted instead of calling getChatMember (seconds)
+MEMBERSHIP_TTL = int(os.environ.get('tg_bot_biochain_membership_ttl', 10 * 60))
+# longest time changes are held back before they're written to disk (seconds)
+SAVE_DELAY = float(os.environ.get('tg_bot_biochain_save_delay', 5))
+# a local stub_server.py to use instead of t.me and the Bot API, for load tests
+STUB_URL = os.environ.get('tg_bot_biochain_stub_url')
+# where public profiles are scraped from and where Bot API calls go (the token is appended)
+TME_URL = os.environ.get('tg_bot_biochain_tme_url', STUB_URL or 'http://t.me')
+BOT_API_URL = os.environ.get('tg_bot_biochain_bot_api_url', STUB_URL + '/bot' if STUB_URL else 'https://api.telegram.org/bot')
+# longest wait for a t.me page before the fetch counts as failed (seconds)
+REQUEST_TIMEOUT = float(os.environ.get('tg_bot_biochain_request_timeout', 10))
+# longest a chain rebuild waits for the users that were overdue when its first change came in (seconds)
+REBUILD_MAX_DELAY = float(os.environ.get('tg_bot_biochain_rebuild_max_delay', 10))
+# longest message Telegram allows
+MESSAGE_LIMIT = 4096
+# Bot API calls allowed per chat: messages per second on average and the largest burst
+OUTBOX_RATE = float(os.environ.get('tg_bot_biochain_outbox_rate', 20 / 60))
+OUTBOX_BURST = int(os.environ.get('tg_bot_biochain_outbox_burst', 5))
 LAST_PIN = FileString('last_pin.txt')
 BULLET = '∙ '
 BULLET_2 = '  - '
 
 
+# where get_current_timestamp() gets the time from, replay.py swaps it for a simulated clock
+clock = time.time
+
+
 def get_current_timestamp():
-    return round(time.time())
+    return round(clock())
 
 
 def get_html_mention(user_id, text):